@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Benchmarks cold desktop file index build with different scan_workers.
+
+Generates a synthetic tree of desktop files split in a few desktop file
+paths, like with Flatpak and Snap exports, and builds the desktop file index
+with an empty desktop file cache using 1, 2, 4, ... up to the number of CPUs
+worker processes. Checks that the index is the same with every worker count.
+
+Usage: bench_cold_scan.py [number of desktop files]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import wor.xdg_open as xo
+
+
+DESKTOP_FILE = """[Desktop Entry]
+Type=Application
+Name=Application {0}
+Name[fi]=Sovellus {0}
+Comment=Synthetic application number {0}
+Exec=app{0} %F
+Icon=app{0}
+Categories=Utility;Category{1};
+MimeType=application/x-app{0};text/x-type{1};
+"""
+
+
+def create_tree(paths, count):
+    """Creates `count` desktop files spread over the desktop file paths."""
+    for i in range(count):
+        dp = paths[i % len(paths)]
+        with open(os.path.join(dp, "app{}.desktop".format(i)), "w") as f:
+            f.write(DESKTOP_FILE.format(i, i % 50))
+
+
+def cold_build(workers):
+    """Builds the index with empty caches."""
+    xo.CONFIG["scan_workers"] = workers
+    xo.DESKTOP_FILE_CACHE = {}
+    xo.LOADED_DESKTOP_FILES.clear()
+    start = time.perf_counter()
+    index = xo.build_desktop_file_index()
+    return time.perf_counter() - start, index
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as root:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        paths = [ os.path.join(root, name) for name in
+                ("local", "flatpak", "snap", "usr") ]
+        for dp in paths:
+            os.mkdir(dp)
+        create_tree(paths, count)
+        xo.CONFIG = xo.read_config_options(os.path.join(root, "none.conf"))
+        xo.CONFIG["desktop_file_paths"] = paths
+
+        worker_counts = [1]
+        while worker_counts[-1] * 2 <= (os.cpu_count() or 1):
+            worker_counts.append(worker_counts[-1] * 2)
+        if worker_counts[-1] != os.cpu_count():
+            worker_counts.append(os.cpu_count())
+
+        # First build warms up the OS page cache
+        cold_build(1)
+        serial_t, serial_index = cold_build(1)
+        print("{} desktop files, {} CPUs".format(count, os.cpu_count()))
+        for workers in worker_counts:
+            t, index = cold_build(workers)
+            assert index == serial_index
+            print("{:3d} workers: {:8.1f} ms  {:5.2f}x".format(
+                workers, t * 1000, serial_t / t))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
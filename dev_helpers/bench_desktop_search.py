@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Benchmarks cold desktop file search with and without raw byte prefilter.
+
+Generates a synthetic tree of desktop files, of which only a few have the
+searched mime type, and compares parsing every file with df_parser (the old
+get_desktop_file_by_search() scan) to the prefiltered scan_desktop_files().
+The scan is called directly, as get_desktop_file_by_search() looks indexed
+keys up from the desktop file index. The scan is still used for keys which
+are not indexed and when the index is not available.
+
+Usage: bench_desktop_search.py [number of desktop files]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import wor.xdg_open as xo
+import wor.desktop_file_parser.parser as df_parser
+
+
+DESKTOP_FILE = """[Desktop Entry]
+Type=Application
+Name=Application {0}
+Name[fi]=Sovellus {0}
+Name[de]=Anwendung {0}
+Comment=Synthetic application number {0}
+Comment[fi]=Keinotekoinen sovellus numero {0}
+Exec=app{0} %F
+Icon=app{0}
+Terminal=false
+Categories=Utility;
+MimeType={1};
+
+[Desktop Action new-window]
+Name=New Window
+Exec=app{0} --new-window
+"""
+
+
+def create_tree(root, count, hit_every):
+    """Creates `count` desktop files, every `hit_every`th has text/x-bench."""
+    for i in range(count):
+        mime_type = "text/x-bench" if i % hit_every == hit_every - 1 \
+                else "application/x-app{}".format(i)
+        with open(os.path.join(root, "app{}.desktop".format(i)), "w") as f:
+            f.write(DESKTOP_FILE.format(i, mime_type))
+
+
+def full_parse_scan(key_value_pair):
+    """The scan as it was before prefiltering: parse everything."""
+    found = []
+    for dp in xo.CONFIG["desktop_file_paths"]:
+        for root, dirs, files in xo.nrwalk(
+                dp, filefilter=lambda f,_: not f.endswith(".desktop")):
+            for f in files:
+                with open(os.path.join(root, f)) as df_:
+                    df = df_parser.parse(df_)
+                entry = df.get_entry_key_from_group(entry_key=key_value_pair[0])
+                if entry != None and key_value_pair[1] in entry.value:
+                    found.append(df)
+    return found
+
+
+def prefiltered_scan(key_value_pair):
+    """Current scan with a cold desktop file cache."""
+    xo.DESKTOP_FILE_CACHE = {}
+    xo.LOADED_DESKTOP_FILES.clear()
+    return xo.scan_desktop_files(key_value_pair, find_all=True)
+
+
+def best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as root:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        apps = os.path.join(root, "applications")
+        os.mkdir(apps)
+        create_tree(apps, count, hit_every=500)
+        xo.CONFIG = xo.read_config_options(os.path.join(root, "none.conf"))
+        xo.CONFIG["desktop_file_paths"] = [apps]
+        # Programs of the synthetic desktop files are not installed
+        xo.CONFIG["check_try_exec"] = False
+
+        kvp = ("MimeType", "text/x-bench")
+        full_t, full_found = best_of(lambda: full_parse_scan(kvp))
+        pre_t, pre_found = best_of(lambda: prefiltered_scan(kvp))
+        assert sorted(d.file_name for d in full_found) == \
+                sorted(d.file_name for d in pre_found)
+
+        print("{} desktop files, {} matching".format(count, len(pre_found)))
+        print("full parse scan:  {:8.1f} ms".format(full_t * 1000))
+        print("prefiltered scan: {:8.1f} ms".format(pre_t * 1000))
+        print("speedup:          {:8.1f}x".format(full_t / pre_t))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
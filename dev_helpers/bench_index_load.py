@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Benchmarks opening the desktop file index and doing a lookup.
+
+Generates a synthetic desktop file index dict of the given size, like
+build_desktop_file_index() returns, and compares unpickling it with
+load_cache() to memory mapping it as a MappedIndex, each followed by the
+lookups of one pyxdg-open run. Checks that MappedIndex returns the same
+values as the dict for every key.
+
+Usage: bench_index_load.py [number of desktop files]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import wor.xdg_open as xo
+
+
+def create_index(count):
+    """Returns index dict with `count` desktop files."""
+    index = {"generation": "0" * 40, "ids": {}, "MimeType": {},
+            "Categories": {}, "lists": {}}
+    for i in range(count):
+        df_id = "app{}.desktop".format(i)
+        df_name = "/usr/share/applications/" + df_id
+        index["ids"][df_id] = df_name
+        for mime_type in ("application/x-app{}".format(i),
+                "text/x-type{}".format(i % 50)):
+            index["MimeType"].setdefault(mime_type, []).append(df_name)
+        index["Categories"].setdefault("Category{}".format(i % 20),
+                []).append(df_name)
+        if i % 10 == 0:
+            index["lists"].setdefault("text/x-type{}".format(i % 50),
+                    []).append((df_id, "/usr/share/applications/mimeapps.list"))
+    return index
+
+
+def best_of(func, repeat=20):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as root:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        index = create_index(count)
+        xo.store_cache("index.pickle", index)
+        xo.store_mapped_index("index.bin", xo.MappedIndex.from_index(index))
+
+        mapped = xo.load_mapped_index("index.bin")
+        for mapping in ("MimeType", "Categories"):
+            for key, values in index[mapping].items():
+                assert mapped.lookup(mapping, key) == values
+        for key, value in index["ids"].items():
+            assert mapped.get("ids", key) == value
+        for key, pairs in index["lists"].items():
+            assert mapped.get_pairs("lists", key) == pairs
+        assert mapped.lookup("MimeType", "no/such") == []
+
+        def pickled():
+            i = xo.load_cache("index.pickle")
+            i["lists"].get("text/x-type10", ())
+            i["MimeType"].get("text/x-type10", ())
+            i["ids"].get("app10.desktop")
+        def mmapped():
+            i = xo.load_mapped_index("index.bin")
+            i.get_pairs("lists", "text/x-type10")
+            i.lookup("MimeType", "text/x-type10")
+            i.get("ids", "app10.desktop")
+        pickle_t = best_of(pickled)
+        mmap_t = best_of(mmapped)
+        sizes = [ os.path.getsize(os.path.join(xo.get_cache_dir(), name))
+                for name in ("index.pickle", "index.bin") ]
+
+    print("{} desktop files, index.pickle {} kB, index.bin {} kB".format(
+        count, sizes[0] // 1024, sizes[1] // 1024))
+    print("unpickle + lookups: {:8.2f} ms".format(pickle_t * 1000))
+    print("mmap + lookups:     {:8.2f} ms".format(mmap_t * 1000))
+    print("speedup:            {:8.1f}x".format(pickle_t / mmap_t))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
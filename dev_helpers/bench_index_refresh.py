@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Benchmarks incremental desktop file index refresh.
+
+Generates a synthetic tree of desktop files in a few desktop file paths with
+subdirectories, builds the index once and then refreshes it after adding,
+modifying and removing 0, 1, 10, 100 and 1000 desktop files in one
+directory, and after only modifying 100 desktop files in place, which
+leaves the modification time of their directory as it was. Each refresh is
+compared to a build from scratch with a warm desktop file cache, and checked
+to give the same index as it.
+
+Scanning time is reported separately from serializing the index as a
+MappedIndex, which is done for the whole index also on refresh.
+
+Usage: bench_index_refresh.py [number of desktop files]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import wor.xdg_open as xo
+
+
+DESKTOP_FILE = """[Desktop Entry]
+Type=Application
+Name=Application {0}
+Exec=app{0} %F
+Categories=Utility;Category{1};
+MimeType=application/x-app{0};text/x-type{1};
+"""
+
+
+def write_desktop_file(path, i, variant=0):
+    with open(path, "w") as f:
+        f.write(DESKTOP_FILE.format(i, (i + variant) % 50))
+
+
+def create_tree(paths, count):
+    """Creates `count` desktop files in 10 subdirectories of each path."""
+    dirs = [ os.path.join(dp, "d{}".format(i)) for dp in paths
+            for i in range(10) ]
+    for d in dirs:
+        os.makedirs(d)
+    for i in range(count):
+        write_desktop_file(os.path.join(dirs[i % len(dirs)],
+            "app{}.desktop".format(i)), i)
+    return dirs
+
+
+def change_files(d, changes, round_, in_place=False):
+    """Adds, modifies and removes about `changes` desktop files in `d`.
+
+    If `in_place`, desktop files are only modified. Number of changes is
+    limited to the number of desktop files in `d`.
+
+    Returns:
+        int. Number of changes.
+    """
+    names = sorted(f for f in os.listdir(d) if f.startswith("app"))
+    changes = min(changes, len(names))
+    for i in range(changes):
+        kind = 1 if in_place else i % 3
+        if kind == 0:
+            write_desktop_file(os.path.join(d,
+                "new{}-{}.desktop".format(round_, i)), i)
+        elif kind == 1:
+            n = names.pop()
+            write_desktop_file(os.path.join(d, n), i, variant=round_ + 1)
+        else:
+            os.remove(os.path.join(d, names.pop(0)))
+    return changes
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def full_build():
+    return xo.build_desktop_file_index()
+
+
+def refresh(manifest):
+    """Returns scan time, serialization time and the index."""
+    scan_t, index = timed(lambda: xo.build_desktop_file_index(manifest))
+    serialize_t, _ = timed(lambda: xo.MappedIndex.from_index(index,
+        manifest["hashes"]))
+    return scan_t, serialize_t, index
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as root:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        paths = [ os.path.join(root, name) for name in
+                ("local", "flatpak", "usr") ]
+        dirs = create_tree(paths, count)
+        xo.CONFIG = xo.read_config_options(os.path.join(root, "none.conf"))
+        xo.CONFIG["desktop_file_paths"] = paths
+
+        manifest = xo.new_index_manifest()
+        cold_t, _, _ = refresh(manifest)
+        print("{} desktop files in {} directories".format(count, len(dirs)))
+        print("cold scan: {:.1f} ms".format(cold_t * 1000))
+        print("changes  refresh scan ms  full scan ms  speedup  serialize ms")
+        rounds = [ (changes, False) for changes in (0, 1, 10, 100, 1000) ]
+        rounds.append((100, True))
+        for round_, (changes, in_place) in enumerate(rounds):
+            changes = change_files(dirs[round_], changes, round_, in_place)
+            scan_t, serialize_t, index = refresh(manifest)
+            full_t, full_index = timed(full_build)
+            assert index == full_index
+            print("{:7d}{} {:15.1f}  {:12.1f}  {:6.1f}x  {:12.1f}".format(
+                changes, "i" if in_place else " ", scan_t * 1000,
+                full_t * 1000, full_t / scan_t, serialize_t * 1000))
+        print("i: modified in place")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
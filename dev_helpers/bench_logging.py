@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Benchmarks the cost of logging in the bulk opening path of xdg_open().
+
+Opens a large number of files with xdg_open(dryrun=True) with logging
+disabled altogether, at verbosity 0 and at verbosity 1 with text and JSON
+log formats. Log messages go to os.devnull. The difference between disabled
+logging and verbosity 0 is what logging costs by default.
+
+Usage: bench_logging.py [number of URLs]
+"""
+
+import gc
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import wor.xdg_open as xo
+
+
+def set_logging(handler, disabled=False, level=logging.WARNING,
+        formatter=None):
+    """Sets up logging for a benchmarked mode."""
+    logging.disable(logging.CRITICAL if disabled else logging.NOTSET)
+    logging.root.setLevel(level)
+    handler.setFormatter(formatter)
+
+
+def best_of(modes, func, repeat=5):
+    """Returns best time of each mode, runs of modes are interleaved.
+
+    Each timed run follows an untimed one in the same mode, so that garbage
+    and caches left by the previous mode don't count.
+    """
+    times = [ [] for _ in modes ]
+    for _ in range(repeat):
+        for i, setup in enumerate(modes):
+            setup()
+            func()
+            gc.collect()
+            start = time.perf_counter()
+            func()
+            times[i].append(time.perf_counter() - start)
+    return [ min(t) for t in times ]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as root, \
+            open(os.devnull, "w") as devnull:
+        apps = os.path.join(root, "applications")
+        os.mkdir(apps)
+        with open(os.path.join(apps, "app.desktop"), "w") as f:
+            f.write("[Desktop Entry]\nType=Application\nName=App\n"
+                    "Exec=app %F\nMimeType=text/plain;\n")
+        config_fn = os.path.join(root, "pyxdg-open.conf")
+        with open(config_fn, "w") as f:
+            f.write("desktop_file_paths = {}\n"
+                    "search_order = desktop_file_paths\n"
+                    "check_try_exec = false\n".format(apps))
+        files = os.path.join(root, "files")
+        os.mkdir(files)
+        urls = []
+        for i in range(count):
+            urls.append(os.path.join(files, "file{}.txt".format(i)))
+            open(urls[-1], "w").close()
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        xo.CONFIG = xo.read_config_options(config_fn)
+        if xo.HAS_MAGIC:
+            xo.MM = xo.magic.open(xo.magic.MIME_TYPE)
+            xo.MM.load()
+
+        handler = logging.StreamHandler(devnull)
+        logging.root.addHandler(handler)
+        run = lambda: xo.xdg_open(urls, dryrun=True)
+        # Builds the caches
+        run()
+
+        modes = [
+            lambda: set_logging(handler, disabled=True),
+            lambda: set_logging(handler),
+            lambda: set_logging(handler, level=logging.INFO,
+                formatter=logging.Formatter(
+                    '%(levelname)s:%(funcName)s:%(lineno)s: %(message)s')),
+            lambda: set_logging(handler, level=logging.INFO,
+                formatter=xo.JsonLogFormatter()),
+            ]
+        disabled_t, quiet_t, text_t, json_t = best_of(modes, run)
+
+    print("{} URLs".format(count))
+    for name, t in (("logging disabled", disabled_t),
+            ("verbosity 0", quiet_t), ("verbosity 1, text", text_t),
+            ("verbosity 1, json", json_t)):
+        print("{:18} {:8.1f} ms {:7.2f} us/URL".format(name, t * 1000,
+            t / count * 1e6))
+    print("verbosity 0 overhead: {:+.2f} us/URL ({:+.1f} %)".format(
+        (quiet_t - disabled_t) / count * 1e6,
+        (quiet_t - disabled_t) / disabled_t * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
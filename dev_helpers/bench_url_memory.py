@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Measures memory used per URL in the bulk opening path of xdg_open().
+
+Creates URL objects the way xdg_open() does for a large number of files,
+attaches desktop files to them and groups them with group_purls(). Memory is
+measured with tracemalloc and reported per URL for each phase.
+
+Usage: bench_url_memory.py [number of URLs]
+"""
+
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import wor.xdg_open as xo
+
+
+MIME_TYPES = ["text/plain", "image/png", "application/pdf", "audio/flac"]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as root:
+        desktop_files = []
+        for i, mime_type in enumerate(MIME_TYPES):
+            df_fn = os.path.join(root, "app{}.desktop".format(i))
+            with open(df_fn, "w") as f:
+                f.write("[Desktop Entry]\nType=Application\nName=App\n"
+                        "Exec=app{} %F\nMimeType={};\n".format(i, mime_type))
+            desktop_files.append(df_fn)
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+
+        purls = []
+        for i in range(count):
+            path = "/home/user/files/file{:07d}.ext".format(i)
+            # Mime type strings as they come from detection: new objects
+            mime_type = "".join(MIME_TYPES[i % len(MIME_TYPES)])
+            purl = xo.URL(path, protocol="file", target=path,
+                    mime_type=mime_type)
+            purl.desktop_file = xo.load_desktop_file(
+                    desktop_files[i % len(desktop_files)])
+            purls.append(purl)
+        urls_mem = tracemalloc.get_traced_memory()[0] - base
+
+        tracemalloc.reset_peak()
+        groups = 0
+        for group in xo.group_purls(purls):
+            groups += 1
+        group_peak = tracemalloc.get_traced_memory()[1] - base - urls_mem
+        tracemalloc.stop()
+
+    print("{} URLs in {} groups".format(count, groups))
+    print("URL objects:     {:7.1f} bytes/URL (incl. url and target strings)"
+            .format(urls_mem / count))
+    print("grouping peak:   {:7.1f} bytes/URL".format(group_peak / count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Simulates opening a batch of files of which some are on a hung mount.
+
+Replaces the filesystem layer of URL with one which adds latency to paths of
+a simulated slow mount and never returns for paths of a simulated hung mount.
+A batch of URLs is created with fs_deadline like xdg_open() does, and the
+time taken, filesystem timeouts and detected mime types are reported. Only
+the first file on the hung mount should wait for the deadline.
+
+Usage: sim_slow_fs.py [fs_deadline ms] [number of files per mount]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import wor.xdg_open as xo
+
+
+class SimulatedFileSystem(xo.FileSystem):
+    """FileSystem with a slow and a hung mount point."""
+    def __init__(self, slow_mount, hung_mount, latency):
+        self.slow_mount = slow_mount
+        self.hung_mount = hung_mount
+        self.latency = latency
+        self.hung = threading.Event()
+    def simulate(self, path):
+        if path.startswith(self.hung_mount + "/"):
+            self.hung.wait()
+        elif path.startswith(self.slow_mount + "/"):
+            time.sleep(self.latency)
+    def realpath(self, path):
+        self.simulate(path)
+        return super().realpath(path)
+    def exists(self, path):
+        self.simulate(path)
+        return super().exists(path)
+    def magic_file(self, path):
+        self.simulate(path)
+        return super().magic_file(path)
+    def mount_points(self):
+        # Devices of the simulated mounts are made up
+        return super().mount_points() + [
+                (self.slow_mount, os.makedev(4095, 1)),
+                (self.hung_mount, os.makedev(4095, 2))]
+
+
+def main():
+    fs_deadline = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as root:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        mounts = [ os.path.join(root, name) for name in
+                ("local", "slow", "hung") ]
+        paths = []
+        for mount in mounts:
+            os.mkdir(mount)
+            for i in range(count):
+                path = os.path.join(mount, "file{}.{}".format(i,
+                    ("txt", "pdf", "png")[i % 3]))
+                with open(path, "w") as f:
+                    f.write("simulated\n")
+                paths.append(path)
+        xo.CONFIG = xo.read_config_options(os.path.join(root, "none.conf"))
+        xo.CONFIG["fs_deadline"] = fs_deadline
+        xo.FS = SimulatedFileSystem(mounts[1], mounts[2], fs_deadline / 10000)
+
+        print("fs_deadline {} ms, {} files per mount".format(fs_deadline,
+            count))
+        for mount, mount_paths in zip(mounts,
+                (paths[i:i + count] for i in range(0, len(paths), count))):
+            start = time.perf_counter()
+            purls = [ xo.URL(path) for path in mount_paths ]
+            elapsed = time.perf_counter() - start
+            print("{:6s} {:8.1f} ms  timeouts {:3d}  mime types {}".format(
+                os.path.basename(mount), elapsed * 1000,
+                xo.STATS_COUNTERS.get("fs_timeouts", 0),
+                sorted(set(purl.mime_type for purl in purls))))
+        slow_mounts = [ mp for mp, _ in
+                xo.load_cache("slow_devices.pickle", {}).values() ]
+        print("remembered slow mounts: {}".format(
+            [ os.path.basename(mp) for mp in slow_mounts ]))
+    return 0 if slow_mounts == [mounts[2]] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Runs concurrent xdg_open(dryrun=True) processes against a cold cache.
+
+Simulates a file manager which starts a process for each selected file.
+Generates a synthetic tree of desktop files and a config using it, then
+starts all processes at once with an empty cache directory. Checks that every
+process succeeds with the same result, that the cache files are valid
+afterwards, and reports how many processes built the desktop file index.
+
+Usage: stress_cache.py [number of processes] [number of desktop files]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import wor.xdg_open as xo
+
+
+RUN_MAIN = "import sys, wor.xdg_open as xo; sys.exit(xo.main())"
+
+
+def create_tree(root, count):
+    """Creates `count` desktop files, app0.desktop handles text/plain."""
+    for i in range(count):
+        mime_type = "text/plain" if i == 0 \
+                else "application/x-app{}".format(i)
+        with open(os.path.join(root, "app{}.desktop".format(i)), "w") as f:
+            f.write("[Desktop Entry]\nType=Application\nName=App {0}\n"
+                    "Exec=app{0} %f\nMimeType={1};\n".format(i, mime_type))
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with tempfile.TemporaryDirectory() as root:
+        apps = os.path.join(root, "applications")
+        os.mkdir(apps)
+        create_tree(apps, count)
+        config_fn = os.path.join(root, "pyxdg-open.conf")
+        with open(config_fn, "w") as f:
+            f.write("desktop_file_paths = {}\n"
+                    "search_order = desktop_file_paths\n"
+                    "check_try_exec = false\n".format(apps))
+        target = os.path.join(root, "file.txt")
+        with open(target, "w") as f:
+            f.write("stress\n")
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(root, "cache"))
+
+        start = time.perf_counter()
+        procs = [ subprocess.Popen([sys.executable, "-c", RUN_MAIN,
+            "-c", config_fn, "-v", "1", "--dryrun", target], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+            for _ in range(processes) ]
+        results = [ p.communicate() + (p.returncode,) for p in procs ]
+        elapsed = time.perf_counter() - start
+
+        failed = [ r for r in results if r[2] != 0 ]
+        builds = sum(r[1].count("Building desktop file index.")
+                for r in results)
+        exec_strs = set(line for r in results for line in r[1].splitlines()
+                if "Calling exec string" in line)
+
+        os.environ["XDG_CACHE_HOME"] = env["XDG_CACHE_HOME"]
+        cache_dir = xo.get_cache_dir()
+        invalid = [ name for name in os.listdir(cache_dir)
+                if name.endswith(".pickle")
+                and xo.load_cache(name) is None ]
+
+    print("{} processes, {} desktop files: {:.2f} s".format(
+        processes, count, elapsed))
+    print("failed processes:  {}".format(len(failed)))
+    print("index builds:      {}".format(builds))
+    print("distinct results:  {}".format(len(exec_strs)))
+    print("invalid caches:    {}".format(invalid))
+    for r in failed[:3]:
+        print(r[1])
+    return 0 if not failed and not invalid and len(exec_strs) == 1 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,21 +23,40 @@ http://standards.freedesktop.org/desktop-entry-spec/latest/
 https://wiki.archlinux.org/index.php/Default_Applications
 """
 
+import array
+import bisect
+import concurrent.futures
 import configparser
-import locale
+import contextlib
+import fcntl
+import hashlib
+import http.client
+import itertools
+import json
 import logging
+import mmap
 import mimetypes as MT
 import os
 import os.path
+import pickle
+import queue
 import re
 import shlex
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import threading
+import time
 import urllib
+import urllib.parse
 import tempfile
 
 HAS_MAGIC = True
 MM = None
+# Thread local magic cookies, see magic_file()
+MAGIC_LOCAL = threading.local()
 try:
     import magic
 except ImportError:
@@ -45,10 +64,15 @@ except ImportError:
 
 import wor.desktop_file_parser.parser as df_parser
 
+from collections import deque
 from collections import namedtuple
 from collections import OrderedDict
 
 
+# Module logger for functions run for every URL, logging.getLogger() takes
+# the logging module lock on every call
+LOG = logging.getLogger(__name__)
+
 # Global config options (stored here after parsing)
 CONFIG = {}
 
@@ -62,6 +86,15 @@ DEFAULT_CONFIG = OrderedDict(sorted({
             "/usr/share/applications/, "
             "/usr/local/share/applications/",
         "default_terminal_emulator": "",
+        "http_probe": "false",
+        "http_probe_timeout": "0.5",
+        "http_probe_cache_ttl": "300",
+        "max_latency": "0",
+        "scan_workers": "0",
+        "check_try_exec": "true",
+        "coalesce_window": "0",
+        "fs_deadline": "0",
+        "stats_file": "",
         "search_order":
             "list_files, "
             "desktop_file_paths"
@@ -78,6 +111,8 @@ class URL(object):
         mime_type
         desktop_file
     """
+    # URLs are created in bulk, so they are kept compact
+    __slots__ = ("url", "protocol", "target", "mime_type", "desktop_file")
     def __init__(self, url, protocol="", target="", mime_type=""):
         """URL initialization.
 
@@ -89,15 +124,20 @@ class URL(object):
             mime_type: str. Optional mime type as string, if not given ...
         """
         self.url = url
+        deadline = get_fs_deadline()
         if not protocol or not target:
-            p, t = self.__get_protocol_and_target__()
+            p, t = self.__get_protocol_and_target__(deadline)
             self.protocol = p if not protocol else protocol
             self.target   = t if not target else target
         else:
             self.protocol = protocol
             self.target   = target
-        self.mime_type = self.__get_mimetype__() \
-                if not mime_type else mime_type
+        if self.protocol:
+            self.protocol = sys.intern(self.protocol)
+        if not mime_type:
+            mime_type = self.__get_mimetype__(deadline)
+        # Same mime types repeat, so share one string per mime type
+        self.mime_type = sys.intern(mime_type) if mime_type else mime_type
 
         self.desktop_file = None
     def __repr__(self):
@@ -107,19 +147,23 @@ class URL(object):
         """
         return "<{}|{}|{}|{}>".format(self.url, self.protocol, self.target,
                 self.mime_type)
-    def __get_protocol_and_target__(self):
+    def __get_protocol_and_target__(self, deadline=None):
         """Tries to guess ´self.url´ URLs protocol.
 
         Derefences symlinks when returning the target to local file url (path).
         In this case modifies self.url to match the target, this helps to
         determine the mime type later on.
 
+        Parameters:
+            deadline: float/None. See run_fs_op(). If filesystem doesn't
+                respond in time, symlinks are not dereferenced.
+
         Returns:
             (str, str). Tuple of protocol and rest of the url without protocol,
                 or if not found tuple of None.
         """
         if self.url.startswith("/"):
-            self.url = os.path.realpath(self.url)
+            self.url = fs_realpath(self.url, deadline)
             return "file", self.url
 
         # Magnet uri starts with 'magnet:?'
@@ -130,17 +174,23 @@ class URL(object):
             return protocol, target
         else:
             # Treat url as relative file
-            self.url = os.path.realpath(os.path.join(os.getcwd(), self.url))
+            self.url = fs_realpath(os.path.join(os.getcwd(), self.url),
+                    deadline)
             return "file", self.url
         return (None, None)
-    def __get_mimetype__(self):
+    def __get_mimetype__(self, deadline=None):
         """Tries to guess ´url´ URLs mime type.
 
+        Parameters:
+            deadline: float/None. See run_fs_op(). If filesystem doesn't
+                respond in time, mime type is guessed from the file extension
+                only.
+
         Returns:
             str/None. The mime type of the ´self.url´ URL. Or None if mime type
                 could not be determined.
         """
-        log = logging.getLogger(__name__)
+        log = LOG
         url = self.url
         if self.protocol == "file":
             # Strip away file protocol
@@ -148,29 +198,37 @@ class URL(object):
             # url = urllib.unquote(url).decode('utf-8') # for python2?
             url = urllib.parse.unquote(url)
 
-            # If file doesn't exist try to guess its mime type from its extension
-            # only.
-            if not os.path.exists(url):
+            # If file doesn't exist, or its filesystem doesn't respond, try to
+            # guess its mime type from its extension only.
+            try:
+                exists = run_fs_op(deadline, FS.exists, url)
+            except TimeoutError:
+                log.info("Filesystem of '%s' is not responding, guessing "
+                        "mime type from extension.", url)
+                exists = False
+            if not exists:
                 log.debug("Guessing non-existing files mimetype from its extension.")
-                file_ext = os.path.splitext(url)[1]
-                if len(file_ext) > 1:
-                    MT.init()
-                    try:
-                        mime_type = MT.types_map[file_ext]
-                    except KeyError:
-                        log.debug("mimetypes could not determine mimetype"
-                                " from extension: {}".format(file_ext))
-                        return None
-                else:
+                mime_type = get_mime_type_from_extension(url)
+                if not mime_type:
+                    log.debug("Could not determine mimetype from extension: "
+                            "%s", os.path.basename(url))
                     return None
             else:
-                log.info("Unescaped file url target: {}".format(url))
-                mime_type = MT.guess_type(url)[0]
-                if HAS_MAGIC: # Debug the differences between mimetypes and magic
-                    mime_type_mm = MM.file(url)
-                    if mime_type != mime_type_mm:
+                log.info("Unescaped file url target: %s", url)
+                mime_type = get_mime_type_from_extension(url)
+                if HAS_MAGIC and mime_type and latency_budget_spent():
+                    log.info("Latency budget spent, skipped magic probe.")
+                elif HAS_MAGIC: # Debug the differences between mimetypes and magic
+                    try:
+                        mime_type_mm = run_fs_op(deadline, FS.magic_file, url)
+                    except TimeoutError:
+                        log.info("Filesystem of '%s' is not responding, "
+                                "skipped magic probe.", url)
+                        mime_type_mm = None
+                    if mime_type != mime_type_mm \
+                            and log.isEnabledFor(logging.DEBUG):
                         log.debug("-------- mimetypes differed from magic --------")
-                        log.debug("{} != {}".format(mime_type, mime_type_mm))
+                        log.debug("%s != %s", mime_type, mime_type_mm)
                         log.debug("-----------------------------------------------")
                     if not mime_type and mime_type_mm:
                         log.debug("Preferring something over 'None'")
@@ -186,12 +244,18 @@ class URL(object):
         elif self.protocol == "magnet":
             mime_type = "application/x-bittorrent"
         else:
+            mime_type = None
+            # Ask the server as the URL path tells nothing reliable about the
+            # content, e.g. "...?filename=x.flac" can well be a HTML page.
+            if self.protocol in ("http", "https") and CONFIG.get("http_probe"):
+                mime_type = get_http_mimetype(self.url)
             # XXX: Is there still a better way to determine mime type for protocol?
-            mime_type = MT.guess_type(self.url)[0]
+            if not mime_type:
+                mime_type = MT.guess_type(self.url)[0]
             if not mime_type:
                 mime_type = "x-scheme-handler/" + self.protocol
-                log.info("Defaulted protocol '{}' to mime type: '{}'"
-                        .format(self.protocol, mime_type))
+                log.info("Defaulted protocol '%s' to mime type: '%s'",
+                        self.protocol, mime_type)
         return mime_type
 
     # Getters
@@ -203,11 +267,273 @@ class URL(object):
         return self.target
 
 
+def magic_file(path):
+    """Returns mime type of a file using magic.
+
+    A magic cookie can't be shared between threads so other than main thread
+    get their own cookies.
+
+    Parameters:
+        path: str. Path of an existing file.
+
+    Returns:
+        str/None. Mime type of the file.
+    """
+    global MM
+    try:
+        count_stat("mime_sniff_bytes",
+                min(os.path.getsize(path), MAGIC_BYTES_MAX))
+    except OSError:
+        pass
+    if threading.current_thread() is threading.main_thread():
+        if MM is None:
+            MM = magic.open(magic.MIME_TYPE)
+            MM.load()
+        return MM.file(path)
+    mm = getattr(MAGIC_LOCAL, "mm", None)
+    if mm is None:
+        mm = MAGIC_LOCAL.mm = magic.open(magic.MIME_TYPE)
+        mm.load()
+    return mm.file(path)
+
+
+class FileSystem(object):
+    """Filesystem operations done for URLs.
+
+    Replace FS with a subclass to simulate slow or hung filesystems.
+    """
+    def realpath(self, path):
+        return os.path.realpath(path)
+    def exists(self, path):
+        return os.path.exists(path)
+    def magic_file(self, path):
+        return magic_file(path)
+    def mount_points(self):
+        """Returns (mount point, device) pairs of /proc/self/mountinfo.
+
+        Device is the st_dev of files on the mount. It's read from the
+        major:minor field, so the mount is not accessed.
+        """
+        mount_points = []
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 5:
+                    continue
+                major, _, minor = fields[2].partition(":")
+                # Spaces and such are octal escaped, e.g. '\040'
+                mount_points.append((re.sub(r"\\([0-7]{3})",
+                    lambda m: chr(int(m.group(1), 8)), fields[4]),
+                    os.makedev(int(major), int(minor))))
+        return mount_points
+
+
+FS = FileSystem()
+
+# Thread local worker job queues, see run_with_deadline()
+DEADLINE_WORKERS = threading.local()
+
+# (mount point, device) pairs longest mount point first, see
+# get_mount_point()
+MOUNT_POINTS = None
+
+# Mounts which didn't respond in time: device -> (mount point, [time.time()
+# of a timeout]). Loaded from the cache directory on first use.
+SLOW_MOUNTS = None
+
+# Seconds a timeout of a mount is remembered
+SLOW_MOUNT_TTL = 600
+
+# Number of remembered timeouts after which the root filesystem is slow.
+# Paths on no other mount, e.g. on a not yet mounted automount, resolve to it
+# and a single timeout must not make every path extension only. Other mounts
+# are slow after one timeout.
+SLOW_ROOT_TIMEOUTS = 3
+
+
+def get_fs_deadline():
+    """Returns deadline for filesystem operations of an URL.
+
+    Returns:
+        float/None. time.monotonic() time, or None if config option
+            fs_deadline is off.
+    """
+    fs_deadline = CONFIG.get("fs_deadline", 0)
+    return time.monotonic() + fs_deadline / 1000 if fs_deadline > 0 else None
+
+
+def deadline_worker(jobs):
+    """Runs operations from a queue, see run_with_deadline()."""
+    while True:
+        func, args, result, done = jobs.get()
+        try:
+            result.append((True, func(*args)))
+        except BaseException as e:
+            result.append((False, e))
+        done.set()
+
+
+def run_with_deadline(deadline, func, *args):
+    """Runs a blocking operation with a deadline.
+
+    The operation is run on a daemon worker thread of the calling thread. If
+    the deadline passes, the worker is abandoned and a new one is started for
+    the next operation.
+
+    Parameters:
+        deadline: float. time.monotonic() time.
+        func: function(...). Operation to run.
+        args: Arguments of `func`.
+
+    Returns:
+        Return value of `func`.
+
+    Raises:
+        TimeoutError. If the deadline passed.
+        Exceptions of `func`.
+    """
+    jobs = getattr(DEADLINE_WORKERS, "jobs", None)
+    if jobs is None:
+        jobs = DEADLINE_WORKERS.jobs = queue.Queue()
+        threading.Thread(target=deadline_worker, args=(jobs,),
+                daemon=True).start()
+    result = []
+    done = threading.Event()
+    jobs.put((func, args, result, done))
+    if not done.wait(max(0, deadline - time.monotonic())):
+        DEADLINE_WORKERS.jobs = None
+        raise TimeoutError("Operation timed out")
+    ok, value = result[0]
+    if not ok:
+        raise value
+    return value
+
+
+def run_fs_op(deadline, func, *args):
+    """Runs a filesystem operation with a deadline.
+
+    The operation is run with run_with_deadline(), so that a hung filesystem
+    (e.g. NFS or sshfs) can't block. If the deadline passes, the mount point
+    of the path is remembered to be slow. Operations on a path of a slow
+    mount point time out immediately.
+
+    Parameters:
+        deadline: float/None. time.monotonic() time, see get_fs_deadline().
+            If None, `func` is called directly.
+        func: function(path, ...). Filesystem operation, see FileSystem.
+        args: Arguments of `func`, the first one is the path.
+
+    Returns:
+        Return value of `func`.
+
+    Raises:
+        TimeoutError. If the deadline passed or mount point is slow.
+        Exceptions of `func`.
+    """
+    if deadline is None:
+        return func(*args)
+    path = args[0]
+    if is_slow_mount(path):
+        raise TimeoutError("Slow mount point: {}".format(
+            get_mount_point(path)[0]))
+    try:
+        return run_with_deadline(deadline, func, *args)
+    except TimeoutError:
+        # Also ETIMEDOUT of `func` itself tells of a slow mount
+        count_stat("fs_timeouts")
+        add_slow_mount(path)
+        raise TimeoutError("Filesystem operation timed out: {}".format(path))
+
+
+def fs_realpath(path, deadline=None):
+    """Returns FS.realpath() of a path, or its absolute path if it timed out.
+    """
+    try:
+        return run_fs_op(deadline, FS.realpath, path)
+    except TimeoutError:
+        logging.getLogger(__name__).info("Filesystem of '%s' is not "
+                "responding, didn't resolve symlinks.", path)
+        return os.path.abspath(path)
+
+
+def get_mount_point(path):
+    """Returns mount point of a path from /proc/self/mountinfo.
+
+    The path is not accessed, so this is safe for paths on hung mounts.
+
+    Returns:
+        (str, int)/(None, None). Mount point and its device, None if mount
+            points could not be read.
+    """
+    global MOUNT_POINTS
+    if MOUNT_POINTS is None:
+        try:
+            # A later mount on the same mount point hides the earlier one
+            MOUNT_POINTS = sorted(dict(FS.mount_points()).items(),
+                    key=lambda t: len(t[0]), reverse=True)
+        except OSError:
+            MOUNT_POINTS = []
+    path = os.path.abspath(path)
+    for mount_point, dev in MOUNT_POINTS:
+        if path == mount_point or path.startswith(
+                mount_point.rstrip("/") + "/"):
+            return mount_point, dev
+    return None, None
+
+
+def is_slow_mount(path):
+    """Returns True if the path is on a mount remembered to be slow.
+
+    Mounts are remembered by their device, so a mount is slow however its
+    paths are reached, e.g. through bind mounts. The root filesystem needs
+    SLOW_ROOT_TIMEOUTS timeouts to be slow.
+    """
+    global SLOW_MOUNTS
+    if SLOW_MOUNTS is None:
+        SLOW_MOUNTS = load_cache("slow_devices.pickle", {})
+    if not SLOW_MOUNTS:
+        return False
+    mount_point, dev = get_mount_point(path)
+    now = time.time()
+    timeouts = [ t for t in SLOW_MOUNTS.get(dev, (None, ()))[1]
+            if now - t < SLOW_MOUNT_TTL ]
+    return len(timeouts) >= (SLOW_ROOT_TIMEOUTS if mount_point == "/"
+            else 1)
+
+
+def add_slow_mount(path):
+    """Remembers a timeout on the mount of a path, see is_slow_mount()."""
+    global SLOW_MOUNTS
+    mount_point, dev = get_mount_point(path)
+    if dev is None:
+        return
+    now = time.time()
+    def merge(stored):
+        slow_mounts = {}
+        for d, (mp, timeouts) in stored.items():
+            timeouts = [ t for t in timeouts if now - t < SLOW_MOUNT_TTL ]
+            if timeouts:
+                slow_mounts[d] = (mp, timeouts)
+        slow_mounts[dev] = (mount_point,
+                slow_mounts.get(dev, (None, []))[1] + [now])
+        return slow_mounts
+    stored = update_cache("slow_devices.pickle", merge, {})
+    if stored is None:
+        # Cache was locked, remember it only in this process
+        stored = merge(SLOW_MOUNTS or {})
+    SLOW_MOUNTS = stored
+    if is_slow_mount(path):
+        logging.getLogger(__name__).warn("Mount point '{}' is slow, using "
+                "only file extensions for files on it for {} seconds."
+                .format(mount_point, SLOW_MOUNT_TTL))
+
+
 def which(program):
     """Mimics *nix 'which' command.
 
     Finds given program from path if it's not absolute path. Else just checks
-    if it's executable.
+    if it's executable. Directories of PATH are looked up from the PATH
+    executable index, see get_path_dir_executables().
 
     This is quite trivial function is orginally from:
     http://stackoverflow.com/a/377028/538470
@@ -226,369 +552,3209 @@ def which(program):
         if is_exe(program):
             return program
     else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
+        for path in get_path_dirs():
+            if program not in get_path_dir_executables(path):
+                continue
+            # Permissions may have changed without directory mtime changing
             exe_file = os.path.join(path, program)
             if is_exe(exe_file):
                 return exe_file
     return None
 
 
-def desktop_list_parser(desktop_list_fn, mime_type_find=None, find_all=False):
-    """Parses desktop list file (defaults.list for example).
+def get_path_dirs():
+    """Returns directories of PATH environment variable."""
+    return [ path.strip('"') for path in
+            os.environ.get("PATH", os.defpath).split(os.pathsep) if path ]
 
-    If mime_type_find is given then return just first matching desktop file or
-    None if not found. If mime_type_find is not given or evaluates to False then
-    return all mime type desktop file pairs as a dict.
 
-    Parameters:
-        desktop_list_fn: str. Path of a desktop list file.
-        mime_type_find: str. Mime type to find from given desktop list file.
-        find_all: bool. If true returns a list of desktop files when
-            mime_type_find is also given.
-    Returns:
-        dict/[str]/None. See doc string.
-    """
-    mt_df_re = re.compile(
-            r"""
-            (^[^[]+)    # mimetype, line doesn't start with [
-            =
-            (.+)[;]?$   # desktop file, ignore possible ';' at the end
-            """, re.I|re.X)
-    mime_type_desktop_map = {}
-    desktop_files = []
-    with open(desktop_list_fn) as f:
-        for line in f:
-            m = mt_df_re.search(line)
-            if not m:
-                continue
-            mime_type = m.groups()[0]
-            single_mime_dfs = parse_comma_sep_list(m.groups()[1])
-            # Just get the desktop files matching the mime type given
-            if mime_type_find:
-                if mime_type == mime_type_find:
-                    if find_all:
-                        desktop_files += single_mime_dfs
-                    else:
-                        return single_mime_dfs
-                continue
-            # Or get everything..
-            else:
-                if mime_type in mime_type_desktop_map:
-                    mime_type_desktop_map[mime_type] += single_mime_dfs
-                else:
-                    mime_type_desktop_map[mime_type] = single_mime_dfs
+# PATH executable index: directory -> (mtime_ns, frozenset(executable names))
+PATH_INDEX = None
+PATH_INDEX_DIRTY = False
 
-    if find_all:
-        return desktop_files
-    return mime_type_desktop_map if mime_type_desktop_map else None
 
+def get_path_dir_executables(path):
+    """Returns names of executables in a directory.
 
-def get_df_full_path(desktop_file):
-    """Retuns full path of a desktop file.
+    Names are kept in the PATH executable index, which is stored in the cache
+    directory. A directory is read again when its modification time changes,
+    that is when files are added, removed or renamed in it.
+
+    Parameters:
+        path: str. Directory path.
+
+    Returns:
+        frozenset(str). Executable file names.
     """
-    # We cannot know where desktop file is found?
-    for dp in CONFIG["desktop_file_paths"]:
-        test_desktop_file = os.path.join(dp, desktop_file)
-        if os.path.isfile(test_desktop_file):
-            return test_desktop_file
-    return None
+    global PATH_INDEX, PATH_INDEX_DIRTY
+    if PATH_INDEX is None:
+        PATH_INDEX, PATH_INDEX_DIRTY = load_path_keyed_cache(
+                "path_index.pickle")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return frozenset()
+    cached = PATH_INDEX.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    names = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        names.append(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        return frozenset()
+    names = frozenset(names)
+    PATH_INDEX[path] = (mtime, names)
+    PATH_INDEX_DIRTY = True
+    return names
+
+
+def store_path_index():
+    """Writes PATH executable index to the cache directory if it changed."""
+    global PATH_INDEX_DIRTY
+    if not PATH_INDEX_DIRTY:
+        return
+    def merge(stored):
+        for path, cached in PATH_INDEX.items():
+            if path not in stored or stored[path][0] <= cached[0]:
+                stored[path] = cached
+        return stored
+    update_cache("path_index.pickle", merge, {})
+    PATH_INDEX_DIRTY = False
+
+
+def get_path_stamp():
+    """Returns a stamp which changes when executables in PATH can change."""
+    stamp = []
+    for path in get_path_dirs():
+        try:
+            stamp.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            pass
+    return tuple(stamp)
 
 
-def get_desktop_file_from_mime_list(mime_type, list_files, find_all=False):
-    """Find desktop file from a mime list file.
+def is_desktop_file_executable(desktop_file):
+    """Checks that the program of a desktop file is installed.
 
-    Desktop file paths and list files are read from global CONFIG.
+    If the desktop file has TryExec key, the file it names must be an
+    executable. Otherwise the program of the Exec key is checked. Desktop
+    files whose Exec can't be parsed are not rejected.
 
     Parameters:
-        mime_type: str. Mime type as string.
-        list_files: TODO:
-        find_all: TODO:
+        desktop_file: CachedDesktopFile/DesktopFile.
 
     Returns:
-        DesktopFile() or if find_all==True lists of DesktopFiles.
+        bool.
     """
-    def check_list_files():
-        """Gets desktop file(s) name from a list file.
-
-        Checks if list_files exist in the current desktop file path (dp) and if
-        it's so then tries to find matchin desktop file name for the mime_type.
-        If list files defines multiple desktop files in one entry, just takes
-        the first one existing if not ´find_all´ defined.
+    log = logging.getLogger(__name__)
+    program = desktop_file.get_entry_value_from_group("TryExec")
+    if not program:
+        exec_str = desktop_file.get_entry_value_from_group("Exec")
+        try:
+            argv = shlex.split(exec_str) if exec_str else []
+        except ValueError:
+            argv = []
+        if not argv:
+            return True
+        program = argv[0]
+    if which(program):
+        return True
+    log.info("Skipping desktop file '%s', its program '%s' is not installed.",
+            desktop_file.file_name, program)
+    return False
 
-        Uses:
-            dp, list_files, mime_type
 
-        Returns:
-            [str]. Desktop file names matching the mime_type.
-        """
-        for lf in list_files:
-            p = os.path.join(dp, lf)
-            if os.path.exists(p):
-                log.debug("Searching list file: {}".format(p))
-                df = desktop_list_parser(p, mime_type, find_all)
-                if df and df[0]:
-                    return df, p
-        return None, ""
-    log = logging.getLogger(__name__)
+def is_desktop_file_usable(desktop_file):
+    """Checks if a found desktop file can be used, see check_try_exec."""
+    return not CONFIG.get("check_try_exec") or \
+            is_desktop_file_executable(desktop_file)
 
-    # First parse desktop file lists, and try to find desktop file there
-    parsed_desktop_files = []
-    for dp in CONFIG["desktop_file_paths"]:
-        desktop_files, list_file = check_list_files()
-        if not desktop_files: continue
-        for desktop_file in desktop_files:
-            if desktop_file:
-                df_fp = get_df_full_path(desktop_file)
-                if not df_fp:
-                    log.info("Skipping not found (list) desktop file "
-                            "'{}', mentioned in '{}'".format(desktop_file, list_file))
-                    continue
-                log.info("Found desktop file from list: {}".format(list_file))
-                with open(df_fp) as df:
-                    parsed_df = df_parser.parse(df)
-                    if not find_all:
-                        return parsed_df
-                    parsed_desktop_files.append(parsed_df)
 
-    return parsed_desktop_files if parsed_desktop_files else None
+# Cache directory shared by all users. --build-cache writes it when run as
+# root, e.g. from a package manager hook, see build_cache() and
+# load_system_cache().
+SYSTEM_CACHE_DIR = "/var/cache/pyxdg-open"
 
+# Cache directory used instead of the user's one, see build_cache()
+CACHE_DIR = None
 
-def get_desktop_file_by_search(key_value_pair, find_all=False):
-    """Finds desktop file by searching from CONFIG["desktop_file_paths"].
 
-    Desktop file which contains given key value pair is returned. Desktop files
-    are returned as DesktopFile objects.
+def get_cache_dir():
+    """Returns the directory where pyxdg-open keeps its cache files.
 
-    Parameters:
-        key_value_pair: (str, str).
-        find_all: TODO:
+    Follows XDG Base Directory Specification, so by default the directory is
+    ~/.cache/pyxdg-open.
 
     Returns:
-        DesktopFile() or if find_all==True lists of DesktopFiles.
+        str. Cache directory path, it's not guaranteed to exist.
     """
-    log = logging.getLogger(__name__)
+    if CACHE_DIR:
+        return CACHE_DIR
+    cache_home = os.getenv("XDG_CACHE_HOME")
+    if not cache_home or not os.path.isabs(cache_home):
+        cache_home = os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "pyxdg-open")
 
-    # Next try to find correct desktop file by parsing invidual desktop files
-    log.debug("Find desktop file by search with key/value: {}".format(key_value_pair))
-    search_key   = key_value_pair[0]
-    search_value = key_value_pair[1]
-    desktop_files = []
-    for dp in CONFIG["desktop_file_paths"]:
-        for root, dirs, files in nrwalk(
-                dp, filefilter=lambda f,_: not f.endswith(".desktop")):
-            for f in files:
-                df_name = os.path.join(root, f)
-                log.debug("Parsing df: {}".format(df_name))
-                with open(df_name) as df_:
-                    try:
-                        df = df_parser.parse(df_)
-                    except SyntaxError as e:
-                        log.debug(str(e))
-                        log.error("Parsing desktop file '{}' failed!"
-                                .format(df_name))
-                        continue
-                mt_entry = df.get_entry_key_from_group(entry_key=search_key)
-                if mt_entry == None:
-                    continue
-                    #log.warn("Desktop file '{}' had no {} entry!"
-                    #    .format(df_name, search_key))
-                    #continue
-                if search_value in mt_entry.value:
-                    if not find_all:
-                        return df
-                    else:
-                        desktop_files.append(df)
 
-    if find_all and desktop_files:
-        return desktop_files
-    return None
+# Cache files start with a header of magic, format version and sha256 of the
+# pickled data which follows it
+CACHE_MAGIC = b"PYXDGOC\0"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("!8sH32s")
+# Seconds to wait for another process to rebuild a cache
+CACHE_LOCK_TIMEOUT = 5.0
 
 
-def get_desktop_file_by_custom_search(target, mime_type, file_name, find_all=False):
-    """Searches matching (pseudo) desktop file from given target.
+def load_cache(cache_name, default=None, cache_dir=None):
+    """Loads pickled cache file from the cache directory.
 
-    Target format is following:
-    [0]:
-        filename extension
-        type/subtype
-        type/
-        /subtype
-    [1]:
-        desktop file name
-        absolute path desktop file name
-        shell command
-        special command
+    Cache files with a wrong magic, format version or checksum are ignored.
 
-    Special commands:
-        !bashwrap <command>: wraps given <command> with bash. See:
-        http://wor.github.io/bash/2013/07/26/start-bash-and-terminal-program.html
+    Parameters:
+        cache_name: str. File name of the cache in the cache directory.
+        default: object. Returned if cache doesn't exist or can't be read.
+        cache_dir: str. Cache directory, defaults to get_cache_dir().
 
     Returns:
-        Existing DesktopFile or if find_all=True then list of dynamically
-        created DesktopFile objects
-        (wor.desktop_file_parser.parser.DesktopFile()).
+        object. Unpickled cache data or `default`.
+    """
+    log = logging.getLogger(__name__)
+    cache_fn = os.path.join(cache_dir or get_cache_dir(), cache_name)
+    try:
+        with open(cache_fn, "rb") as f:
+            data = f.read()
+        magic_, version, checksum = CACHE_HEADER.unpack_from(data)
+        if magic_ != CACHE_MAGIC:
+            raise ValueError("not a pyxdg-open cache file")
+        if version != CACHE_VERSION:
+            log.info("Ignoring cache file '{}' of format version {}.".format(
+                cache_fn, version))
+            return default
+        payload = memoryview(data)[CACHE_HEADER.size:]
+        if hashlib.sha256(payload).digest() != checksum:
+            raise ValueError("checksum mismatch")
+        return pickle.loads(payload)
+    except FileNotFoundError:
+        pass
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError, IndexError, TypeError, ValueError,
+            struct.error) as e:
+        log.warn("Ignoring unreadable cache file '{}': {}".format(cache_fn, e))
+    return default
+
+
+def load_system_cache(cache_name, load=load_cache):
+    """Loads a cache file from the system cache directory.
+
+    Caches there are built by root for all users, see build_cache(), so
+    they must be checked to be fresh like the user's own ones.
 
     Parameters:
-        target: [(str,str)]. List of key value pairs from custom search config.
-        mime_type: str. Mime type as a string.
-        file_name: str.
-        find_all: bool.
+        cache_name: str. File name of the cache.
+        load: function(cache_name, cache_dir=str) -> object/None. Reads the
+            cache, see load_or_build_cache().
+
+    Returns:
+        object/None. None if there's no such system cache, or it's the
+            cache directory in use.
     """
-    log = logging.getLogger(__name__)
+    if get_cache_dir() == SYSTEM_CACHE_DIR:
+        return None
+    return load(cache_name, cache_dir=SYSTEM_CACHE_DIR)
 
-    matches = []
-    for pattern, value in target:
-        # Filename extension matching
-        if pattern.find("/") == -1 and file_name.endswith("." + pattern):
-            matches.append(value)
-            if not find_all:
-                break
-        # Mimetype end matching
-        elif pattern.startswith("/") and mime_type.endswith(pattern):
-            matches.append(value)
-            if not find_all:
-                break
-        # Mimetype start matching
-        elif pattern.endswith("/") and mime_type.startswith(pattern):
-            matches.append(value)
-            if not find_all:
-                break
-        # Full mimetype matching
-        elif pattern == mime_type:
-            matches.append(value)
-            if not find_all:
-                break
 
-    # Now we have the match(es).
-    # Let's generate desktop files from them.
-    desktop_files = []
-    for match in matches:
-        # Check if a desktop file
-        if match.endswith(".desktop"):
-            # Allow absolute paths possibly outside defined desktop_file_dirs
-            if os.path.isabs(match):
-                if not os.path.exists(match):
-                    log.error("Desktop file '{}' from a config file mapping did not exist!".format(match))
-                    break
-                df = match
-            # Find from desktop_file_dirs
-            else:
-                df = get_df_full_path(match)
-                if not df:
-                    log.error("Failed to find desktop file '{}' from desktop "
-                              "file paths in config file mapping!".format(match))
-                    break
-            with open(df) as df_f:
-                parsed_df = df_parser.parse(df_f)
-                if not find_all:
-                    return parsed_df
-                desktop_files.append(parsed_df)
-        # Else treat as a exec string
-        else:
-            # Create new desktop file identified by given exec string (match).
-            # As desktop file name is used to determine their sameness when
-            # grouping them, this ensures that generated desktop files are
-            # grouped right.
-            parsed_df = df_parser.DesktopFile(file_name="Generated Desktop File: " + match)
-            field_check_re = re.compile(r'%[uf]', re.IGNORECASE)
-            default_field = "%F"
-            # Special !bashwrap command
-            # bash wrapped programs are expected to be run inside a terminal
-            if match.startswith("!bashwrap"):
-                cmd = match[len("!bashwrap") + 1:]
-                if not field_check_re.search(cmd):
-                    cmd += " " + default_field
-                # For now we create default desktop file entry, exec string is
-                # added later as is cmd expanded. This happens because we set
-                # bashwrap_cmd variable for the desktop file.
-                parsed_df.setup_with([("Terminal", True), ("Exec", "bashwrap placeholder")])
-                parsed_df.bashwrap_cmd = cmd
-            else:
-                if not field_check_re.search(match):
-                    exec_str = match + " " + default_field
-                parsed_df.setup_with([("Exec", exec_str)])
-            if not find_all:
-                return parsed_df
-            desktop_files.append(parsed_df)
+def load_path_keyed_cache(cache_name):
+    """Loads a cache of path -> (mtime_ns, ...) entries.
 
-    return desktop_files
+    If the system cache directory has the cache and it has been written after
+    the user's one, its entries of paths which are missing or older in the
+    user's cache are merged in. Each entry is still checked against its path
+    when used.
 
+    Parameters:
+        cache_name: str. File name of the cache.
 
-def get_desktop_file(key_value_pair, file_name, print_found=False):
-    """Finds desktop file by key value pair.
+    Returns:
+        (dict, bool). The cache, and True if the system cache was merged in,
+            in which case the cache should be stored.
+    """
+    data = load_cache(cache_name, {})
+    if get_cache_dir() == SYSTEM_CACHE_DIR:
+        return data, False
+    try:
+        system_mtime = os.stat(os.path.join(SYSTEM_CACHE_DIR,
+            cache_name)).st_mtime_ns
+    except OSError:
+        return data, False
+    try:
+        if os.stat(os.path.join(get_cache_dir(), cache_name)).st_mtime_ns \
+                > system_mtime:
+            return data, False
+    except OSError:
+        pass
+    for path, cached in load_cache(cache_name, {},
+            SYSTEM_CACHE_DIR).items():
+        if path not in data or data[path][0] < cached[0]:
+            data[path] = cached
+    return data, True
+
+
+def store_cache(cache_name, data):
+    """Pickles given data to a cache file in the cache directory.
+
+    The cache file is first written to a temporary file which is then renamed
+    over the old cache file, so readers never see a half written cache.
 
-    TODO: Memory cache values per run. Now can be run multiple times for same
-          type of key/value/file_name
-    TODO: Support cached desktop file format.
+    Parameters:
+        cache_name: str. File name of the cache in the cache directory.
+        data: object. Picklable data to be stored.
 
-    Finds desktop file which matches given key_value_pair. First from list files
-    and then by systematic desktop file search.
+    Returns:
+        bool. True if the cache was written.
+    """
+    payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION,
+            hashlib.sha256(payload).digest())
+    return write_cache_file(cache_name, (header, payload))
 
-    For example if given key_value_pair is ("Categories","TerminalEmulator"), then
-    a desktop file which contains "TerminalEmulator" value in "Categories" key is
-    returned.
 
-    The first desktop file found is returned.
+def write_cache_file(cache_name, chunks):
+    """Writes a cache file atomically, see store_cache().
 
     Parameters:
-        key_value_pair: (str, str).
-        file_name: str. File name to be opened. Some searches need this.
-        print_found: bool. Print found desktop files and don't stop when first
-            is found.
+        cache_name: str. File name of the cache in the cache directory.
+        chunks: [bytes]. Contents of the file.
+
+    Returns:
+        bool. True if the cache was written.
     """
     log = logging.getLogger(__name__)
-    def update_search_results(df, found_desktop_files):
-        assert(isinstance(df, list))
-        if df_temp:
-            if not print_found:
-                df.append(df_temp)
-                return True
-            else:
-                df += df_temp
-                for d in df_temp:
-                    found_desktop_files.append(d.file_name + " [" + search + "]" + os.linesep)
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_fn = tempfile.mkstemp(prefix="." + cache_name, dir=cache_dir)
+        try:
+            if cache_dir == SYSTEM_CACHE_DIR:
+                # Read by all users
+                os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_fn, os.path.join(cache_dir, cache_name))
+        except BaseException:
+            os.unlink(tmp_fn)
+            raise
+    except OSError as e:
+        log.warn("Could not write cache file '{}': {}".format(cache_name, e))
         return False
+    return True
 
-    df = []
-    found_desktop_files = [] # list of strings
-    # Do desktop file searchs in given order (config file)
-    for search in CONFIG["search_order"]:
-        if search == "list_files":
-            log.debug("Running list_files search.")
-            # If MimeType key then search first from MimeType/Desktop file list files.
-            # Configuration option list files must also be specified for this.
-            if key_value_pair[0] == "MimeType" and CONFIG["list_files"]:
-                df_temp = get_desktop_file_from_mime_list(
-                        key_value_pair[1],
-                        CONFIG["list_files"],
-                        find_all=print_found)
-                if update_search_results(df, found_desktop_files):
-                    break
-        elif search == "desktop_file_paths":
-            log.debug("Running desktop_file_paths search.")
-            df_temp = get_desktop_file_by_search(key_value_pair, find_all=print_found)
-            if update_search_results(df, found_desktop_files):
-                break
-        elif search in CONFIG["custom_searchs"].keys():
-            log.debug("Running custom config search ({}): {}".format(key_value_pair, search))
-            if key_value_pair[0] == "MimeType":
-                df_temp = get_desktop_file_by_custom_search(
-                        CONFIG["custom_searchs"][search],
-                        key_value_pair[1],
-                        file_name,
-                        find_all=print_found)
-                if update_search_results(df, found_desktop_files):
-                    break
 
-    if print_found:
-        print("Found desktop files:")
-        print("".join(found_desktop_files))
+@contextlib.contextmanager
+def cache_lock(cache_name, timeout=None):
+    """Context manager holding an advisory lock of a cache file.
+
+    The lock is a flock() on "<cache_name>.lock" in the cache directory, see
+    file_lock().
 
-    return df[0] if df else None
+    Parameters:
+        cache_name: str. File name of the cache in the cache directory.
+        timeout: float/None. Seconds to wait for the lock, None waits
+            forever.
+
+    Yields:
+        bool. See file_lock().
+    """
+    log = logging.getLogger(__name__)
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        log.warn("Could not create cache directory: {}".format(e))
+        yield False
+        return
+    with file_lock(os.path.join(cache_dir, cache_name + ".lock"),
+            timeout) as locked:
+        yield locked
+
+
+@contextlib.contextmanager
+def file_lock(lock_fn, timeout=None):
+    """Context manager holding an advisory flock() on a lock file.
+
+    The lock is released automatically also if the process dies.
+
+    Parameters:
+        lock_fn: str. Path of the lock file, created if missing.
+        timeout: float/None. Seconds to wait for the lock, None waits
+            forever.
+
+    Yields:
+        bool. True if the lock was acquired, False if waiting timed out or
+            lock file could not be opened.
+    """
+    log = logging.getLogger(__name__)
+    try:
+        fd = os.open(lock_fn, os.O_RDONLY | os.O_CREAT, 0o644)
+    except OSError as e:
+        log.warn("Could not open lock file '{}': {}".format(lock_fn, e))
+        yield False
+        return
+    try:
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        yield False
+                        return
+                    time.sleep(0.005)
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def get_cache_lock_timeout():
+    """Returns seconds to wait for a cache lock within the latency budget."""
+    budget_left = latency_budget_left()
+    if budget_left is None:
+        return CACHE_LOCK_TIMEOUT
+    return max(0, min(CACHE_LOCK_TIMEOUT, budget_left))
+
+
+def load_or_build_cache(cache_name, is_fresh, build, fallback=None,
+        load=load_cache, store=store_cache):
+    """Loads cache data, or builds and stores it if cache is not fresh.
+
+    If the cache is not fresh, a fresh one from the system cache directory
+    is used, see load_system_cache(). Only one process builds a cache at a
+    time. Others wait for the lock and then use the data it stored. If
+    waiting times out, `fallback` is called instead.
+
+    Parameters:
+        cache_name: str. File name of the cache in the cache directory.
+        is_fresh: function(data) -> bool. Checks if cached data is usable.
+        build: function() -> object. Builds the data.
+        fallback: function() -> object. Defaults to `build`, in which case
+            the built data is not stored.
+        load: function(cache_name, cache_dir=None) -> object/None. Reads
+            the cache.
+        store: function(cache_name, data). Writes the cache.
+
+    Returns:
+        object. Cached, built or fallback data.
+    """
+    log = logging.getLogger(__name__)
+    data = load(cache_name)
+    if data is not None and is_fresh(data):
+        return data
+    # Copied from the system cache, so that the next run reads only one
+    data = load_system_cache(cache_name, load)
+    if data is not None and is_fresh(data):
+        store(cache_name, data)
+        return data
+    with cache_lock(cache_name, get_cache_lock_timeout()) as locked:
+        if locked:
+            # Another process may have built it while we waited
+            data = load(cache_name)
+            if data is not None and is_fresh(data):
+                return data
+            data = build()
+            store(cache_name, data)
+            return data
+    log.info("Timed out waiting for cache '{}'.".format(cache_name))
+    return (fallback or build)()
+
+
+def update_cache(cache_name, merge, default=None):
+    """Merges data to a cache file under the cache lock.
+
+    Cache is read again under the lock so that concurrent updates from other
+    processes are not lost. If lock can't be acquired in time the update is
+    dropped.
+
+    Parameters:
+        cache_name: str. File name of the cache in the cache directory.
+        merge: function(data) -> object. Returns data to store given the
+            currently stored data, or `default` if there is none.
+        default: object. See above.
+
+    Returns:
+        object/None. Stored data or None if nothing was stored.
+    """
+    log = logging.getLogger(__name__)
+    with cache_lock(cache_name, get_cache_lock_timeout()) as locked:
+        if not locked:
+            log.info("Cache '{}' is locked, dropped update.".format(
+                cache_name))
+            return None
+        data = merge(load_cache(cache_name, default))
+        store_cache(cache_name, data)
+        return data
+
+
+class HTTPConnectionPool(object):
+    """Pool of keep-alive HTTP(S) connections.
+
+    Connections are pooled per (scheme, host:port) pair, so probing multiple
+    URLs from the same server needs only one TCP (and TLS) handshake.
+    """
+    def __init__(self, max_per_host=2):
+        """HTTPConnectionPool initialization.
+
+        Parameters:
+            max_per_host: int. Maximum number of idle connections kept per
+                host.
+        """
+        self.max_per_host = max_per_host
+        self.idle = {}
+    def get(self, scheme, netloc, timeout, new=False):
+        """Returns an idle connection to the host or a new one.
+
+        Parameters:
+            new: bool. Don't reuse an idle connection.
+
+        Returns:
+            (http.client.HTTPConnection, bool). Connection and True if the
+                connection was reused from the pool.
+        """
+        conns = self.idle.get((scheme, netloc))
+        if conns and not new:
+            conn = conns.pop()
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=timeout)
+        return conn, False
+    def put(self, scheme, netloc, conn):
+        """Returns a connection back to the pool for reuse."""
+        conns = self.idle.setdefault((scheme, netloc), [])
+        if len(conns) < self.max_per_host:
+            conns.append(conn)
+        else:
+            conn.close()
+    def close(self):
+        """Closes all idle connections."""
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle = {}
+
+
+HTTP_POOL = HTTPConnectionPool()
+
+# Cache of probed mime types: url -> (expiration time, mime type). Loaded from
+# the cache directory on first use.
+HTTP_PROBE_CACHE = None
+
+# Whether HTTP_PROBE_CACHE has entries not written to the cache directory
+HTTP_PROBE_CACHE_DIRTY = False
+
+
+def send_http_request(conn, method, path, headers):
+    """Sends a request and returns the response.
+
+    Body of a HEAD response is read, so that the connection can be reused.
+
+    Returns:
+        http.client.HTTPResponse.
+    """
+    conn.request(method, path, headers=headers)
+    resp = conn.getresponse()
+    if method == "HEAD":
+        resp.read()
+    return resp
+
+
+def abort_http_connection(conn):
+    """Closes a connection possibly in use by an abandoned worker thread.
+
+    Shutting the socket down first wakes up a worker blocked in reading it.
+    """
+    sock = conn.sock
+    if sock:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    conn.close()
+
+
+def probe_http_mimetype(url, timeout):
+    """Asks mime type of an http(s) URL from the server.
+
+    First a HEAD request is sent, if server doesn't allow it or doesn't give
+    Content-Type then a GET request for the first byte is sent. Redirections
+    are followed. Whole probe including redirections must complete in
+    `timeout` seconds. Requests are sent with run_with_deadline(), so neither
+    name resolution nor a server trickling its response can exceed it.
+
+    Parameters:
+        url: str. http or https URL.
+        timeout: float. Latency budget in seconds.
+
+    Returns:
+        str/None. Mime type from the Content-Type header or None if it could
+            not be determined in time.
+    """
+    log = logging.getLogger(__name__)
+    deadline = time.monotonic() + timeout
+    max_redirects = 5
+    for _ in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https") or not parts.netloc:
+            return None
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        redirect = None
+        for method, headers in (("HEAD", {}), ("GET", {"Range": "bytes=0-0"})):
+            # One retry with a new connection is allowed if a pooled
+            # connection was closed by the server while idle.
+            for retry in range(2):
+                resp = None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.info("HTTP probe of '%s' ran out of time.", url)
+                    return None
+                conn, reused = HTTP_POOL.get(scheme, parts.netloc, remaining,
+                        new=bool(retry))
+                try:
+                    resp = run_with_deadline(deadline, send_http_request,
+                            conn, method, path, headers)
+                except TimeoutError:
+                    abort_http_connection(conn)
+                    log.info("HTTP probe of '%s' ran out of time.", url)
+                    return None
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    if reused:
+                        continue
+                    log.info("HTTP probe of '%s' failed: %s", url, e)
+                    return None
+                break
+            if resp is None:
+                log.info("HTTP probe of '%s' failed.", url)
+                return None
+            # Don't read possibly large GET body just to keep the connection
+            if method == "HEAD" and not resp.will_close:
+                HTTP_POOL.put(scheme, parts.netloc, conn)
+            else:
+                conn.close()
+            log.debug("HTTP probe %s '%s': %s %s", method, url, resp.status,
+                    resp.getheader("Content-Type"))
+            location = resp.getheader("Location")
+            if 300 <= resp.status < 400 and location:
+                redirect = urllib.parse.urljoin(url, location)
+                break
+            content_type = resp.getheader("Content-Type")
+            if resp.status < 400 and content_type:
+                return content_type.partition(";")[0].strip().lower()
+            # Some servers don't implement HEAD properly, try GET then
+            if method == "HEAD" and (resp.status < 400 or
+                    resp.status in (403, 405, 501)):
+                continue
+            return None
+        if not redirect:
+            return None
+        url = redirect
+    log.info("HTTP probe of '%s' had too many redirections.", url)
+    return None
+
+
+def get_http_mimetype(url):
+    """Returns mime type of an http(s) URL using HTTP probe cache.
+
+    Probes the URL with probe_http_mimetype() if cache doesn't have an
+    unexpired mime type for it. New results are written to the cache
+    directory at exit by store_http_probe_cache().
+
+    Parameters:
+        url: str. http or https URL.
+
+    Returns:
+        str/None. Mime type or None if it could not be determined.
+    """
+    global HTTP_PROBE_CACHE, HTTP_PROBE_CACHE_DIRTY
+    log = logging.getLogger(__name__)
+    if HTTP_PROBE_CACHE is None:
+        HTTP_PROBE_CACHE = load_cache("http_probe.pickle", {})
+    now = time.time()
+    cached = HTTP_PROBE_CACHE.get(url)
+    if cached and cached[0] > now:
+        log.info("Using cached HTTP probe result for '%s'.", url)
+        return cached[1]
+
+    timeout = CONFIG.get("http_probe_timeout", 0.5)
+    budget_left = latency_budget_left()
+    if budget_left is not None:
+        if budget_left <= 0:
+            log.info("Latency budget spent, skipped HTTP probe.")
+            return None
+        timeout = min(timeout, budget_left)
+    mime_type = probe_http_mimetype(url, timeout)
+    if mime_type:
+        ttl = CONFIG.get("http_probe_cache_ttl", 300)
+        HTTP_PROBE_CACHE[url] = (now + ttl, mime_type)
+        HTTP_PROBE_CACHE_DIRTY = True
+    return mime_type
+
+
+def store_http_probe_cache():
+    """Writes HTTP probe cache to the cache directory if it has changed.
+
+    Expired entries are dropped.
+    """
+    global HTTP_PROBE_CACHE_DIRTY
+    if not HTTP_PROBE_CACHE_DIRTY:
+        return
+    now = time.time()
+    def merge(stored):
+        # Entries stored meanwhile by other processes are kept, the one
+        # expiring later wins
+        for url, cached in HTTP_PROBE_CACHE.items():
+            if url not in stored or stored[url][0] <= cached[0]:
+                stored[url] = cached
+        return { u: c for u, c in stored.items() if c[0] > now }
+    update_cache("http_probe.pickle", merge, {})
+    HTTP_PROBE_CACHE_DIRTY = False
+
+
+# Desktop Entry keys with list and boolean values, other keys are strings
+DESKTOP_ENTRY_LIST_KEYS = frozenset(("MimeType", "Categories", "Keywords",
+    "OnlyShowIn", "NotShowIn", "Actions", "Implements"))
+DESKTOP_ENTRY_BOOL_KEYS = frozenset(("Terminal", "NoDisplay", "Hidden",
+    "StartupNotify", "DBusActivatable", "PrefersNonDefaultGPU",
+    "SingleMainWindow"))
+
+DesktopEntryKey = namedtuple("DesktopEntryKey", ["key", "value"])
+
+
+class CachedDesktopFile(object):
+    """Desktop file loaded through the desktop file cache.
+
+    Provides the parts of wor.desktop_file_parser.parser.DesktopFile interface
+    which pyxdg-open uses. Only untranslated keys of the [Desktop Entry] group
+    are loaded eagerly, other groups and localized keys are read by parsing
+    the whole desktop file with df_parser when first needed.
+
+    Attributes:
+        file_name
+        entry: dict. Untranslated [Desktop Entry] keys to their values.
+        bashwrap_cmd
+    """
+    __slots__ = ("file_name", "entry", "bashwrap_cmd", "parsed")
+    def __init__(self, file_name, entry):
+        """CachedDesktopFile initialization.
+
+        Parameters:
+            file_name: str. Path of the desktop file.
+            entry: dict. See read_desktop_entry().
+        """
+        self.file_name = sys.intern(file_name)
+        self.entry = entry
+        self.bashwrap_cmd = None
+        self.parsed = None
+    def __repr__(self):
+        return "<CachedDesktopFile|{}>".format(self.file_name)
+    def get_parsed(self):
+        """Returns fully parsed desktop file, parsing it on first call."""
+        if self.parsed is None:
+            with open(self.file_name) as df:
+                self.parsed = df_parser.parse(df)
+        return self.parsed
+    def is_eager(self, group_name, entry_key):
+        return group_name == "Desktop Entry" and entry_key.find("[") == -1
+    def get_entry_value_from_group(self, entry_key, group_name="Desktop Entry"):
+        if self.is_eager(group_name, entry_key):
+            return self.entry.get(entry_key)
+        return self.get_parsed().get_entry_value_from_group(
+                entry_key, group_name=group_name)
+    def get_entry_key_from_group(self, group_name="Desktop Entry",
+            entry_key=None):
+        if self.is_eager(group_name, entry_key):
+            value = self.entry.get(entry_key)
+            return DesktopEntryKey(entry_key, value) if value != None else None
+        return self.get_parsed().get_entry_key_from_group(
+                group_name=group_name, entry_key=entry_key)
+    def get_localized_value(self, entry_key):
+        """Returns value of a key in LOCALIZED_KEYS in the current locale.
+
+        Localized values are resolved when the desktop file is read, see
+        read_desktop_entry().
+        """
+        value = self.entry[LOCALIZED_ENTRY_KEY][1].get(entry_key)
+        return value if value is not None else self.entry.get(entry_key)
+
+
+def unescape_desktop_entry_value(value, in_list=False):
+    """Unescapes a desktop entry value.
+
+    Escape sequences are \\s, \\n, \\t, \\r and \\\\, and in lists also \\;.
+    Other backslashes are kept as they are.
+
+    Parameters:
+        value: str. Raw value or list item.
+        in_list: bool. True if value is an item of a list value.
+    """
+    if value.find("\\") == -1:
+        return value
+    escapes = {"s": " ", "n": "\n", "t": "\t", "r": "\r", "\\": "\\"}
+    if in_list:
+        escapes[";"] = ";"
+    return re.sub(r"\\(.)", lambda m: escapes.get(m.group(1), m.group(0)),
+            value)
+
+
+# Desktop Entry keys whose localized values are resolved when reading
+LOCALIZED_KEYS = frozenset(("Name", "GenericName", "Comment"))
+# Key of (locale keys, {key: localized value}) in entries read with
+# read_desktop_entry(), it's not a valid desktop entry key
+LOCALIZED_ENTRY_KEY = ".localized"
+# Memoized result of get_locale_keys()
+LOCALE_KEYS = None
+
+
+def get_locale_keys():
+    """Returns locale suffixes of localized keys in the order of preference.
+
+    The locale is the one of messages, from LC_ALL, LC_MESSAGES or LANG
+    environment variables. Order follows Desktop Entry Specification: for
+    lang_COUNTRY.ENCODING@MODIFIER it's lang_COUNTRY@MODIFIER, lang_COUNTRY,
+    lang@MODIFIER and lang.
+
+    Returns:
+        (str). Empty for C and POSIX locales.
+    """
+    global LOCALE_KEYS
+    if LOCALE_KEYS is not None:
+        return LOCALE_KEYS
+    value = None
+    for var in ("LC_ALL", "LC_MESSAGES", "LANG"):
+        value = os.getenv(var)
+        if value:
+            break
+    m = re.match(r"([^_.@]+)(?:_([^.@]+))?(?:\.[^@]*)?(?:@(.+))?$",
+            value or "")
+    if not m or m.group(1) in ("C", "POSIX"):
+        LOCALE_KEYS = ()
+        return LOCALE_KEYS
+    lang, country, modifier = m.groups()
+    keys = []
+    if country and modifier:
+        keys.append("{}_{}@{}".format(lang, country, modifier))
+    if country:
+        keys.append("{}_{}".format(lang, country))
+    if modifier:
+        keys.append("{}@{}".format(lang, modifier))
+    keys.append(lang)
+    LOCALE_KEYS = tuple(keys)
+    return LOCALE_KEYS
+
+
+def read_desktop_entry(desktop_fn):
+    """Reads untranslated keys of desktop files [Desktop Entry] group.
+
+    Reading stops at the next group header, as [Desktop Entry] must be the
+    first group in a desktop file. Keys in LOCALIZED_KEYS are also resolved
+    in the current locale, see get_locale_keys(), and stored under
+    LOCALIZED_ENTRY_KEY with the locale keys used.
+
+    Parameters:
+        desktop_fn: str. Path of a desktop file.
+
+    Returns:
+        dict. Key to value, values of list keys are lists of strings and of
+            boolean keys bools.
+
+    Raises:
+        SyntaxError. If an invalid line is found.
+    """
+    locale_keys = get_locale_keys()
+    locale_ranks = { k: rank for rank, k in enumerate(locale_keys) }
+    localized = {} # key -> (rank, value)
+    entry = {}
+    in_entry = False
+    with open(desktop_fn, encoding="utf-8", errors="replace") as f:
+        for line_nro, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line[0] == "#":
+                continue
+            if line[0] == "[":
+                if in_entry:
+                    break
+                in_entry = line == "[Desktop Entry]"
+                continue
+            key, sep, value = line.partition("=")
+            if not sep:
+                raise SyntaxError("Invalid line {} in desktop file '{}'"
+                        .format(line_nro, desktop_fn))
+            key = key.strip()
+            if not in_entry:
+                continue
+            if key.find("[") != -1:
+                key, _, loc = key[:-1].partition("[")
+                rank = locale_ranks.get(loc)
+                if key in LOCALIZED_KEYS and rank is not None and \
+                        rank < localized.get(key, (len(locale_keys),))[0]:
+                    localized[key] = (rank,
+                            unescape_desktop_entry_value(value.strip()))
+                continue
+            value = value.strip()
+            if key in DESKTOP_ENTRY_LIST_KEYS:
+                value = [ unescape_desktop_entry_value(v, in_list=True)
+                        for v in re.split(r"(?<!\\);", value) if v ]
+            elif key in DESKTOP_ENTRY_BOOL_KEYS:
+                value = value == "true"
+            else:
+                value = unescape_desktop_entry_value(value)
+            entry[sys.intern(key)] = value
+    entry[LOCALIZED_ENTRY_KEY] = (locale_keys,
+            { k: v for k, (_, v) in localized.items() })
+    return entry
+
+
+# Desktop file cache: path -> (mtime_ns, size, entry), see load_desktop_file().
+# Loaded from the cache directory on first use.
+DESKTOP_FILE_CACHE = None
+DESKTOP_FILE_CACHE_DIRTY = False
+# Loaded desktop files by path, URLs with the same desktop file share it
+LOADED_DESKTOP_FILES = {}
+
+
+def desktop_file_may_contain(desktop_fn, key_value_pair):
+    """Checks quickly from raw bytes if desktop file can contain key value pair.
+
+    The desktop file is read as bytes and searched for a line with the key
+    and the value after it. False positives are possible as the line can be
+    in another group than [Desktop Entry], or the value only a part of
+    another value, but if False is returned the pair surely isn't there.
+
+    Parameters:
+        desktop_fn: str. Path of a desktop file.
+        key_value_pair: (str, str).
+
+    Returns:
+        bool.
+    """
+    prefilter_re = PREFILTER_RES.get(key_value_pair)
+    if prefilter_re is None:
+        key, value = key_value_pair
+        # Values which may have escape sequences can't be found from raw bytes
+        if re.search(r"[\s\\;]", value):
+            prefilter_re = PREFILTER_RES[key_value_pair] = False
+        else:
+            prefilter_re = PREFILTER_RES[key_value_pair] = re.compile(
+                    b"^[ \t]*" + re.escape(key.encode("utf-8")) +
+                    b"[ \t]*=[^\n]*" + re.escape(value.encode("utf-8")),
+                    re.M)
+    if prefilter_re is False:
+        return True
+    with open(desktop_fn, "rb") as f:
+        return prefilter_re.search(f.read()) is not None
+
+
+# Compiled desktop_file_may_contain() regexes per key value pair
+PREFILTER_RES = {}
+
+
+def is_desktop_file_cached(cached, st):
+    """Checks if desktop file cache entry is up to date.
+
+    Parameters:
+        cached: tuple/None. Desktop file cache value.
+        st: os.stat_result. Stat of the desktop file.
+
+    Returns:
+        bool. True if desktop file hasn't changed and its localized keys are
+            of the current locale.
+    """
+    return bool(cached) and cached[0] == st.st_mtime_ns and \
+            cached[1] == st.st_size and \
+            cached[2].get(LOCALIZED_ENTRY_KEY, (None,))[0] == \
+                get_locale_keys()
+
+
+def load_desktop_file(desktop_fn, prefilter=None):
+    """Loads a desktop file through the desktop file cache.
+
+    The [Desktop Entry] group is read from the cache if the desktop files
+    modification time and size match the cached ones. Otherwise it's read
+    from the desktop file and stored to the cache.
+
+    Parameters:
+        desktop_fn: str. Path of a desktop file.
+        prefilter: (str, str). Optional key value pair. If given and the
+            desktop file is not in the cache, it's read only if
+            desktop_file_may_contain() passes for the pair.
+
+    Returns:
+        CachedDesktopFile/None. None if prefilter didn't pass.
+
+    Raises:
+        OSError. If desktop file could not be read.
+        SyntaxError. If desktop file could not be parsed.
+    """
+    global DESKTOP_FILE_CACHE, DESKTOP_FILE_CACHE_DIRTY
+    if DESKTOP_FILE_CACHE is None:
+        DESKTOP_FILE_CACHE, DESKTOP_FILE_CACHE_DIRTY = \
+                load_path_keyed_cache("desktop_files.pickle")
+    st = os.stat(desktop_fn)
+    cached = DESKTOP_FILE_CACHE.get(desktop_fn)
+    if is_desktop_file_cached(cached, st):
+        df = LOADED_DESKTOP_FILES.get(desktop_fn)
+        if df is None or df.entry is not cached[2]:
+            df = LOADED_DESKTOP_FILES[desktop_fn] = \
+                    CachedDesktopFile(desktop_fn, cached[2])
+        return df
+
+    if prefilter and not desktop_file_may_contain(desktop_fn, prefilter):
+        return None
+    logging.getLogger(__name__).debug("Parsing df: %s", desktop_fn)
+    count_stat("desktop_files_parsed")
+    entry = read_desktop_entry(desktop_fn)
+    DESKTOP_FILE_CACHE[desktop_fn] = (st.st_mtime_ns, st.st_size, entry)
+    DESKTOP_FILE_CACHE_DIRTY = True
+    df = LOADED_DESKTOP_FILES[desktop_fn] = CachedDesktopFile(desktop_fn, entry)
+    return df
+
+
+def read_desktop_entry_with_stat(desktop_fn, prefilter=None):
+    """Reads desktop file for the desktop file cache in a worker process.
+
+    Parameters:
+        desktop_fn: str. Path of a desktop file.
+        prefilter: (str, str). Optional key value pair, see
+            load_desktop_file().
+
+    Returns:
+        (int, int, dict)/str/None. Modification time, size and entry as in
+            desktop file cache, error message if reading failed, or None if
+            prefilter didn't pass.
+    """
+    try:
+        st = os.stat(desktop_fn)
+        if prefilter and not desktop_file_may_contain(desktop_fn, prefilter):
+            return None
+        return st.st_mtime_ns, st.st_size, read_desktop_entry(desktop_fn)
+    except (OSError, SyntaxError) as e:
+        return str(e)
+
+
+# Less desktop files than this are not worth of starting a process pool
+PRELOAD_MIN_FILES = 256
+
+
+def get_scan_workers():
+    """Returns number of processes for parsing desktop files, see
+    scan_workers config option."""
+    return CONFIG.get("scan_workers") or os.cpu_count() or 1
+
+
+def preload_desktop_files(desktop_fns, prefilter=None):
+    """Reads desktop files missing from the desktop file cache in parallel.
+
+    The desktop files which are not in the desktop file cache, or have
+    changed, are parsed in a process pool and added to the cache in the
+    given order. Failing desktop files are left for load_desktop_file() to
+    report. Nothing is done if there are only a few desktop files to parse
+    or only one worker, load_desktop_file() parses them when needed.
+
+    Parameters:
+        desktop_fns: [str]. Paths of desktop files.
+        prefilter: (str, str). Optional key value pair, see
+            load_desktop_file().
+
+    Returns:
+        set(str). Paths of desktop files which didn't pass prefilter.
+    """
+    global DESKTOP_FILE_CACHE, DESKTOP_FILE_CACHE_DIRTY
+    log = logging.getLogger(__name__)
+    if DESKTOP_FILE_CACHE is None:
+        DESKTOP_FILE_CACHE, DESKTOP_FILE_CACHE_DIRTY = \
+                load_path_keyed_cache("desktop_files.pickle")
+    workers = get_scan_workers()
+    if workers <= 1:
+        return set()
+    cold = []
+    for desktop_fn in desktop_fns:
+        try:
+            st = os.stat(desktop_fn)
+        except OSError:
+            continue
+        if not is_desktop_file_cached(DESKTOP_FILE_CACHE.get(desktop_fn), st):
+            cold.append(desktop_fn)
+    if len(cold) < PRELOAD_MIN_FILES:
+        return set()
+
+    log.info("Parsing %s desktop files in %s processes.", len(cold), workers)
+    filtered = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as ex:
+        results = ex.map(read_desktop_entry_with_stat, cold,
+                itertools.repeat(prefilter),
+                chunksize=max(1, len(cold) // (workers * 4)))
+        for desktop_fn, result in zip(cold, results):
+            if result is None:
+                filtered.add(desktop_fn)
+                continue
+            if isinstance(result, str):
+                continue
+            count_stat("desktop_files_parsed")
+            mtime, size, entry = result
+            entry = { sys.intern(k): v for k, v in entry.items() }
+            DESKTOP_FILE_CACHE[desktop_fn] = (mtime, size, entry)
+            DESKTOP_FILE_CACHE_DIRTY = True
+    return filtered
+
+
+def store_desktop_file_cache():
+    """Writes desktop file cache to the cache directory if it has changed.
+
+    Entries of removed desktop files are dropped.
+    """
+    global DESKTOP_FILE_CACHE_DIRTY
+    if not DESKTOP_FILE_CACHE_DIRTY:
+        return
+    def merge(stored):
+        # Entries stored meanwhile by other processes are kept, the one of a
+        # newer desktop file wins
+        for desktop_fn, cached in DESKTOP_FILE_CACHE.items():
+            if desktop_fn not in stored or stored[desktop_fn][0] <= cached[0]:
+                stored[desktop_fn] = cached
+        for desktop_fn in [ df for df in stored if not os.path.exists(df) ]:
+            del stored[desktop_fn]
+        return stored
+    update_cache("desktop_files.pickle", merge, {})
+    DESKTOP_FILE_CACHE_DIRTY = False
+
+
+# Monotonic time when the latency budget ends or None if there's no budget,
+# see start_latency_budget()
+LATENCY_DEADLINE = None
+
+
+def start_latency_budget():
+    """Starts latency budget of CONFIG["max_latency"] milliseconds.
+
+    Under latency budget, expensive desktop file searches and mime type
+    probes are skipped once the budget is spent. Zero means no budget.
+    """
+    global LATENCY_DEADLINE
+    max_latency = CONFIG.get("max_latency", 0)
+    LATENCY_DEADLINE = time.monotonic() + max_latency / 1000 \
+            if max_latency > 0 else None
+
+
+def latency_budget_left():
+    """Returns seconds left of the latency budget.
+
+    Returns:
+        float/None. Seconds left, negative if overspent, or None if there's
+            no latency budget.
+    """
+    if LATENCY_DEADLINE is None:
+        return None
+    return LATENCY_DEADLINE - time.monotonic()
+
+
+def latency_budget_spent():
+    """Returns True if there's a latency budget and it's spent."""
+    left = latency_budget_left()
+    return left is not None and left <= 0
+
+
+# Resolver metrics of this process, see count_stat() and observe_stat()
+STATS_COUNTERS = {}
+STATS_HISTOGRAMS = OrderedDict()
+STATS_LOCK = threading.Lock()
+
+# Counters and their descriptions in the order they are reported
+STATS_COUNTER_HELP = OrderedDict([
+    ("invocations", "Runs of pyxdg-open."),
+    ("urls", "URLs opened or resolved."),
+    ("list_file_hits", "Desktop files found from list files."),
+    ("custom_search_hits", "Desktop files found by custom searchs."),
+    ("desktop_file_path_hits",
+        "Desktop files found from desktop file paths."),
+    ("full_scans",
+        "Desktop file path searches which scanned all desktop files."),
+    ("negative_cache_hits", "Searches skipped by the negative cache."),
+    ("mru_hits", "Searches skipped by the most recently used results."),
+    ("index_builds", "Desktop file index builds."),
+    ("desktop_files_parsed",
+        "Desktop files parsed instead of read from the desktop file cache."),
+    ("mime_sniff_bytes",
+        "Bytes of files read by magic mime type detection (estimate)."),
+    ("spawns", "Programs started."),
+    ("forkserver_spawns", "Programs started by forkserver."),
+    ("fs_timeouts", "Filesystem operations which passed fs_deadline."),
+    ])
+
+# Upper bounds of the latency histogram buckets in seconds
+STATS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0)
+
+# Prefix of the reported metric names
+STATS_PREFIX = "pyxdg_open_"
+
+# libmagic reads at most this many bytes of a file (its default bytes_max)
+MAGIC_BYTES_MAX = 1024 * 1024
+
+
+def count_stat(name, n=1):
+    """Increments a counter of STATS_COUNTER_HELP."""
+    with STATS_LOCK:
+        STATS_COUNTERS[name] = STATS_COUNTERS.get(name, 0) + n
+
+
+def observe_stat(stage, seconds):
+    """Adds latency of a stage to its histogram.
+
+    Parameters:
+        stage: str. Name of the stage, e.g. a search of the search order.
+        seconds: float.
+    """
+    with STATS_LOCK:
+        histogram = STATS_HISTOGRAMS.get(stage)
+        if histogram is None:
+            # Counts of each bucket and +Inf bucket, and sum of latencies
+            histogram = STATS_HISTOGRAMS[stage] = \
+                    [0] * (len(STATS_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(STATS_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+
+@contextlib.contextmanager
+def timed_stat(stage):
+    """Context manager which adds its running time to a stage histogram."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stat(stage, time.monotonic() - start)
+
+
+def get_stats_samples():
+    """Returns metrics of this process as Prometheus samples.
+
+    Returns:
+        OrderedDict. Series, e.g. 'pyxdg_open_spawns_total' or
+            'pyxdg_open_stage_seconds_count{stage="list_files"}', to its
+            value.
+    """
+    samples = OrderedDict()
+    for name in STATS_COUNTER_HELP:
+        samples[STATS_PREFIX + name + "_total"] = STATS_COUNTERS.get(name, 0)
+    for stage, histogram in STATS_HISTOGRAMS.items():
+        labels = 'stage="{}"'.format(stage.replace("\\", "\\\\")
+                .replace('"', '\\"').replace("\n", "\\n"))
+        count = 0
+        for bound, n in zip(STATS_BUCKETS + (float("inf"),), histogram):
+            count += n
+            samples['{}stage_seconds_bucket{{{},le="{}"}}'.format(
+                STATS_PREFIX, labels,
+                repr(bound) if bound != float("inf") else "+Inf")] = count
+        samples["{}stage_seconds_sum{{{}}}".format(STATS_PREFIX, labels)] = \
+                histogram[-1]
+        samples["{}stage_seconds_count{{{}}}".format(STATS_PREFIX, labels)] = \
+                count
+    return samples
+
+
+def format_stats(samples):
+    """Formats samples of get_stats_samples() in Prometheus text format."""
+    lines = []
+    histogram_prefix = STATS_PREFIX + "stage_seconds"
+    histogram_header = True
+    for series, value in samples.items():
+        if series.startswith(histogram_prefix):
+            if histogram_header:
+                lines.append("# HELP {} Latency of resolver stages.".format(
+                    histogram_prefix))
+                lines.append("# TYPE {} histogram".format(histogram_prefix))
+                histogram_header = False
+        elif series.startswith(STATS_PREFIX) and series.endswith("_total"):
+            name = series[len(STATS_PREFIX):-len("_total")]
+            lines.append("# HELP {} {}".format(series,
+                STATS_COUNTER_HELP.get(name, "")))
+            lines.append("# TYPE {} counter".format(series))
+        lines.append("{} {}".format(series,
+            int(value) if value == int(value) else repr(value)))
+    return "\n".join(lines) + "\n"
+
+
+def parse_stats(text):
+    """Parses samples from Prometheus text format, see format_stats().
+
+    Returns:
+        OrderedDict. Series to its value.
+    """
+    samples = OrderedDict()
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, _, value = line.rpartition(" ")
+        try:
+            samples[series] = float(value)
+        except ValueError:
+            continue
+    return samples
+
+
+def write_stats_file(stats_fn):
+    """Adds metrics of this process to a Prometheus textfile.
+
+    The file is meant for node_exporter textfile collector, so it's shared
+    by all runs and users. It's read, merged with this process's metrics and
+    replaced atomically under the lock "<stats_fn>.lock", so concurrent runs
+    don't lose counts and a partially written file is never collected. If the
+    lock can't be acquired in time, metrics of this process are dropped.
+
+    Parameters:
+        stats_fn: str. Path of the textfile, e.g.
+            "/var/lib/node_exporter/textfile/pyxdg-open.prom".
+
+    Returns:
+        bool. True if the metrics were written.
+    """
+    log = logging.getLogger(__name__)
+    stats_fn = os.path.expanduser(stats_fn)
+    samples = get_stats_samples()
+    histogram_prefix = STATS_PREFIX + "stage_seconds"
+    with file_lock(stats_fn + ".lock", get_cache_lock_timeout()) as locked:
+        if not locked:
+            log.info("Stats file '{}' is locked, dropped stats.".format(
+                stats_fn))
+            return False
+        try:
+            with open(stats_fn) as f:
+                stored = parse_stats(f.read())
+        except FileNotFoundError:
+            stored = {}
+        except (OSError, UnicodeDecodeError) as e:
+            log.warn("Could not read stats file '{}': {}".format(stats_fn, e))
+            return False
+        for series, value in stored.items():
+            if series in samples:
+                samples[series] += value
+            elif series.startswith(histogram_prefix):
+                samples[series] = value
+        stats_dir, stats_name = os.path.split(stats_fn)
+        try:
+            fd, tmp_fn = tempfile.mkstemp(prefix="." + stats_name,
+                    dir=stats_dir or ".")
+            try:
+                os.fchmod(fd, 0o644)
+                with os.fdopen(fd, "w") as f:
+                    f.write(format_stats(samples))
+                os.replace(tmp_fn, stats_fn)
+            except BaseException:
+                os.unlink(tmp_fn)
+                raise
+        except OSError as e:
+            log.warn("Could not write stats file '{}': {}".format(stats_fn, e))
+            return False
+    return True
+
+
+def desktop_list_parser(desktop_list_fn, mime_type_find=None, find_all=False):
+    """Parses desktop list file (defaults.list for example).
+
+    If mime_type_find is given then return just first matching desktop file or
+    None if not found. If mime_type_find is not given or evaluates to False then
+    return all mime type desktop file pairs as a dict.
+
+    Parameters:
+        desktop_list_fn: str. Path of a desktop list file.
+        mime_type_find: str. Mime type to find from given desktop list file.
+        find_all: bool. If true returns a list of desktop files when
+            mime_type_find is also given.
+    Returns:
+        dict/[str]/None. See doc string.
+    """
+    mt_df_re = re.compile(
+            r"""
+            (^[^[]+)    # mimetype, line doesn't start with [
+            =
+            (.+)[;]?$   # desktop file, ignore possible ';' at the end
+            """, re.I|re.X)
+    mime_type_desktop_map = {}
+    desktop_files = []
+    with open(desktop_list_fn) as f:
+        for line in f:
+            m = mt_df_re.search(line)
+            if not m:
+                continue
+            mime_type = m.groups()[0].strip()
+            # Desktop files are separated by ';' in the spec, but accept also
+            # comma separated lists
+            single_mime_dfs = [ df for df in
+                    parse_comma_sep_list(m.groups()[1].replace(";", ","))
+                    if df ]
+            # Just get the desktop files matching the mime type given
+            if mime_type_find:
+                if mime_type == mime_type_find:
+                    if find_all:
+                        desktop_files += single_mime_dfs
+                    else:
+                        return single_mime_dfs
+                continue
+            # Or get everything..
+            else:
+                if mime_type in mime_type_desktop_map:
+                    mime_type_desktop_map[mime_type] += single_mime_dfs
+                else:
+                    mime_type_desktop_map[mime_type] = single_mime_dfs
+
+    if find_all:
+        return desktop_files
+    return mime_type_desktop_map if mime_type_desktop_map else None
+
+
+def get_df_full_path(desktop_file):
+    """Retuns full path of a desktop file.
+
+    Parameters:
+        desktop_file: str. Desktop file ID or path relative to desktop file
+            paths.
+    """
+    # Under latency budget don't build the index just for this
+    index = get_desktop_file_index(build=latency_budget_left() is None)
+    df_fp = index.get("ids", desktop_file) if index else None
+    if df_fp:
+        return df_fp
+    # We cannot know where desktop file is found?
+    for dp in CONFIG["desktop_file_paths"]:
+        test_desktop_file = os.path.join(dp, desktop_file)
+        if os.path.isfile(test_desktop_file):
+            return test_desktop_file
+    return None
+
+
+def get_desktop_file_from_mime_list(mime_type, list_files, find_all=False):
+    """Find desktop file from a mime list file.
+
+    Desktop files are looked up from the list file index, which has
+    desktop files of list files in desktop file paths in the order of
+    preference, see build_desktop_file_index(). Desktop files which are not
+    found are skipped.
+
+    Parameters:
+        mime_type: str. Mime type as string.
+        list_files: [str]. List file names, only desktop files from these
+            are returned.
+        find_all: bool. If True return all found desktop files.
+
+    Returns:
+        DesktopFile() or if find_all==True lists of DesktopFiles.
+    """
+    log = logging.getLogger(__name__)
+
+    # Under latency budget parse list files directly if the index is not
+    # built yet
+    index = get_desktop_file_index(build=latency_budget_left() is None)
+    if index:
+        list_entries = index.get_pairs("lists", mime_type)
+    else:
+        list_entries = []
+        for dp in CONFIG["desktop_file_paths"]:
+            for lf in list_files:
+                p = os.path.join(dp, lf)
+                if os.path.exists(p):
+                    log.debug("Searching list file: %s", p)
+                    list_entries += [ (df, p) for df in
+                            desktop_list_parser(p, mime_type, find_all=True) ]
+
+    parsed_desktop_files = []
+    for desktop_file, list_file in list_entries:
+        if os.path.basename(list_file) not in list_files:
+            continue
+        df_fp = get_df_full_path(desktop_file)
+        if not df_fp:
+            log.info("Skipping not found (list) desktop file "
+                    "'%s', mentioned in '%s'", desktop_file, list_file)
+            continue
+        log.info("Found desktop file from list: %s", list_file)
+        try:
+            parsed_df = load_desktop_file(df_fp)
+        except (OSError, SyntaxError) as e:
+            log.error("Parsing desktop file '%s' failed: %s", df_fp, e)
+            continue
+        if not is_desktop_file_usable(parsed_df):
+            continue
+        if not find_all:
+            return parsed_df
+        parsed_desktop_files.append(parsed_df)
+
+    return parsed_desktop_files if parsed_desktop_files else None
+
+
+def get_desktop_file_by_search(key_value_pair, find_all=False):
+    """Finds desktop file by searching from CONFIG["desktop_file_paths"].
+
+    Desktop file which contains given key value pair is returned. Desktop files
+    are returned as DesktopFile objects.
+
+    Parameters:
+        key_value_pair: (str, str).
+        find_all: TODO:
+
+    Returns:
+        DesktopFile() or if find_all==True lists of DesktopFiles.
+    """
+    log = logging.getLogger(__name__)
+
+    # Next try to find correct desktop file by parsing invidual desktop files
+    log.debug("Find desktop file by search with key/value: %s", key_value_pair)
+    search_key   = key_value_pair[0]
+    search_value = key_value_pair[1]
+    desktop_files = []
+
+    # Indexed keys need no scanning. The index is of the current index
+    # generation, but desktop files edited in place don't change it. They
+    # are loaded as they are now, so their value is checked again, and if
+    # one no longer has it, the index is refreshed once as other desktop
+    # files may have been edited too. The index is not built when latency
+    # budget is spent, the scan reads less.
+    build = not latency_budget_spent()
+    index = get_desktop_file_index(build=build) \
+            if search_key in INDEXED_KEYS else None
+    refreshed = False
+    while index:
+        stale = None
+        for df_name in index.lookup(search_key, search_value):
+            try:
+                df = load_desktop_file(df_name)
+            except (OSError, SyntaxError) as e:
+                log.error("Parsing desktop file '%s' failed: %s",
+                        df_name, e)
+                continue
+            if search_value not in (df.entry.get(search_key) or ()):
+                stale = df_name
+                continue
+            if not is_desktop_file_usable(df):
+                continue
+            if not find_all:
+                return df
+            desktop_files.append(df)
+        if stale and build and not refreshed and not desktop_files:
+            log.info("Desktop file '%s' has changed after indexing, "
+                    "refreshing index.", stale)
+            index = get_desktop_file_index(refresh=True)
+            refreshed = True
+            continue
+        return desktop_files if find_all and desktop_files else None
+
+    return scan_desktop_files(key_value_pair, find_all=find_all)
+
+
+def scan_desktop_files(key_value_pair, find_all=False):
+    """Finds desktop file by scanning all desktop files.
+
+    Used when the key is not indexed or the desktop file index is not
+    available. Desktop files which are not in the desktop file cache are
+    prefiltered by their raw bytes, see desktop_file_may_contain().
+
+    Parameters:
+        key_value_pair: (str, str).
+        find_all: bool. Find all matching desktop files.
+
+    Returns:
+        DesktopFile() or if find_all==True lists of DesktopFiles.
+    """
+    log = logging.getLogger(__name__)
+    search_key, search_value = key_value_pair
+    desktop_files = []
+
+    count_stat("full_scans")
+    df_names = []
+    for dp in CONFIG["desktop_file_paths"]:
+        for root, dirs, files in nrwalk(
+                dp, filefilter=lambda f,_: not f.endswith(".desktop")):
+            df_names += [ os.path.join(root, f) for f in files ]
+    # Desktop files are parsed in parallel if many of them are not cached,
+    # but still checked in desktop file path order
+    filtered = preload_desktop_files(df_names, prefilter=key_value_pair)
+    for df_name in df_names:
+        if df_name in filtered:
+            continue
+        try:
+            df = load_desktop_file(df_name, prefilter=key_value_pair)
+        except (OSError, SyntaxError) as e:
+            log.debug("%s", e)
+            log.error("Parsing desktop file '%s' failed!", df_name)
+            continue
+        if not df:
+            continue
+        mt_entry = df.get_entry_key_from_group(entry_key=search_key)
+        if mt_entry == None:
+            continue
+            #log.warn("Desktop file '{}' had no {} entry!"
+            #    .format(df_name, search_key))
+            #continue
+        if search_value in mt_entry.value:
+            if not is_desktop_file_usable(df):
+                continue
+            if not find_all:
+                return df
+            else:
+                desktop_files.append(df)
+
+    if find_all and desktop_files:
+        return desktop_files
+    return None
+
+
+def get_generated_desktop_file(match):
+    """Returns desktop file generated from a custom search exec string.
+
+    Generated desktop files are identified by the exec string, so one desktop
+    file object is created per exec string and shared between URLs.
+
+    Parameters:
+        match: str. Exec string or special command from custom search config.
+
+    Returns:
+        wor.desktop_file_parser.parser.DesktopFile.
+    """
+    parsed_df = GENERATED_DESKTOP_FILES.get(match)
+    if parsed_df:
+        return parsed_df
+    # Create new desktop file identified by given exec string (match).
+    # As desktop file name is used to determine their sameness when
+    # grouping them, this ensures that generated desktop files are
+    # grouped right.
+    parsed_df = df_parser.DesktopFile(file_name=sys.intern(
+        "Generated Desktop File: " + match))
+    has_file_field = lambda cmd: \
+            not get_exec_template(cmd).codes.isdisjoint("fFuU")
+    default_field = "%F"
+    # Special !bashwrap command
+    # bash wrapped programs are expected to be run inside a terminal
+    if match.startswith("!bashwrap"):
+        cmd = match[len("!bashwrap") + 1:]
+        if not has_file_field(cmd):
+            cmd += " " + default_field
+        # For now we create default desktop file entry, exec string is
+        # added later as is cmd expanded. This happens because we set
+        # bashwrap_cmd variable for the desktop file.
+        parsed_df.setup_with([("Terminal", True), ("Exec", "bashwrap placeholder")])
+        parsed_df.bashwrap_cmd = cmd
+    else:
+        exec_str = match
+        if not has_file_field(match):
+            exec_str += " " + default_field
+        parsed_df.setup_with([("Exec", exec_str)])
+    GENERATED_DESKTOP_FILES[match] = parsed_df
+    return parsed_df
+
+
+# Generated desktop files by their exec strings, see
+# get_generated_desktop_file()
+GENERATED_DESKTOP_FILES = {}
+
+
+def match_custom_search_pattern(pattern, mime_type, file_name):
+    """Checks if a custom search pattern matches mime type or file name.
+
+    Parameters:
+        pattern: str. Filename extension, "type/subtype", "type/" or
+            "/subtype".
+        mime_type: str.
+        file_name: str.
+
+    Returns:
+        bool.
+    """
+    # Filename extension matching
+    if pattern.find("/") == -1:
+        return file_name.endswith("." + pattern)
+    # Mimetype end matching
+    elif pattern.startswith("/"):
+        return mime_type.endswith(pattern)
+    # Mimetype start matching
+    elif pattern.endswith("/"):
+        return mime_type.startswith(pattern)
+    # Full mimetype matching
+    return pattern == mime_type
+
+
+def get_desktop_file_by_custom_search(target, mime_type, file_name, find_all=False):
+    """Searches matching (pseudo) desktop file from given target.
+
+    Target format is following:
+    [0]:
+        filename extension
+        type/subtype
+        type/
+        /subtype
+    [1]:
+        desktop file name
+        absolute path desktop file name
+        shell command
+        special command
+
+    Special commands:
+        !bashwrap <command>: wraps given <command> with bash. See:
+        http://wor.github.io/bash/2013/07/26/start-bash-and-terminal-program.html
+
+    Returns:
+        Existing DesktopFile or if find_all=True then list of dynamically
+        created DesktopFile objects
+        (wor.desktop_file_parser.parser.DesktopFile()).
+
+    Parameters:
+        target: [(str,str)]. List of key value pairs from custom search config.
+        mime_type: str. Mime type as a string.
+        file_name: str.
+        find_all: bool.
+    """
+    log = logging.getLogger(__name__)
+
+    matches = []
+    for pattern, value in target:
+        if match_custom_search_pattern(pattern, mime_type, file_name):
+            matches.append(value)
+            if not find_all:
+                break
+
+    # Now we have the match(es).
+    # Let's generate desktop files from them.
+    desktop_files = []
+    for match in matches:
+        # Check if a desktop file
+        if match.endswith(".desktop"):
+            # Allow absolute paths possibly outside defined desktop_file_dirs
+            if os.path.isabs(match):
+                if not os.path.exists(match):
+                    log.error("Desktop file '%s' from a config file mapping did not exist!", match)
+                    break
+                df = match
+            # Find from desktop_file_dirs
+            else:
+                df = get_df_full_path(match)
+                if not df:
+                    log.error("Failed to find desktop file '%s' from desktop "
+                              "file paths in config file mapping!", match)
+                    break
+            parsed_df = load_desktop_file(df)
+            if not find_all:
+                return parsed_df
+            desktop_files.append(parsed_df)
+        # Else treat as a exec string
+        else:
+            parsed_df = get_generated_desktop_file(match)
+            if not find_all:
+                return parsed_df
+            desktop_files.append(parsed_df)
+
+    return desktop_files
+
+
+# Memoized result of get_index_generation()
+INDEX_GENERATION = None
+
+# Memoized result of get_search_generation()
+SEARCH_GENERATION = None
+
+# Negative search result cache, see get_negative_cache_key(). Loaded from the
+# cache directory on first use.
+NEGATIVE_CACHE = None
+
+# Most recently used search results, see get_mru_desktop_file(). Loaded from
+# the cache directory on first use.
+MRU = None
+
+# Number of search results kept in MRU
+MRU_SIZE = 64
+
+
+def get_index_generation():
+    """Returns a stamp which changes whenever desktop file search results can.
+
+    The stamp is computed from the config options affecting the searches and
+    from (mtime, size, inode) of the desktop file directories (with
+    subdirectories) and list files. Desktop files are added, removed and
+    updated (package managers rename files in place) so directory
+    modification times change with them. Desktop files themselves are not
+    stat'ed, so the stamp costs the same however many desktop files there
+    are. A desktop file edited in place is noticed when it's loaded, see
+    load_desktop_file() and get_desktop_file_by_search().
+
+    The stamp is computed once per run.
+
+    Returns:
+        str. Index generation stamp.
+    """
+    global INDEX_GENERATION
+    if INDEX_GENERATION is not None:
+        return INDEX_GENERATION
+
+    h = hashlib.sha1(repr((
+        CONFIG["desktop_file_paths"],
+        CONFIG["list_files"],
+        CONFIG["search_order"],
+        sorted(CONFIG["custom_searchs"].items()),
+        )).encode("utf-8", "surrogateescape"))
+    def update(path):
+        try:
+            st = os.stat(path)
+            stamp = "{}:{}:{}".format(st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            stamp = "-"
+        h.update("{}\0{}\0".format(path, stamp)
+                .encode("utf-8", "surrogateescape"))
+
+    for dp in CONFIG["desktop_file_paths"]:
+        for lf in CONFIG["list_files"]:
+            update(os.path.join(dp, lf))
+        dir_stack = [dp]
+        while dir_stack:
+            d = dir_stack.pop()
+            update(d)
+            try:
+                # Directory entry types come with the listing, so only
+                # directories are stat'ed
+                with os.scandir(d) as entries:
+                    dir_stack.extend(sorted(e.path for e in entries
+                        if e.is_dir()))
+            except OSError:
+                pass
+
+    INDEX_GENERATION = h.hexdigest()
+    return INDEX_GENERATION
+
+
+# Desktop Entry keys which have their values indexed
+INDEXED_KEYS = ("MimeType", "Categories")
+
+# Desktop file index of the current index generation, see
+# get_desktop_file_index()
+DESKTOP_FILE_INDEX = None
+# True if waiting for another process to build the index timed out
+DESKTOP_FILE_INDEX_BUSY = False
+
+
+def build_desktop_file_index(manifest=None):
+    """Builds desktop file index from desktop files and list files.
+
+    Index has the following mappings, in which values are in desktop file
+    path search order:
+
+        "ids": desktop file ID -> path of the preferred desktop file
+        "MimeType": mime type -> [desktop file path]
+        "Categories": category -> [desktop file path]
+        "lists": mime type -> [(desktop file ID, list file path)]
+
+    The index is built incrementally from a manifest of the previous build.
+    Only directories whose modification time has changed are listed again.
+    Desktop files are edited in place without changing their directory, so
+    every listed desktop file is stat'ed and only new ones and those whose
+    (mtime, size, inode) has changed are loaded. Indexed values of the other
+    desktop files come from the manifest. So a refresh stats all desktop
+    files but parses only the changed ones. Refreshes are rare, as the
+    index generation stats only directories, see get_index_generation().
+    Desktop files are loaded through the desktop file cache, and missing
+    ones are parsed in a process pool, see preload_desktop_files(). List
+    files are always read.
+
+    Parameters:
+        manifest: dict. Manifest of the previous build, see
+            load_index_manifest(). It's updated in place. If None, index is
+            built from scratch.
+
+    Returns:
+        dict. The index with its "generation".
+    """
+    log = logging.getLogger(__name__)
+    log.info("Building desktop file index.")
+    count_stat("index_builds")
+    if manifest is None:
+        manifest = new_index_manifest()
+    index = {
+            "generation": get_index_generation(),
+            "ids": {},
+            "lists": {},
+            }
+    for key in INDEXED_KEYS:
+        index[key] = {}
+
+    # Directories: path -> (mtime_ns, [subdirectory], [desktop file name])
+    old_dirs, dirs = manifest["dirs"], {}
+    changed_dirs = set()
+    def listdir(root):
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except OSError:
+            return [], []
+        cached = old_dirs.get(root)
+        if not cached or cached[0] != mtime:
+            subdirs, names = [], []
+            try:
+                with os.scandir(root) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.name.endswith(".desktop"):
+                            names.append(entry.name)
+            except OSError:
+                pass
+            cached = (mtime, sorted(subdirs), sorted(names))
+            changed_dirs.add(root)
+        dirs[root] = cached
+        return list(cached[1]), list(cached[2])
+
+    # Desktop file ID is its path relative to desktop file path with '/'
+    # replaced by '-'
+    df_names = [] # [(desktop file ID, desktop file name)]
+    for dp in CONFIG["desktop_file_paths"]:
+        for root, _, files in nrwalk(dp, listdir=listdir):
+            prefix = os.path.relpath(root, dp).replace(os.sep, "-") + "-"
+            if prefix == os.curdir + "-":
+                prefix = ""
+            df_names += [ (prefix + f, os.path.join(root, f)) for f in files ]
+
+    # Desktop files: path -> (mtime_ns, size, ino, {indexed key: [value]})
+    old_files, files = manifest["files"], {}
+    load = []
+    for _, df_name in df_names:
+        if df_name in files:
+            continue
+        cached = old_files.get(df_name)
+        try:
+            st = os.stat(df_name)
+        except OSError:
+            continue
+        if cached and cached[:3] == (st.st_mtime_ns, st.st_size, st.st_ino):
+            files[df_name] = cached
+        else:
+            load.append((df_name, st))
+    preload_desktop_files([ df_name for df_name, _ in load ])
+    for df_name, st in load:
+        try:
+            df = load_desktop_file(df_name)
+        except (OSError, SyntaxError) as e:
+            log.debug("%s", e)
+            log.error("Parsing desktop file '%s' failed!", df_name)
+            continue
+        files[df_name] = (st.st_mtime_ns, st.st_size, st.st_ino,
+                { key: df.entry[key] for key in INDEXED_KEYS
+                    if key in df.entry })
+    log.info("Index refresh: %s of %s directories listed, %s of %s desktop "
+            "files loaded, %s removed.", len(changed_dirs), len(dirs),
+            len(load), len(files), len(set(old_files) - set(files)))
+    manifest["dirs"], manifest["files"] = dirs, files
+
+    for df_id, df_name in df_names:
+        if df_name not in files:
+            continue
+        index["ids"].setdefault(df_id, df_name)
+        for key, values in files[df_name][3].items():
+            for value in values:
+                index[key].setdefault(value, []).append(df_name)
+
+    for dp in CONFIG["desktop_file_paths"]:
+        for lf in CONFIG["list_files"]:
+            p = os.path.join(dp, lf)
+            if not os.path.exists(p):
+                continue
+            for mime_type, desktop_files in \
+                    (desktop_list_parser(p) or {}).items():
+                index["lists"].setdefault(mime_type, []).extend(
+                        (df, p) for df in desktop_files)
+    return index
+
+
+def new_index_manifest():
+    """Returns an empty index manifest, see build_desktop_file_index().
+
+    "hashes" has MappedIndex key hashes, see MappedIndex.from_index().
+    """
+    return {"dirs": {}, "files": {}, "hashes": {}}
+
+
+def load_index_manifest():
+    """Loads manifest of the previous index build from the cache directory.
+    """
+    manifest = load_cache("index_manifest.pickle")
+    return manifest if manifest is not None else new_index_manifest()
+
+
+def build_mapped_index():
+    """Builds desktop file index incrementally as a MappedIndex.
+
+    The manifest for the next build is stored to the cache directory. Caller
+    should hold the index cache lock.
+
+    Returns:
+        MappedIndex.
+    """
+    manifest = load_index_manifest()
+    index = MappedIndex.from_index(build_desktop_file_index(manifest),
+            manifest["hashes"])
+    store_cache("index_manifest.pickle", manifest)
+    return index
+
+
+class MappedIndex(object):
+    """Desktop file index in a binary format which is used in place.
+
+    The index file is memory mapped and lookups read only the pages they
+    need, so opening the index costs the same however many desktop files
+    there are. Checking that it's fresh stats only the desktop file
+    directories and list files, see get_index_generation(). Layout, all
+    integers are little endian uint32:
+
+        header: magic, version, generation, file size, number of hash
+            table slots, offsets of the string table, hash table and value
+            array, and number of keys per namespace
+        string table: sorted unique strings, each a length and UTF-8 bytes
+        hash table: open addressing with linear probing, slots are (FNV-1a
+            hash, key string offset, value array index, number of values)
+        value array: string offsets
+
+    Keys are namespaced with their mapping in build_desktop_file_index():
+    "I:" ids, "M:" MimeType, "C:" Categories and "L:" lists. Values of
+    lists are desktop file ID and list file path pairs flattened.
+
+    Attributes:
+        generation: str. Index generation, see get_index_generation().
+        counts: dict. Namespace -> number of keys.
+    """
+    MAGIC = b"PYXDGOI\0"
+    VERSION = 1
+    HEADER = struct.Struct("<8sH40sIIIII4I")
+    SLOT = struct.Struct("<IIII")
+    EMPTY = 0xFFFFFFFF
+    NAMESPACES = {"ids": "I", "MimeType": "M", "Categories": "C",
+            "lists": "L"}
+
+    def __init__(self, buf):
+        """MappedIndex initialization.
+
+        Parameters:
+            buf: mmap/bytes. Index in binary format.
+
+        Raises:
+            ValueError. If `buf` is not a valid index.
+        """
+        if len(buf) < self.HEADER.size:
+            raise ValueError("truncated index")
+        (magic_, version, generation, size, self.n_slots, self.strings_off,
+                self.table_off, self.values_off, *counts) = \
+                self.HEADER.unpack_from(buf)
+        if magic_ != self.MAGIC or version != self.VERSION:
+            raise ValueError("not a pyxdg-open index of version {}".format(
+                self.VERSION))
+        if size != len(buf):
+            raise ValueError("truncated index")
+        self.buf = buf
+        self.generation = generation.decode("ascii")
+        self.counts = dict(zip(sorted(self.NAMESPACES.values()), counts))
+
+    @staticmethod
+    def hash(key):
+        """FNV-1a 32-bit hash of bytes."""
+        h = 0x811c9dc5
+        for b in key:
+            h = ((h ^ b) * 0x01000193) & 0xFFFFFFFF
+        return h
+
+    def get_string(self, offset):
+        start = self.strings_off + offset + 4
+        length, = struct.unpack_from("<I", self.buf, start - 4)
+        return self.buf[start:start+length].decode("utf-8", "surrogateescape")
+
+    def lookup(self, mapping, key):
+        """Returns values of a key.
+
+        Parameters:
+            mapping: str. Mapping of build_desktop_file_index().
+            key: str.
+
+        Returns:
+            [str]. Values, empty if key is not found.
+        """
+        key = (self.NAMESPACES[mapping] + ":" + key).encode(
+                "utf-8", "surrogateescape")
+        h = self.hash(key)
+        mask = self.n_slots - 1
+        i = h & mask
+        while True:
+            slot_h, key_off, values_i, n_values = self.SLOT.unpack_from(
+                    self.buf, self.table_off + i * self.SLOT.size)
+            if key_off == self.EMPTY:
+                return []
+            if slot_h == h:
+                start = self.strings_off + key_off + 4
+                length, = struct.unpack_from("<I", self.buf, start - 4)
+                if self.buf[start:start+length] == key:
+                    offsets = struct.unpack_from("<{}I".format(n_values),
+                            self.buf, self.values_off + values_i * 4)
+                    return [ self.get_string(o) for o in offsets ]
+            i = (i + 1) & mask
+
+    def get(self, mapping, key):
+        """Returns the first value of a key or None."""
+        values = self.lookup(mapping, key)
+        return values[0] if values else None
+
+    def get_pairs(self, mapping, key):
+        """Returns values of a key with pair values, as in lists."""
+        values = self.lookup(mapping, key)
+        return list(zip(values[::2], values[1::2]))
+
+    def slots(self, mapping):
+        """Generates (key offset, values index, number of values) of all
+        keys of a mapping."""
+        prefix = (self.NAMESPACES[mapping] + ":").encode("ascii")
+        for i in range(self.n_slots):
+            _, key_off, values_i, n_values = self.SLOT.unpack_from(
+                    self.buf, self.table_off + i * self.SLOT.size)
+            if key_off == self.EMPTY:
+                continue
+            start = self.strings_off + key_off + 4
+            if self.buf[start:start+2] != prefix:
+                continue
+            yield key_off, values_i, n_values
+
+    def keys(self, mapping):
+        """Generates all keys of a mapping."""
+        for key_off, _, _ in self.slots(mapping):
+            yield self.get_string(key_off)[2:]
+
+    def values(self, mapping):
+        """Generates all values of a mapping."""
+        for _, values_i, n_values in self.slots(mapping):
+            for o in struct.unpack_from("<{}I".format(n_values), self.buf,
+                    self.values_off + values_i * 4):
+                yield self.get_string(o)
+
+    @classmethod
+    def from_index(cls, index, hash_cache=None):
+        """Creates MappedIndex from index of build_desktop_file_index().
+
+        Parameters:
+            index: dict.
+            hash_cache: dict. Key -> hash of the keys of a previous index. If
+                given, hashes are looked up from it and it's updated to have
+                hashes of this index.
+        """
+        keys = {} # namespaced key -> [value]
+        for mapping, ns in cls.NAMESPACES.items():
+            for key, values in index[mapping].items():
+                if mapping == "ids":
+                    values = [values]
+                elif mapping == "lists":
+                    values = [ v for pair in values for v in pair ]
+                keys[ns + ":" + key] = values
+
+        strings = sorted(set(keys).union(*keys.values()))
+        string_offsets = {}
+        string_chunks = []
+        offset = 0
+        pack_length = struct.Struct("<I").pack
+        for string in strings:
+            data = string.encode("utf-8", "surrogateescape")
+            string_chunks += (pack_length(len(data)), data)
+            string_offsets[string] = offset
+            offset += 4 + len(data)
+        strings_data = b"".join(string_chunks)
+
+        n_slots = 8
+        while n_slots < 2 * len(keys):
+            n_slots *= 2
+        mask = n_slots - 1
+        # Slots as a flat list of SLOT fields, empty slots have EMPTY key
+        table = [0, cls.EMPTY, 0, 0] * n_slots
+        values = []
+        hashes = {}
+        for key in sorted(keys):
+            h = hash_cache.get(key) if hash_cache else None
+            if h is None:
+                h = cls.hash(key.encode("utf-8", "surrogateescape"))
+            hashes[key] = h
+            i = h & mask
+            while table[4 * i + 1] != cls.EMPTY:
+                i = (i + 1) & mask
+            table[4 * i:4 * i + 4] = (h, string_offsets[key], len(values),
+                    len(keys[key]))
+            values += [ string_offsets[v] for v in keys[key] ]
+        table_data = struct.pack("<{}I".format(len(table)), *table)
+        values_data = struct.pack("<{}I".format(len(values)), *values)
+        if hash_cache is not None:
+            hash_cache.clear()
+            hash_cache.update(hashes)
+
+        strings_off = cls.HEADER.size
+        table_off = strings_off + len(strings_data)
+        values_off = table_off + len(table_data)
+        size = values_off + len(values_data)
+        counts = [ len(index[mapping]) for mapping, _ in
+                sorted(cls.NAMESPACES.items(), key=lambda t: t[1]) ]
+        header = cls.HEADER.pack(cls.MAGIC, cls.VERSION,
+                index["generation"].encode("ascii"), size, n_slots,
+                strings_off, table_off, values_off, *counts)
+        return cls(header + strings_data + table_data + values_data)
+
+
+def load_mapped_index(cache_name, cache_dir=None):
+    """Memory maps an index file from the cache directory.
+
+    Parameters:
+        cache_name: str. File name of the index.
+        cache_dir: str. Cache directory, defaults to get_cache_dir().
+
+    Returns:
+        MappedIndex/None. None if the index doesn't exist or is invalid.
+    """
+    log = logging.getLogger(__name__)
+    cache_fn = os.path.join(cache_dir or get_cache_dir(), cache_name)
+    try:
+        with open(cache_fn, "rb") as f:
+            # The mapping stays valid after closing and the file being
+            # replaced by a new index
+            return MappedIndex(mmap.mmap(f.fileno(), 0,
+                access=mmap.ACCESS_READ))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, struct.error) as e:
+        log.warn("Ignoring unreadable index file '{}': {}".format(cache_fn, e))
+    return None
+
+
+def store_mapped_index(cache_name, index):
+    """Writes a MappedIndex to the cache directory."""
+    return write_cache_file(cache_name, (index.buf,))
+
+
+def get_desktop_file_index(build=True, refresh=False):
+    """Returns desktop file index of the current index generation.
+
+    Index is memory mapped from the cache directory, or rebuilt if it's from
+    an older index generation. The generation doesn't depend on the number
+    of desktop files, so neither does opening a fresh index.
+
+    Parameters:
+        build: bool. If False, don't build the index if it's not cached.
+        refresh: bool. Rebuild the index even if it's of the current index
+            generation, e.g. if a desktop file in it has been edited in
+            place, see get_desktop_file_by_search().
+
+    Returns:
+        MappedIndex/None. Index of build_desktop_file_index(). None if index
+            was not cached and `build` was False, or another process was
+            building it.
+    """
+    global DESKTOP_FILE_INDEX, DESKTOP_FILE_INDEX_BUSY
+    if refresh and build:
+        DESKTOP_FILE_INDEX = None
+    if DESKTOP_FILE_INDEX is None:
+        is_fresh = lambda index: not refresh and \
+                index.generation == get_index_generation()
+        if build and not DESKTOP_FILE_INDEX_BUSY:
+            # If another process is building the index and it takes too
+            # long, rather search without the index than build it also here
+            DESKTOP_FILE_INDEX = load_or_build_cache("index.bin", is_fresh,
+                    build_mapped_index, lambda: None, load_mapped_index,
+                    store_mapped_index)
+            DESKTOP_FILE_INDEX_BUSY = DESKTOP_FILE_INDEX is None
+        else:
+            index = load_mapped_index("index.bin")
+            if not index or not is_fresh(index):
+                return None
+            DESKTOP_FILE_INDEX = index
+    return DESKTOP_FILE_INDEX
+
+
+def get_mime_dirs():
+    """Returns shared-mime-info directories in the order of preference."""
+    data_home = os.getenv("XDG_DATA_HOME") or \
+            os.path.expanduser("~/.local/share")
+    data_dirs = os.getenv("XDG_DATA_DIRS") or "/usr/local/share/:/usr/share/"
+    return [ os.path.join(d, "mime")
+            for d in [data_home] + data_dirs.split(":") if d ]
+
+
+def get_mime_hierarchy_sources():
+    """Returns existing shared-mime-info aliases and subclasses files.
+
+    Returns:
+        [(str, int)]. Paths with their modification times.
+    """
+    sources = []
+    for mime_dir in get_mime_dirs():
+        for name in ("aliases", "subclasses"):
+            p = os.path.join(mime_dir, name)
+            try:
+                sources.append((p, os.stat(p).st_mtime_ns))
+            except OSError:
+                pass
+    return sources
+
+
+# Mime type hierarchy, see get_mime_hierarchy()
+MIME_HIERARCHY = None
+
+
+def get_mime_hierarchy():
+    """Returns mime type aliases and ancestor closure from shared-mime-info.
+
+    Reads "aliases" and "subclasses" files of the shared-mime-info
+    directories. For every mime type which has parents, all of its ancestors
+    are precomputed in breadth first order. Result is cached in the cache
+    directory until the shared-mime-info files change.
+
+    Returns:
+        (dict, dict). Alias -> canonical mime type and mime type -> [ancestor
+            mime type].
+    """
+    global MIME_HIERARCHY
+    if MIME_HIERARCHY is not None:
+        return MIME_HIERARCHY
+
+    sources = get_mime_hierarchy_sources()
+    cached = load_or_build_cache("mime_hierarchy.pickle",
+            lambda cached: cached["sources"] == sources,
+            lambda: build_mime_hierarchy(sources))
+    MIME_HIERARCHY = cached["aliases"], cached["ancestors"]
+    return MIME_HIERARCHY
+
+
+def build_mime_hierarchy(sources):
+    """Builds mime type hierarchy for get_mime_hierarchy().
+
+    Parameters:
+        sources: [(str, int)]. See get_mime_hierarchy_sources().
+
+    Returns:
+        dict. "sources", "aliases" and "ancestors".
+    """
+    aliases = {}
+    parents = {}
+    for p, _ in sources:
+        try:
+            with open(p, encoding="utf-8") as f:
+                pairs = [ line.split() for line in f ]
+        except OSError:
+            continue
+        for pair in pairs:
+            if len(pair) != 2:
+                continue
+            # First directory has precedence for aliases, parents are merged
+            if p.endswith("aliases"):
+                aliases.setdefault(pair[0], pair[1])
+            elif pair[1] not in parents.setdefault(pair[0], []):
+                parents[pair[0]].append(pair[1])
+
+    ancestors = {}
+    for mime_type in parents:
+        closure = []
+        pending = deque((mime_type,))
+        while pending:
+            for parent in parents.get(pending.popleft(), ()):
+                parent = aliases.get(parent, parent)
+                if parent != mime_type and parent not in closure:
+                    closure.append(parent)
+                    pending.append(parent)
+        ancestors[mime_type] = closure
+
+    return {"sources": sources, "aliases": aliases, "ancestors": ancestors}
+
+
+def get_mime_extension_sources():
+    """Returns sources of the file extension table, see get_mime_extensions().
+
+    Returns:
+        [(str, int/str)]. Existing mime.types files of mimetypes and
+            shared-mime-info globs2 files with their modification times, and
+            Python version as mimetypes has built-in types.
+    """
+    sources = [("python", sys.version)]
+    for p in MT.knownfiles + [ os.path.join(mime_dir, "globs2")
+            for mime_dir in get_mime_dirs() ]:
+        try:
+            sources.append((p, os.stat(p).st_mtime_ns))
+        except OSError:
+            pass
+    return sources
+
+
+# File extension table, see get_mime_extensions()
+MIME_EXTENSIONS = None
+
+
+def get_mime_extensions():
+    """Returns file extension to mime type table.
+
+    The table is compiled from mime.types files and shared-mime-info globs,
+    see build_mime_extensions(), and cached in the cache directory until
+    they change.
+
+    Returns:
+        (dict, dict). Case-sensitive and case-folded tables of extension ->
+            mime type, extensions are with leading '.', e.g. ".tar.gz".
+    """
+    global MIME_EXTENSIONS
+    if MIME_EXTENSIONS is not None:
+        return MIME_EXTENSIONS
+
+    sources = get_mime_extension_sources()
+    cached = load_or_build_cache("mime_extensions.pickle",
+            lambda cached: cached["sources"] == sources,
+            lambda: build_mime_extensions(sources))
+    MIME_EXTENSIONS = cached["case_sensitive"], cached["folded"]
+    return MIME_EXTENSIONS
+
+
+def build_mime_extensions(sources):
+    """Builds file extension table for get_mime_extensions().
+
+    Types of mimetypes (its built-in types and mime.types files) have
+    precedence, so extensions known to it keep their mime types. Globs of
+    the form "*.ext" add compound extensions, e.g. ".tar.gz", and extensions
+    mimetypes doesn't know. Of globs for the same extension the one with the
+    highest weight wins, and with equal weights the one of the most preferred
+    mime directory. Globs with "cs" flag are case-sensitive.
+
+    Parameters:
+        sources: [(str, int/str)]. See get_mime_extension_sources().
+
+    Returns:
+        dict. "sources", "case_sensitive" and "folded".
+    """
+    log = logging.getLogger(__name__)
+    db = MT.MimeTypes(filenames=[ p for p, _ in sources
+        if p in MT.knownfiles ])
+    folded = {}
+    for ext, mime_type in db.types_map[True].items():
+        folded.setdefault(ext.lower(), mime_type)
+
+    globs = {} # (case-sensitive, extension) -> (weight, mime type)
+    for p, _ in sources:
+        if not p.endswith("globs2"):
+            continue
+        try:
+            with open(p, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except (OSError, UnicodeDecodeError) as e:
+            log.warn("Could not read globs file '{}': {}".format(p, e))
+            continue
+        for line in lines:
+            # weight:mime type:glob[:flags]
+            fields = line.split(":")
+            if line.startswith("#") or len(fields) < 3:
+                continue
+            weight, mime_type, glob = fields[:3]
+            if not glob.startswith("*.") or \
+                    any(c in glob[1:] for c in "*?[") or \
+                    not weight.isdigit():
+                continue
+            case_sensitive = len(fields) > 3 and "cs" in fields[3].split(",")
+            ext = glob[1:] if case_sensitive else glob[1:].lower()
+            key = (case_sensitive, ext)
+            if key not in globs or int(weight) > globs[key][0]:
+                globs[key] = (int(weight), mime_type)
+
+    case_sensitive = {}
+    for (cs, ext), (_, mime_type) in globs.items():
+        (case_sensitive if cs else folded).setdefault(ext, mime_type)
+    return {"sources": sources, "case_sensitive": case_sensitive,
+            "folded": folded}
+
+
+def get_mime_type_from_extension(path):
+    """Returns mime type of a file by its longest known extension.
+
+    Extensions are tried from the longest to the shortest, each first
+    case-sensitively and then case-folded. E.g. "a.b.TAR.GZ" matches
+    ".tar.gz" before ".gz".
+
+    Parameters:
+        path: str. Path or name of a file, it's not accessed.
+
+    Returns:
+        str/None. None if no extension of the file is known.
+    """
+    case_sensitive, folded = get_mime_extensions()
+    name = os.path.basename(path)
+    i = name.find(".")
+    while i != -1:
+        ext = name[i:]
+        mime_type = case_sensitive.get(ext) or folded.get(ext.lower())
+        if mime_type:
+            return mime_type
+        i = name.find(".", i + 1)
+    return None
+
+
+def get_mime_fallbacks(mime_type):
+    """Returns mime types to try if no desktop file handles the mime type.
+
+    These are the canonical mime type if `mime_type` is an alias, and
+    ancestors of the canonical mime type. Implicitly all text/* types are
+    subclasses of text/plain, and all streamable types subclasses of
+    application/octet-stream, which is always the last one.
+
+    Example: text/x-python -> [text/plain, application/octet-stream]
+
+    Parameters:
+        mime_type: str.
+
+    Returns:
+        [str].
+    """
+    aliases, ancestors = get_mime_hierarchy()
+    canonical = aliases.get(mime_type, mime_type)
+    fallbacks = [canonical] if canonical != mime_type else []
+    fallbacks += ancestors.get(canonical, [])
+    media = canonical.partition("/")[0]
+    if media == "text" and "text/plain" not in fallbacks + [canonical]:
+        fallbacks.append("text/plain")
+    octet_stream = "application/octet-stream"
+    if octet_stream in fallbacks:
+        fallbacks.remove(octet_stream)
+    if media not in ("inode", "x-scheme-handler", "x-content") and \
+            canonical != octet_stream:
+        fallbacks.append(octet_stream)
+    return fallbacks
+
+
+def get_search_generation():
+    """Returns a stamp which changes whenever search results can.
+
+    It's the index generation, see get_index_generation(), and when desktop
+    files are checked for installed programs, PATH directories. Both stat
+    only directories and list files. The negative cache is keyed on it, as
+    it has no desktop file which could be checked instead.
+    """
+    global SEARCH_GENERATION
+    if SEARCH_GENERATION is None:
+        SEARCH_GENERATION = get_index_generation()
+        if CONFIG.get("check_try_exec"):
+            SEARCH_GENERATION = (SEARCH_GENERATION, get_path_stamp())
+    return SEARCH_GENERATION
+
+
+def get_negative_cache_key(key_value_pair, file_name):
+    """Returns negative cache key for a search.
+
+    Besides key value pair, custom searchs results depend on the file name
+    extension. So extension patterns of the custom searchs matching the file
+    name are part of the key.
+
+    Parameters:
+        key_value_pair: (str, str).
+        file_name: str/None. File name to be opened.
+
+    Returns:
+        tuple.
+    """
+    ext_patterns = ()
+    if file_name:
+        ext_patterns = tuple(pattern
+                for search in CONFIG["search_order"]
+                for pattern, _ in CONFIG["custom_searchs"].get(search, ())
+                if pattern.find("/") == -1 and
+                    file_name.endswith("." + pattern))
+    return (key_value_pair[0], key_value_pair[1], ext_patterns)
+
+
+def is_negative_cached(key_value_pair, file_name):
+    """Checks if a search is known to find no desktop files.
+
+    Cached negative results are valid only for the index generation they were
+    stored in, see get_index_generation(). When desktop files are checked for
+    installed programs, also PATH directories must be unchanged. A desktop
+    file edited in place to handle the search is noticed only when its
+    directory or a list file changes next.
+
+    Returns:
+        bool.
+    """
+    global NEGATIVE_CACHE
+    if NEGATIVE_CACHE is None:
+        generation = get_search_generation()
+        NEGATIVE_CACHE = load_cache("negative.pickle", {})
+        if NEGATIVE_CACHE.get("generation") != generation:
+            NEGATIVE_CACHE = {
+                    "generation": generation,
+                    "misses": set()}
+    return get_negative_cache_key(key_value_pair, file_name) in \
+        NEGATIVE_CACHE["misses"]
+
+
+def add_negative_cached(key_value_pair, file_name):
+    """Stores a search which found no desktop files to negative cache."""
+    if is_negative_cached(key_value_pair, file_name):
+        return
+    NEGATIVE_CACHE["misses"].add(
+            get_negative_cache_key(key_value_pair, file_name))
+    def merge(stored):
+        if stored.get("generation") == NEGATIVE_CACHE["generation"]:
+            NEGATIVE_CACHE["misses"] |= stored["misses"]
+        return NEGATIVE_CACHE
+    update_cache("negative.pickle", merge, {})
+
+
+def get_cached_desktop_file(desktop_fn, cached):
+    """Returns desktop file of a desktop file cache entry if it's up to date.
+
+    Parameters:
+        desktop_fn: str. Path of the desktop file.
+        cached: (int, int, dict). Modification time, size and entry as in
+            the desktop file cache.
+
+    Returns:
+        CachedDesktopFile/None. None if desktop file has changed.
+    """
+    try:
+        st = os.stat(desktop_fn)
+    except OSError:
+        return None
+    if not is_desktop_file_cached(cached, st):
+        return None
+    df = LOADED_DESKTOP_FILES.get(desktop_fn)
+    if df is None or df.entry is not cached[2]:
+        df = LOADED_DESKTOP_FILES[desktop_fn] = \
+                CachedDesktopFile(desktop_fn, cached[2])
+    return df
+
+
+def load_mru():
+    """Returns MRU of the current index generation and locale.
+
+    The index generation stats only list files and desktop file
+    directories, see get_index_generation(). PATH is not part of the key, as
+    the program of a hit is checked instead, see get_mru_desktop_file().
+    """
+    global MRU
+    if MRU is None:
+        generation = (get_index_generation(), get_locale_keys())
+        MRU = load_cache("mru.pickle", {})
+        if MRU.get("generation") != generation:
+            MRU = {"generation": generation, "entries": OrderedDict()}
+    return MRU
+
+
+def get_mru_desktop_file(key_value_pair, file_name):
+    """Returns desktop file of a recently used search result.
+
+    Results are valid only for the index generation they were stored in,
+    see load_mru(), so adding, removing or replacing desktop files drops
+    them. Only the desktop file of a hit is checked to be unchanged and,
+    with check_try_exec, to have its program installed.
+    The entry is stored with the desktop file, so desktop file cache isn't
+    needed on a hit. A hit in the older half of MRU is moved to the front,
+    so frequently used results are kept without storing MRU on every hit.
+
+    Parameters:
+        key_value_pair: (str, str).
+        file_name: str/None. File name to be opened.
+
+    Returns:
+        (DesktopFile, str)/(None, None). Desktop file and the search which
+            found it.
+    """
+    entries = load_mru()["entries"]
+    key = get_negative_cache_key(key_value_pair, file_name)
+    cached = entries.get(key)
+    if not cached:
+        return None, None
+    stage, desktop_fn = cached[:2]
+    df = get_cached_desktop_file(desktop_fn, cached[2:])
+    if not df or not is_desktop_file_usable(df):
+        return None, None
+    if list(entries).index(key) < len(entries) // 2:
+        add_mru(key_value_pair, file_name, df, stage)
+    return df, stage
+
+
+def add_mru(key_value_pair, file_name, desktop_file, stage):
+    """Stores a search result as the most recently used one.
+
+    Generated desktop files of custom searchs are not stored.
+    """
+    global MRU
+    cached = (DESKTOP_FILE_CACHE or {}).get(desktop_file.file_name)
+    if not cached or cached[2] is not desktop_file.entry:
+        return
+    generation = load_mru()["generation"]
+    key = get_negative_cache_key(key_value_pair, file_name)
+    def merge(stored):
+        entries = stored["entries"] \
+                if stored.get("generation") == generation else OrderedDict()
+        entries.pop(key, None)
+        entries[key] = (stage, desktop_file.file_name) + cached
+        while len(entries) > MRU_SIZE:
+            entries.popitem(last=False)
+        return {"generation": generation, "entries": entries}
+    MRU = update_cache("mru.pickle", merge, {}) or merge(MRU)
+
+
+def run_search_stage(search, key_value_pair, file_name, find_all=False):
+    """Runs one desktop file search of the search order.
+
+    Parameters:
+        search: str. Search name from CONFIG["search_order"].
+        key_value_pair: (str, str).
+        file_name: str. File name to be opened. Some searches need this.
+        find_all: bool. Find all matching desktop files.
+
+    Returns:
+        DesktopFile/None or if find_all==True list of DesktopFiles.
+    """
+    with timed_stat(search):
+        return run_search(search, key_value_pair, file_name, find_all)
+
+
+def run_search(search, key_value_pair, file_name, find_all=False):
+    """Runs a desktop file search, see run_search_stage()."""
+    log = logging.getLogger(__name__)
+    if search == "list_files":
+        log.debug("Running list_files search.")
+        # If MimeType key then search first from MimeType/Desktop file list files.
+        # Configuration option list files must also be specified for this.
+        if key_value_pair[0] == "MimeType" and CONFIG["list_files"]:
+            return get_desktop_file_from_mime_list(
+                    key_value_pair[1],
+                    CONFIG["list_files"],
+                    find_all=find_all)
+    elif search == "desktop_file_paths":
+        log.debug("Running desktop_file_paths search.")
+        return get_desktop_file_by_search(key_value_pair, find_all=find_all)
+    elif search in CONFIG["custom_searchs"].keys():
+        log.debug("Running custom config search (%s): %s", key_value_pair, search)
+        if key_value_pair[0] == "MimeType":
+            return get_desktop_file_by_custom_search(
+                    CONFIG["custom_searchs"][search],
+                    key_value_pair[1],
+                    file_name,
+                    find_all=find_all)
+    return None
+
+
+# Searches with at least this cost are skipped when latency budget is spent
+EXPENSIVE_SEARCH_COST = 2
+
+
+def get_search_stage_cost(search, key_value_pair):
+    """Returns relative cost of a desktop file search.
+
+    Custom searchs are done in memory, list files and indexed keys are
+    looked up from the desktop file index. Only when the index is not built
+    yet, or the key is not indexed, desktop_file_paths search must scan all
+    desktop files.
+
+    Returns:
+        int. 0, 1 or EXPENSIVE_SEARCH_COST.
+    """
+    if search == "list_files":
+        return 1
+    elif search == "desktop_file_paths":
+        if key_value_pair[0] in INDEXED_KEYS and \
+                get_desktop_file_index(build=False):
+            return 1
+        return EXPENSIVE_SEARCH_COST
+    return 0
+
+
+def get_desktop_file(key_value_pair, file_name, print_found=False,
+        with_stage=False):
+    """Finds desktop file by key value pair.
+
+    TODO: Memory cache values per run. Now can be run multiple times for same
+          type of key/value/file_name
+
+    Finds desktop file which matches given key_value_pair. First from list files
+    and then by systematic desktop file search.
+
+    For example if given key_value_pair is ("Categories","TerminalEmulator"), then
+    a desktop file which contains "TerminalEmulator" value in "Categories" key is
+    returned.
+
+    The first desktop file found is returned.
+
+    With a latency budget (see start_latency_budget()), searches are run in
+    the order of their cost. Searches with lower preference than an already
+    found desktop file are not run, and expensive searches are skipped once
+    the budget is spent. The most preferred desktop file found is returned.
+    If nothing was found, the skipped searches are run after all.
+
+    Parameters:
+        key_value_pair: (str, str).
+        file_name: str. File name to be opened. Some searches need this.
+        print_found: bool. Print found desktop files and don't stop when first
+            is found.
+        with_stage: bool. Return also the search which found the desktop
+            file.
+
+    Returns:
+        DesktopFile/None, or (DesktopFile/None, str/None) if `with_stage`.
+    """
+    log = LOG
+    search_order = CONFIG["search_order"]
+    result = lambda df, stage: (df, stage) if with_stage else df
+
+    if print_found:
+        df = []
+        found_desktop_files = [] # list of strings
+        for search in search_order:
+            for d in run_search_stage(search, key_value_pair, file_name,
+                    find_all=True) or ():
+                df.append((d, search))
+                found_desktop_files.append(d.file_name + " [" + search + "]" + os.linesep)
+        print("Found desktop files:")
+        print("".join(found_desktop_files))
+        if not df:
+            add_negative_cached(key_value_pair, file_name)
+        return result(*df[0]) if df else result(None, None)
+
+    if is_negative_cached(key_value_pair, file_name):
+        log.info("Negative cache: no desktop file for %s", key_value_pair)
+        count_stat("negative_cache_hits")
+        return result(None, None)
+
+    df, stage = get_mru_desktop_file(key_value_pair, file_name)
+    if df:
+        log.info("MRU: '%s' [%s] for %s", df.file_name, stage,
+            key_value_pair)
+        count_stat("mru_hits")
+        return result(df, stage)
+
+    # Do desktop file searchs in given order (config file), or in cost order
+    # under latency budget
+    stage_order = range(len(search_order))
+    if latency_budget_left() is not None:
+        stage_order = sorted(stage_order, key=lambda i:
+                (get_search_stage_cost(search_order[i], key_value_pair), i))
+    found = None # (search order index, desktop file)
+    skipped = []
+    for i in stage_order:
+        search = search_order[i]
+        # Already found from a more preferred search
+        if found and found[0] < i:
+            continue
+        if latency_budget_spent() and get_search_stage_cost(
+                search, key_value_pair) >= EXPENSIVE_SEARCH_COST:
+            skipped.append(search)
+            continue
+        df = run_search_stage(search, key_value_pair, file_name)
+        if df:
+            found = (i, df)
+
+    if skipped and not found:
+        # Rather exceed the budget than open nothing, skipped searches are
+        # run cheapest first until one finds a desktop file
+        log.info("Latency budget spent but nothing found, running skipped "
+                "searches %s for %s", skipped, key_value_pair)
+        for search in skipped:
+            df = run_search_stage(search, key_value_pair, file_name)
+            if df:
+                found = (search_order.index(search), df)
+                break
+    elif skipped:
+        log.info("Latency budget spent, skipped searches %s for %s",
+            skipped, key_value_pair)
+    elif not found:
+        add_negative_cached(key_value_pair, file_name)
+    if not found:
+        return result(None, None)
+    stage = search_order[found[0]]
+    # Result of a search order cut short by latency budget is not stored
+    if not skipped:
+        add_mru(key_value_pair, file_name, found[1], stage)
+    if stage == "list_files":
+        count_stat("list_file_hits")
+    elif stage == "desktop_file_paths":
+        count_stat("desktop_file_path_hits")
+    else:
+        count_stat("custom_search_hits")
+    return result(found[1], stage)
+
+
+def get_desktop_file_for_mime(mime_type, file_name, print_found=False,
+        with_match=False):
+    """Finds desktop file for a mime type, or for its closest ancestor.
+
+    If no desktop file is found for the mime type itself, its fallback mime
+    types are tried in order, see get_mime_fallbacks().
+
+    Parameters:
+        mime_type: str.
+        file_name: str. File name to be opened. Some searches need this.
+        print_found: bool. See get_desktop_file().
+        with_match: bool. Return also how the desktop file was found.
+
+    Returns:
+        DesktopFile/None, or (DesktopFile/None, str/None, str/None) if
+            `with_match`: the desktop file, the search which found it and
+            the rule which matched, see get_match_rule().
+    """
+    log = LOG
+    for i, search_mime_type in enumerate(
+            [mime_type] + get_mime_fallbacks(mime_type)):
+        if i:
+            log.info("Trying fallback mime type '%s' for '%s'",
+                search_mime_type, mime_type)
+        desktop_file, stage = get_desktop_file(("MimeType", search_mime_type),
+                file_name=file_name, print_found=print_found, with_stage=True)
+        if desktop_file:
+            break
+    if not with_match:
+        return desktop_file
+    if not desktop_file:
+        return None, None, None
+    return desktop_file, stage, get_match_rule(stage, search_mime_type,
+            file_name, desktop_file)
+
+
+def get_match_rule(stage, mime_type, file_name, desktop_file):
+    """Returns the rule by which a search found a desktop file.
+
+    The rule is "<pattern> = <value>" of a custom search, the path of the
+    list file for list_files search and "MimeType=<mime type>" for
+    desktop_file_paths search.
+
+    Parameters:
+        stage: str. Search from CONFIG["search_order"].
+        mime_type: str. Searched mime type.
+        file_name: str. File name to be opened.
+        desktop_file: DesktopFile. Desktop file the search found.
+
+    Returns:
+        str/None.
+    """
+    if stage in CONFIG["custom_searchs"]:
+        for pattern, value in CONFIG["custom_searchs"][stage]:
+            if match_custom_search_pattern(pattern, mime_type, file_name):
+                return "{} = {}".format(pattern, value)
+    elif stage == "list_files":
+        index = get_desktop_file_index(build=False)
+        for df_id, list_file in index.get_pairs("lists", mime_type) \
+                if index else ():
+            if os.path.basename(list_file) in CONFIG["list_files"] and \
+                    get_df_full_path(df_id) == desktop_file.file_name:
+                return list_file
+    elif stage == "desktop_file_paths":
+        return "MimeType={}".format(mime_type)
+    return None
+
+
+# Mime type prefix of URL scheme handlers
+SCHEME_HANDLER_PREFIX = "x-scheme-handler/"
+
+# Scheme handler table, see get_scheme_handlers()
+SCHEME_HANDLERS = None
+
+# URL scheme, e.g. "mailto:" or "https://". Relative file names can match it
+# too, e.g. "notes:draft.txt", see is_scheme_url().
+SCHEME_URL_RE = re.compile(r"([a-z][a-z0-9+.-]*):(//)?", re.I)
+
+
+def get_scheme_handlers_stamp():
+    """Returns a stamp which changes when scheme handlers can change.
+
+    It's built from the index generation, which stats only list files and
+    desktop file directories, see get_index_generation(), and doesn't need
+    the index itself. PATH is not part of it: the one handler used is checked
+    for its program instead, see get_scheme_handler_url().
+    """
+    return (get_index_generation(), CONFIG["search_order"],
+            CONFIG["list_files"], CONFIG["desktop_file_paths"],
+            CONFIG.get("check_try_exec", True), get_locale_keys())
+
+
+def get_scheme_handlers(rebuild=False):
+    """Returns desktop files of URL schemes.
+
+    The table is built from the "x-scheme-handler/*" mime types of list
+    files and desktop files, see build_scheme_handlers(), and cached in the
+    cache directory with its stamp, see get_scheme_handlers_stamp(). The
+    desktop file index is opened only to build the table.
+
+    Parameters:
+        rebuild: bool. Rebuild the table, e.g. if a desktop file in it has
+            changed.
+
+    Returns:
+        dict. Scheme -> (search, desktop file path, mtime_ns, size, entry).
+            Search is the one of the search order which found the desktop
+            file and the rest are as in the desktop file cache.
+    """
+    global SCHEME_HANDLERS
+    if SCHEME_HANDLERS is None or rebuild:
+        stamp = get_scheme_handlers_stamp()
+        is_fresh = lambda cached: cached["stamp"] == stamp and not rebuild
+        cached = load_cache("schemes.pickle")
+        if cached is not None and is_fresh(cached):
+            SCHEME_HANDLERS = cached["handlers"]
+            return SCHEME_HANDLERS
+        index = get_desktop_file_index()
+        if not index:
+            return {}
+        SCHEME_HANDLERS = load_or_build_cache("schemes.pickle", is_fresh,
+                lambda: {"stamp": stamp,
+                    "handlers": build_scheme_handlers(index)})["handlers"]
+    return SCHEME_HANDLERS
+
+
+def build_scheme_handlers(index):
+    """Builds scheme handler table for get_scheme_handlers().
+
+    Desktop file of each scheme is searched with the list_files and
+    desktop_file_paths searches in search order. Custom searchs are left out,
+    see get_scheme_handler_url().
+
+    Parameters:
+        index: MappedIndex. See get_desktop_file_index().
+
+    Returns:
+        dict.
+    """
+    log = logging.getLogger(__name__)
+    log.info("Building scheme handler table.")
+    mime_types = set()
+    for mapping in ("lists", "MimeType"):
+        mime_types.update(key for key in index.keys(mapping)
+                if key.startswith(SCHEME_HANDLER_PREFIX))
+    handlers = {}
+    for mime_type in sorted(mime_types):
+        for search in CONFIG["search_order"]:
+            if search not in ("list_files", "desktop_file_paths"):
+                continue
+            df = run_search_stage(search, ("MimeType", mime_type), None)
+            cached = DESKTOP_FILE_CACHE.get(df.file_name) if df else None
+            if cached:
+                handlers[mime_type[len(SCHEME_HANDLER_PREFIX):]] = \
+                        (search, df.file_name) + cached
+                break
+    return handlers
+
+
+def is_scheme_url(url, scheme):
+    """Returns True if an URL matching SCHEME_URL_RE is not a file name.
+
+    It's an URL if its scheme has a scheme handler, or if no such path
+    exists. Otherwise it's a relative file name like "notes:draft.txt".
+
+    Parameters:
+        url: str.
+        scheme: str. Scheme of the `url` in lower case.
+    """
+    return not os.path.exists(url) or scheme in get_scheme_handlers()
+
+
+def get_scheme_handler_url(url):
+    """Returns URL with its desktop file if a scheme handler handles it.
+
+    This is the fast path of scheme URLs, e.g. "https://..." or "mailto:...".
+    Their mime type is "x-scheme-handler/<scheme>" and the desktop file comes
+    from get_scheme_handlers(), so there's no mime type detection and no
+    desktop file searches. The fast path is not taken for http(s) URLs if
+    http_probe is on, as then the mime type comes from the server, or if a
+    custom search in search order could match the URL. It's taken only for
+    schemes with a scheme handler, so relative file names which look like
+    URLs, e.g. "notes:draft.txt", are opened as files, see is_scheme_url().
+
+    Parameters:
+        url: str.
+
+    Returns:
+        (URL, str)/(None, None). URL with the desktop file attached and the
+            search which found the desktop file.
+    """
+    m = SCHEME_URL_RE.match(url)
+    if not m:
+        return None, None
+    protocol = m.group(1).lower()
+    if protocol == "file" or (protocol in ("http", "https") and
+            CONFIG.get("http_probe")):
+        return None, None
+    handler = get_scheme_handlers().get(protocol)
+    if not handler:
+        return None, None
+
+    mime_type = SCHEME_HANDLER_PREFIX + protocol
+    target = urllib.parse.unquote(url[m.end():])
+    for search_name in CONFIG["search_order"]:
+        for pattern, _ in CONFIG["custom_searchs"].get(search_name, ()):
+            if match_custom_search_pattern(pattern, mime_type, target):
+                return None, None
+    # Only the handler used is checked, not every desktop file and PATH
+    # directory the table was built from
+    df = get_cached_desktop_file(handler[1], handler[2:])
+    if not df or not is_desktop_file_usable(df):
+        # Desktop file or its program has changed after the table was built
+        handler = get_scheme_handlers(rebuild=True).get(protocol)
+        df = handler and get_cached_desktop_file(handler[1], handler[2:])
+        if not df or not is_desktop_file_usable(df):
+            return None, None
+
+    purl = URL(url, protocol=protocol, target=target, mime_type=mime_type)
+    purl.desktop_file = df
+    return purl, handler[0]
+
+
+class ExecTemplate(object):
+    """Exec string parsed into literal text and field codes.
+
+    http://standards.freedesktop.org/desktop-entry-spec/latest/ar01s06.html
+
+    "%%" is unescaped to "%" and deprecated field codes are removed when
+    parsing, so expanding the template is a single join.
+
+    Attributes:
+        literals: (str). Literal text around field codes, one more than
+            there are field codes.
+        fields: (str). Field code characters in order of appearance.
+        codes: frozenset(str). Field code characters in the template.
+    """
+    __slots__ = ("literals", "fields", "codes")
+
+    # Field codes removed from Exec strings
+    DEPRECATED_CODES = frozenset("dDnNvm")
+    # Field codes expanded per URL, others are same for all URLs of a group
+    URL_CODES = frozenset("fu")
+
+    def __init__(self, exec_str):
+        """ExecTemplate initialization.
+
+        Parameters:
+            exec_str: str. Exec string with field codes.
+        """
+        # Split gives literal, code, literal, ..., literal
+        parts = re.split(r"%(.)", exec_str, flags=re.DOTALL)
+        literals = [parts[0]]
+        fields = []
+        for code, literal in zip(parts[1::2], parts[2::2]):
+            if code == "%":
+                literals[-1] += "%" + literal
+            elif code in self.DEPRECATED_CODES:
+                literals[-1] += literal
+            elif code in "fFuUick":
+                fields.append(code)
+                literals.append(literal)
+            else:
+                # Unknown field codes are left as they are
+                literals[-1] += "%" + code + literal
+        self.literals = tuple(literals)
+        self.fields = tuple(fields)
+        self.codes = frozenset(fields)
+
+    def expand(self, group_values, purl):
+        """Returns exec string with field codes expanded.
+
+        Parameters:
+            group_values: dict. Field code -> shell quoted value for field
+                codes not in URL_CODES, see get_exec_group_values().
+            purl: URL. URL for "%f" and "%u".
+        """
+        out = [self.literals[0]]
+        for code, literal in zip(self.fields, self.literals[1:]):
+            if code == "f":
+                out.append(shlex.quote(purl.get_target()))
+            elif code == "u":
+                out.append(shlex.quote(purl.get_url()))
+            else:
+                out.append(group_values[code])
+            out.append(literal)
+        return "".join(out)
+
+
+# Parsed exec strings, see get_exec_template()
+EXEC_TEMPLATES = {}
+
+
+def get_exec_template(exec_str):
+    """Returns ExecTemplate of the exec string, templates are cached."""
+    template = EXEC_TEMPLATES.get(exec_str)
+    if template is None:
+        template = EXEC_TEMPLATES[exec_str] = ExecTemplate(exec_str)
+    return template
+
+
+def get_desktop_file_exec_template(desktop_file):
+    """Returns ExecTemplate of the desktop files Exec or bashwrap command."""
+    return get_exec_template(desktop_file.bashwrap_cmd or
+            desktop_file.get_entry_value_from_group("Exec"))
+
+
+def get_localized_value(desktop_file, entry_key):
+    """Returns value of a localizable key in the current locale.
+
+    Falls back to the untranslated value.
+
+    Parameters:
+        desktop_file: CachedDesktopFile/DesktopFile.
+        entry_key: str. Key in LOCALIZED_KEYS.
+
+    Returns:
+        str/None.
+    """
+    if isinstance(desktop_file, CachedDesktopFile):
+        return desktop_file.get_localized_value(entry_key)
+    for loc in get_locale_keys():
+        value = desktop_file.get_entry_value_from_group(
+                "{}[{}]".format(entry_key, loc))
+        if value is not None:
+            return value
+    return desktop_file.get_entry_value_from_group(entry_key)
+
+
+def get_exec_group_values(template, purls):
+    """Returns values of field codes which are the same for all URLs.
+
+    Only field codes in the template are expanded.
+
+    Parameters:
+        template: ExecTemplate.
+        purls: [URL]. URLs with the same desktop file.
+
+    Returns:
+        dict. Field code -> shell quoted value.
+    """
+    desktop_file = purls[0].desktop_file
+    values = {}
+    if "F" in template.codes:
+        values["F"] = " ".join(
+                shlex.quote(purl.get_target()) for purl in purls)
+    if "U" in template.codes:
+        values["U"] = " ".join(shlex.quote(purl.get_url()) for purl in purls)
+    if "i" in template.codes:
+        icon = desktop_file.get_entry_value_from_group("Icon")
+        values["i"] = "--icon " + shlex.quote(icon) if icon else ""
+    if "c" in template.codes:
+        name = get_localized_value(desktop_file, "Name")
+        values["c"] = shlex.quote(name) if name is not None else ""
+    if "k" in template.codes:
+        # TODO: file name in URI form if not local (vholder?)
+        values["k"] = shlex.quote(desktop_file.file_name)
+    return values
 
 
-def get_prepared_exec_str(purl, purls):
+def get_prepared_exec_str(purl, purls, group_values=None,
+        create_rc_file=True):
     """Expands field (%x) variables in Exec strings.
 
     Replaces Exec string fields (%x) and wraps with terminal emulator
@@ -600,56 +3766,22 @@ def get_prepared_exec_str(purl, purls):
         purl: URL. Parsed url, Exec string is got from associated desktop file.
         purls: [URL]. List of parsed urls. Used for expanding '%F' and '%U'
             fields. First parameter purl should be included in this list.
+        group_values: dict. Values from get_exec_group_values(), computed if
+            not given. Pass them when preparing exec strings for each URL of
+            a group.
+        create_rc_file: bool. If False, bashwrap command is returned as is
+            instead of creating a bashrc file which runs it.
     """
     log = logging.getLogger(__name__)
-    def expand_fields(string):
-        """Expands or removes field variables from the given string.
-        """
-        # Fill fields
-        # TODO: '%' char escaping is not considered yet
-        # http://standards.freedesktop.org/desktop-entry-spec/latest/ar01s06.html
-
-        # First remove/ignore deprecated
-        string = string.replace('%d', "")
-        string = string.replace('%D', "")
-        string = string.replace('%n', "")
-        string = string.replace('%N', "")
-        string = string.replace('%v', "")
-        string = string.replace('%m', "")
-
-        string = string.replace('%f', shlex.quote(purl.get_target()))
-        string = string.replace('%u', shlex.quote(purl.get_url()))
-
-        string = string.replace('%F', " ".join(
-                [ shlex.quote(_purl.get_target()) for _purl in purls]))
-        string = string.replace('%U', " ".join(
-                [ shlex.quote(_purl.get_url()) for _purl in purls]))
-
-        icon_value = purl.desktop_file.get_entry_value_from_group("Icon")
-        string = string.replace('%i',
-                icon_value if icon_value != None else "")
-
-        # Replace locale dependent name
-        if string.find("%c") != -1:
-            loc = locale.getlocale()[0]
-            name = purl.desktop_file.get_entry_value_from_group(
-                    "Name[{}]".format(loc))
-            if name == None:
-                name = purl.desktop_file.get_entry_value_from_group(
-                        "Name[{}]".format(loc.partition("_")[0]))
-            if name == None:
-                string = string.replace('%c', "")
-            else:
-                string = string.replace('%c', shlex.quote(name))
-
-        # TODO: file name in URI form if not local (vholder?)
-        string = string.replace(
-                '%k', shlex.quote(purl.desktop_file.file_name))
-        return string
+    template = get_desktop_file_exec_template(purl.desktop_file)
+    if group_values is None:
+        group_values = get_exec_group_values(template, purls)
 
-    if purl.desktop_file.bashwrap_cmd:
+    if purl.desktop_file.bashwrap_cmd and not create_rc_file:
+        exec_str = template.expand(group_values, purl)
+    elif purl.desktop_file.bashwrap_cmd:
         # Expand bashwrap command and create a custom bashrc with it
-        cmd = expand_fields(purl.desktop_file.bashwrap_cmd)
+        cmd = template.expand(group_values, purl)
         rc_file = tempfile.NamedTemporaryFile(mode='a+b', delete=False)
 
         # Let's add orginal bashrc file if it exits
@@ -661,7 +3793,7 @@ def get_prepared_exec_str(purl, purls):
 
         # rm is used in the custom bashrc to delete it self
         rm_path = "/usr/bin/rm"
-        if not which("rm_path"):
+        if not which(rm_path):
             rm_path = which("rm")
 
         additional = """export PROMPT_COMMAND=""" + \
@@ -671,31 +3803,47 @@ def get_prepared_exec_str(purl, purls):
         rc_file.flush()
         exec_str = "bash --rcfile " + rc_file.name + " -i"
     else:
-        exec_str = purl.desktop_file.get_entry_value_from_group("Exec")
-        exec_str = expand_fields(exec_str)
+        exec_str = template.expand(group_values, purl)
 
     # Finally do terminal wrapping if needed
     if purl.desktop_file.get_entry_value_from_group("Terminal"):
         log.info("wrapping exec string with terminal emulator call.")
-        if CONFIG["default_terminal_emulator"]:
-            exec_str = CONFIG["default_terminal_emulator"] + \
-                    " -e " + exec_str
-        else:
-            # If not default terminal emulator specified in the config file
-            # then try to find a terminal emulator from desktop files.
-            log.debug("Trying to find the terminal emulator from desktop files.")
-            terminal_df = get_desktop_file(("Categories", "TerminalEmulator"), file_name=None)
-            if terminal_df:
-                exec_str = terminal_df.get_entry_value_from_group("Exec") + \
-                        " -e " + exec_str
-            else:
-                # Just try xterm if no TerminalEmulator desktop file found
-                log.warn("Could not find terminal emulator .desktop file:"
-                        " defaulting to xterm")
-                exec_str = "xterm -e " + exec_str
+        exec_str = get_terminal_exec_str() + " -e " + exec_str
     return exec_str
 
 
+# Terminal emulator command, see get_terminal_exec_str()
+TERMINAL_EXEC_STR = None
+
+
+def get_terminal_exec_str():
+    """Returns command of the terminal emulator for Terminal=true programs.
+
+    Returns:
+        str. Exec string to which "-e" and the command can be appended.
+    """
+    global TERMINAL_EXEC_STR
+    log = logging.getLogger(__name__)
+    if TERMINAL_EXEC_STR is not None:
+        return TERMINAL_EXEC_STR
+    if CONFIG["default_terminal_emulator"]:
+        TERMINAL_EXEC_STR = CONFIG["default_terminal_emulator"]
+        return TERMINAL_EXEC_STR
+    # If not default terminal emulator specified in the config file
+    # then try to find a terminal emulator from desktop files.
+    log.debug("Trying to find the terminal emulator from desktop files.")
+    terminal_df = get_desktop_file(("Categories", "TerminalEmulator"),
+            file_name=None)
+    if terminal_df:
+        TERMINAL_EXEC_STR = terminal_df.get_entry_value_from_group("Exec")
+    else:
+        # Just try xterm if no TerminalEmulator desktop file found
+        log.warn("Could not find terminal emulator .desktop file:"
+                " defaulting to xterm")
+        TERMINAL_EXEC_STR = "xterm"
+    return TERMINAL_EXEC_STR
+
+
 def run_exec(purls, dryrun=False):
     """Evaluates/Runs desktop files Exec value.
 
@@ -717,29 +3865,552 @@ def run_exec(purls, dryrun=False):
         assert(url.desktop_file.file_name == purls[0].desktop_file.file_name)
 
     exec_str = purls[0].desktop_file.get_entry_value_from_group("Exec")
-    exec_strs = []
-    log.info("run_exec: {}".format(exec_str))
-
-    # If we have %f or %u and length(purls) > 1, then do multiple exec calls
-    if len(purls) > 1:
-        # If bashwrap_cmd then it contains the to-be-expanded field variables
-        if purls[0].desktop_file.bashwrap_cmd:
-            check_string = purls[0].desktop_file.bashwrap_cmd
-        else:
-            check_string = exec_str
-        if check_string.find('%f') != -1 or check_string.find('%u') != -1:
-            for purl in purls:
-                exec_strs.append(get_prepared_exec_str(purl, purls))
-        else:
-            exec_strs.append(get_prepared_exec_str(purls[0], purls))
+    log.info("run_exec: %s", exec_str)
+
+    # If we have %f or %u, then do an exec call per URL. Field values which
+    # are same for all URLs are expanded only once.
+    template = get_desktop_file_exec_template(purls[0].desktop_file)
+    group_values = get_exec_group_values(template, purls)
+    if len(purls) > 1 and not template.codes.isdisjoint(
+            ExecTemplate.URL_CODES):
+        exec_strs = [ get_prepared_exec_str(purl, purls, group_values)
+                for purl in purls ]
     else:
-        exec_strs.append(get_prepared_exec_str(purls[0], purls))
+        exec_strs = [get_prepared_exec_str(purls[0], purls, group_values)]
 
-    log.info("Final exec string(s): {}".format(repr(exec_strs)))
+    log.info("Final exec string(s): %r", exec_strs)
     for es in exec_strs:
-        log.info("Calling exec string: {}".format(es))
+        log.info("Calling exec string: %s", es)
         if not dryrun:
-            subprocess.Popen(es, shell=True)
+            with timed_stat("spawn"):
+                if launch_with_forkserver(es):
+                    count_stat("forkserver_spawns")
+                else:
+                    subprocess.Popen(es, shell=True)
+            count_stat("spawns")
+
+
+def group_purls(purls):
+    """Groups purls with same desktop_file together.
+
+    The sameness is determined by desktop files name. Groups are in the order
+    of their first URLs and URLs keep their order inside groups.
+
+    Instead of sorting and copying purls, URL indices are counting sorted by
+    their group numbers into an array, so grouping needs only a few machine
+    words per URL.
+
+    Yields:
+        [URL]. One group at a time.
+    """
+    log = logging.getLogger(__name__)
+    group_numbers = {}
+    url_groups = array.array("L")
+    for purl in purls:
+        url_groups.append(group_numbers.setdefault(
+            purl.desktop_file.file_name, len(group_numbers)))
+    log.debug("Formed %s URL groups.", len(group_numbers))
+
+    # Group g URLs are at indices order[group_starts[g]:group_starts[g+1]]
+    group_starts = array.array("L", [0]) * (len(group_numbers) + 1)
+    for g in url_groups:
+        group_starts[g+1] += 1
+    for g in range(len(group_numbers)):
+        group_starts[g+1] += group_starts[g]
+    next_pos = group_starts[:-1]
+    order = array.array("L", [0]) * len(url_groups)
+    for i, g in enumerate(url_groups):
+        order[next_pos[g]] = i
+        next_pos[g] += 1
+    del url_groups, next_pos
+
+    for g in range(len(group_numbers)):
+        yield [ purls[i] for i in order[group_starts[g]:group_starts[g+1]] ]
+
+
+def get_runtime_dir():
+    """Returns the directory for pyxdg-open's sockets and lock files.
+
+    It's $XDG_RUNTIME_DIR/pyxdg-open, or the cache directory if
+    XDG_RUNTIME_DIR is not set.
+
+    Returns:
+        str. Runtime directory path, it's not guaranteed to exist.
+    """
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if not runtime_dir or not os.path.isabs(runtime_dir):
+        return get_cache_dir()
+    return os.path.join(runtime_dir, "pyxdg-open")
+
+
+def get_absolute_url(url):
+    """Returns URL which doesn't depend on current working directory.
+
+    Relative file paths are made absolute, URLs with a scheme are returned as
+    is. A relative file name which looks like an URL, e.g. "notes:draft.txt",
+    is a file path, see is_scheme_url().
+    """
+    m = SCHEME_URL_RE.match(url)
+    if m and is_scheme_url(url, m.group(1).lower()):
+        return url
+    return os.path.abspath(os.path.expanduser(url))
+
+
+def get_coalesce_key(dryrun=False):
+    """Returns a key of the settings URLs of an invocation are opened with.
+
+    The leader of coalesced invocations opens all URLs with its own config,
+    --dryrun and environment, so only invocations with the same key are
+    coalesced. Environment is compared by the FORKSERVER_ENV variables, the
+    ones programs are started with.
+
+    Parameters:
+        dryrun: bool. See xdg_open().
+
+    Returns:
+        str. Hex digest.
+    """
+    env = sorted((name, value) for name, value in os.environ.items()
+            if is_forkserver_env_var(name))
+    return hashlib.sha1(repr((sorted(CONFIG.items()), dryrun, env))
+            .encode("utf-8", "surrogateescape")).hexdigest()[:16]
+
+
+def coalesce_urls(urls, window, dryrun=False):
+    """Merges URLs of pyxdg-open invocations started within a time window.
+
+    The first invocation becomes a leader by locking "coalesce-<key>.lock" in
+    the runtime directory, see get_coalesce_key(). It listens to
+    "coalesce-<key>.sock" for the duration of the window and collects URLs
+    sent by the other invocations, which exit after the leader has
+    acknowledged their URLs. The leader then opens them all, so that
+    grouping by desktop file can start a program once for all of them. If
+    handing URLs over fails, the invocation opens its URLs itself.
+
+    Parameters:
+        urls: [str]. URLs given to this invocation.
+        window: float. Coalescing window in seconds.
+        dryrun: bool. See xdg_open().
+
+    Returns:
+        [str]/None. URLs to open, or None if they were handed to the leader.
+    """
+    log = logging.getLogger(__name__)
+    runtime_dir = get_runtime_dir()
+    key = get_coalesce_key(dryrun)
+    lock_fn = os.path.join(runtime_dir, "coalesce-{}.lock".format(key))
+    sock_fn = os.path.join(runtime_dir, "coalesce-{}.sock".format(key))
+    urls = [ get_absolute_url(url) for url in urls ]
+    # URLs are sent NUL separated, which can't appear in paths
+    message = "\0".join(urls).encode("utf-8", "surrogateescape")
+    try:
+        os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+        lock_fd = os.open(lock_fn, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        log.warn("Could not coalesce invocations: {}".format(e))
+        return urls
+
+    deadline = time.monotonic() + window
+    try:
+        while True:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return coalesce_as_leader(urls, sock_fn, deadline)
+            except BlockingIOError:
+                pass
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.settimeout(window + 1)
+                    sock.connect(sock_fn)
+                    sock.sendall(message)
+                    sock.shutdown(socket.SHUT_WR)
+                    if sock.recv(1) == b"\0":
+                        log.info("Handed URLs to coalescing invocation.")
+                        return None
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Leader hasn't bound the socket yet or has just closed it
+                if time.monotonic() < deadline:
+                    time.sleep(0.005)
+                    continue
+            except OSError as e:
+                log.warn("Could not hand URLs to coalescing invocation: {}"
+                        .format(e))
+            return urls
+    finally:
+        os.close(lock_fd)
+
+
+def coalesce_as_leader(urls, sock_fn, deadline):
+    """Collects URLs from other invocations until the deadline.
+
+    Caller must hold the coalescing lock, see coalesce_urls().
+
+    Parameters:
+        urls: [str]. URLs of the leader itself.
+        sock_fn: str. Path of the socket to listen to.
+        deadline: float. time.monotonic() time to stop listening.
+
+    Returns:
+        [str]. All collected URLs in arrival order.
+    """
+    log = logging.getLogger(__name__)
+    urls = list(urls)
+    try:
+        os.unlink(sock_fn)
+    except FileNotFoundError:
+        pass
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        try:
+            server.bind(sock_fn)
+            server.listen(64)
+        except OSError as e:
+            log.warn("Could not listen coalescing socket: {}".format(e))
+            return urls
+        try:
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                server.settimeout(timeout)
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                with conn:
+                    try:
+                        conn.settimeout(0.5)
+                        chunks = []
+                        while True:
+                            chunk = conn.recv(65536)
+                            if not chunk:
+                                break
+                            chunks.append(chunk)
+                        received = b"".join(chunks).decode(
+                                "utf-8", "surrogateescape").split("\0")
+                        conn.sendall(b"\0")
+                    except OSError as e:
+                        log.warn("Receiving coalesced URLs failed: %s", e)
+                        continue
+                urls += [ url for url in received if url ]
+        finally:
+            os.unlink(sock_fn)
+    log.info("Coalesced %s URLs.", len(urls))
+    return urls
+
+
+# Seconds a forkserver request may take, see launch_with_forkserver()
+FORKSERVER_TIMEOUT = 1.0
+
+# Environment variables of an invocation which programs started by
+# forkserver get, see get_forkserver_env(). Names ending with "_" are
+# prefixes.
+FORKSERVER_ENV = ("DISPLAY", "WAYLAND_DISPLAY", "XDG_", "PATH", "LANG",
+        "LC_", "DBUS_SESSION_BUS_ADDRESS")
+
+# Exec strings with these need a shell, see get_exec_argv()
+SHELL_SPECIAL_CHARS = re.compile(r"[|&;<>()$`\\*?\[\]{}~#!\n]")
+
+
+def get_exec_argv(exec_str):
+    """Returns argv which runs an exec string.
+
+    Exec string is run directly if it consists only of words and quotes,
+    otherwise with "/bin/sh -c" like subprocess.Popen(shell=True) does.
+
+    Parameters:
+        exec_str: str. See get_prepared_exec_str().
+
+    Returns:
+        [str].
+    """
+    if not SHELL_SPECIAL_CHARS.search(exec_str):
+        try:
+            argv = shlex.split(exec_str)
+        except ValueError:
+            argv = None
+        # Variable assignments need a shell too
+        if argv and "=" not in argv[0]:
+            return argv
+    return ["/bin/sh", "-c", exec_str]
+
+
+def is_forkserver_env_var(name):
+    """Returns True if an environment variable is in FORKSERVER_ENV."""
+    return any(name.startswith(var) if var.endswith("_") else name == var
+            for var in FORKSERVER_ENV)
+
+
+def get_forkserver_env(request_env):
+    """Returns environment of a program started by forkserver.
+
+    The program gets the FORKSERVER_ENV variables of the invocation, which
+    select its display, session bus, locale and programs, and the rest from
+    forkserver's own environment, which is the user's session environment.
+    The rest of the invocation's environment is not passed, so e.g.
+    LD_PRELOAD or PYTHONPATH of a terminal don't leak into programs, which
+    are no longer children of that invocation.
+
+    Parameters:
+        request_env: dict. Environment of the invocation.
+
+    Returns:
+        dict.
+    """
+    env = { name: value for name, value in os.environ.items()
+            if not is_forkserver_env_var(name) }
+    env.update((name, value) for name, value in request_env.items()
+            if is_forkserver_env_var(name))
+    return env
+
+
+def launch_with_forkserver(exec_str):
+    """Asks forkserver to run an exec string, see forkserver().
+
+    The request has argv of the exec string, current directory and
+    FORKSERVER_ENV variables of the environment, and stdin, stdout and
+    stderr are passed with it.
+
+    Parameters:
+        exec_str: str. See get_prepared_exec_str().
+
+    Returns:
+        bool. False if there's no forkserver or it didn't start the program,
+            in which case caller should start it itself.
+    """
+    log = logging.getLogger(__name__)
+    sock_fn = os.path.join(get_runtime_dir(), "forkserver.sock")
+    request = json.dumps({"argv": get_exec_argv(exec_str),
+        "cwd": os.getcwd(), "env": { name: value for name, value in
+            os.environ.items() if is_forkserver_env_var(name) }
+        }).encode("ascii")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(FORKSERVER_TIMEOUT)
+        try:
+            sock.connect(sock_fn)
+            sock.sendmsg([b"\0"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                array.array("i", (0, 1, 2)))])
+            sock.sendall(request)
+            sock.shutdown(socket.SHUT_WR)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+        except OSError as e:
+            log.warn("Could not send request to forkserver: %s", e)
+            return False
+        try:
+            reply = sock.recv(64)
+        except OSError as e:
+            # Request was sent, so program may have been started: don't
+            # risk starting it twice
+            log.error("No reply from forkserver: %s", e)
+            return True
+    if not reply.strip().isdigit():
+        log.warn("Forkserver didn't start '%s'.", exec_str)
+        return False
+    log.info("Forkserver started '%s' as pid %d", exec_str, int(reply))
+    return True
+
+
+def forkserver():
+    """Runs a resident launcher of programs for pyxdg-open invocations.
+
+    Listens to "forkserver.sock" in the runtime directory. For each request
+    of launch_with_forkserver() a child is forked, which starts a new session,
+    changes to the directory of the request and execs its argv with its
+    stdin, stdout and stderr, and environment, see get_forkserver_env().
+    Only requests of the same user are accepted. Invocations start programs
+    themselves if forkserver is not running. Only one forkserver runs at a
+    time.
+
+    Only launching is done here. Invocations still start the interpreter,
+    import this module, read the config and resolve their URLs, and send
+    the resulting argv.
+
+    Returns:
+        int. Nonzero value if forkserver could not be started.
+    """
+    log = logging.getLogger(__name__)
+    runtime_dir = get_runtime_dir()
+    lock_fn = os.path.join(runtime_dir, "forkserver.lock")
+    sock_fn = os.path.join(runtime_dir, "forkserver.sock")
+    try:
+        os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+        lock_fd = os.open(lock_fn, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        log.error("Could not start forkserver: %s", e)
+        return 1
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.error("Forkserver is already running.")
+        os.close(lock_fd)
+        return 1
+    try:
+        os.unlink(sock_fn)
+    except FileNotFoundError:
+        pass
+
+    # Children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(sock_fn)
+        server.listen(64)
+        log.info("Forkserver listening to '%s'", sock_fn)
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    serve_launch_request(conn)
+                except (OSError, ValueError, KeyError) as e:
+                    log.warn("Launch request failed: %s", e)
+
+
+def serve_launch_request(conn):
+    """Forks a child for a launch request, see forkserver().
+
+    Parameters:
+        conn: socket. Connection of a launch_with_forkserver() call.
+
+    Raises:
+        OSError. If request could not be received or child forked.
+        ValueError. If request is invalid.
+    """
+    conn.settimeout(FORKSERVER_TIMEOUT)
+    _, uid, _ = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET,
+        socket.SO_PEERCRED, struct.calcsize("3i")))
+    if uid != os.getuid():
+        raise PermissionError("Request from uid {}".format(uid))
+    fds = array.array("i")
+    _, ancdata, _, _ = conn.recvmsg(1, socket.CMSG_SPACE(3 * fds.itemsize))
+    try:
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        request = json.loads(b"".join(chunks).decode("ascii"))
+        argv, cwd = request["argv"], request["cwd"]
+        env = get_forkserver_env(request["env"])
+        if not argv:
+            raise ValueError("Empty argv")
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                exec_launch_request(argv, cwd, env, list(fds))
+            finally:
+                os._exit(127)
+        conn.sendall("{}\n".format(pid).encode("ascii"))
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def exec_launch_request(argv, cwd, env, fds):
+    """Execs a launch request in a forked child, see serve_launch_request().
+    """
+    os.setsid()
+    # Python ignores these, and ignored signals stay ignored over exec
+    for signum in (signal.SIGCHLD, signal.SIGPIPE, signal.SIGXFSZ):
+        signal.signal(signum, signal.SIG_DFL)
+    for target_fd, fd in enumerate(fds[:3]):
+        os.dup2(fd, target_fd)
+    for fd in fds:
+        if fd > 2:
+            os.close(fd)
+    try:
+        os.chdir(cwd)
+    except OSError:
+        os.chdir("/")
+    os.execvpe(argv[0], argv, env)
+
+
+def resolve_url(url, memo):
+    """Resolves how an URL would be opened, without opening it.
+
+    Parameters:
+        url: str. URL to resolve.
+        memo: dict. Desktop file search results by search key, shared
+            between calls. See get_negative_cache_key().
+
+    Returns:
+        OrderedDict. JSON serializable record of the URL with keys "url",
+            "protocol", "target", "mime_type", "desktop_file", "stage",
+            "rule", "argv" and "error", which is None if resolving succeeded.
+    """
+    count_stat("urls")
+    with timed_stat("url"):
+        purl, stage = get_scheme_handler_url(url)
+        if not purl:
+            purl = URL(url)
+    record = OrderedDict([
+        ("url", purl.url),
+        ("protocol", purl.protocol),
+        ("target", purl.target),
+        ("mime_type", purl.mime_type),
+        ("desktop_file", None),
+        ("stage", None),
+        ("rule", None),
+        ("argv", None),
+        ("error", None),
+        ])
+    if not purl.mime_type:
+        record["error"] = "no mime type"
+        return record
+
+    # Results depend only on the mime type and custom search extensions
+    key = get_negative_cache_key(("MimeType", purl.mime_type), purl.target)
+    if purl.desktop_file:
+        memo[key] = (purl.desktop_file, stage, get_match_rule(stage,
+            purl.mime_type, purl.target, purl.desktop_file))
+    if key not in memo:
+        memo[key] = get_desktop_file_for_mime(purl.mime_type,
+                file_name=purl.target, with_match=True)
+    desktop_file, record["stage"], record["rule"] = memo[key]
+    if not desktop_file:
+        record["error"] = "no desktop file"
+        return record
+    record["desktop_file"] = desktop_file.file_name
+
+    purl.desktop_file = desktop_file
+    exec_str = get_prepared_exec_str(purl, [purl], create_rc_file=False)
+    try:
+        record["argv"] = shlex.split(exec_str)
+    except ValueError as e:
+        record["error"] = "invalid exec string '{}': {}".format(exec_str, e)
+    return record
+
+
+def resolve(urls=None):
+    """Writes how each URL would be opened as JSON Lines to stdout.
+
+    Nothing is launched. One JSON object per URL is written, see
+    resolve_url(). URLs are read from stdin, one per line, if none are given.
+    Records are written as URLs are resolved, so this works as a streaming
+    classifier for large numbers of files.
+
+    Parameters:
+        urls: [str]/None. URLs to resolve.
+
+    Returns:
+        int. 0 if all URLs were resolved nonzero value if not.
+    """
+    if not urls:
+        urls = ( line.rstrip("\n") for line in sys.stdin )
+    memo = {}
+    status = 0
+    for url in urls:
+        if not url:
+            continue
+        record = resolve_url(url, memo)
+        if record["error"]:
+            status = 1
+        sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
+    return status
 
 
 def xdg_open(urls=None, dryrun=False, print_found=False):
@@ -759,83 +4430,234 @@ def xdg_open(urls=None, dryrun=False, print_found=False):
         int. 0 if everything ok nonzero value if not.
     """
     log = logging.getLogger(__name__)
-    def group_purls(purls):
-        """Groups purls with same desktop_file together.
-
-        The sameness is determined by desktop files name.
-
-        Returns:
-            [[URL]].
-        """
-        purls.sort(key=lambda k: k.desktop_file.file_name)
-        grouped_purls = []
-        group = []
-        store = False
-        for i in range(0, len(purls)):
-            if store:
-                store = False
-                grouped_purls.append(group)
-                group = []
-            group.append(purls[i])
-            if (i+1 >= len(purls) or
-                    purls[i].desktop_file.file_name !=
-                        purls[i+1].desktop_file.file_name):
-                store = True
-        if group:
-            grouped_purls.append(group)
-        log.debug("Formed {} URL groups.".format(len(grouped_purls)))
-        return grouped_purls
-
-    log.info("Got urls: '{}'".format(urls))
+    log.info("Got urls: '%s'", urls)
+    log.info("Desktop file paths: %s", CONFIG["desktop_file_paths"])
+    start_latency_budget()
+    # Per URL messages are checked once, the loop runs for every URL in bulk
+    log_urls = log.isEnabledFor(logging.INFO)
 
     # 1. Create URL objects
     # 2. Find related .desktop files, one per URL object.
     error_opening_url = False
     purls = []
     for url in urls:
-        purl = URL(url)
-        log.info("'{}' protocol was: '{}'".format(purl.url, purl.protocol))
-        log.info("'{}' target was: '{}'".format(purl.url, purl.target))
-        log.info("'{}' mime type was: '{}'".format(purl.url, purl.mime_type))
+        count_stat("urls")
+        with timed_stat("url"):
+            purl, stage = get_scheme_handler_url(url) if not print_found \
+                    else (None, None)
+            if not purl:
+                purl = URL(url)
+        if purl.desktop_file:
+            if log_urls:
+                log.info("'%s' scheme handler was: '%s' [%s]", purl.url,
+                    purl.desktop_file.file_name, stage)
+            purls.append(purl)
+            continue
+        if log_urls:
+            log.info("'%s' protocol was: '%s'", purl.url, purl.protocol)
+            log.info("'%s' target was: '%s'", purl.url, purl.target)
+            log.info("'%s' mime type was: '%s'", purl.url, purl.mime_type)
 
         if purl.mime_type:
             # Find .desktop file handling the URLs mime_type
-            log.info(CONFIG["desktop_file_paths"])
-            desktop_file = get_desktop_file(
-                    ("MimeType", purl.mime_type),
+            desktop_file = get_desktop_file_for_mime(
+                    purl.mime_type,
                     file_name=purl.target,
                     print_found=print_found)
             if not desktop_file:
                 log.error("Could not find .desktop file"
-                        " associated with mime type '{}'"
-                        .format(purl.mime_type))
+                        " associated with mime type '%s'",
+                        purl.mime_type)
                 error_opening_url = True
                 continue
         else:
-            log.error("Could not get mime type for the given url: '{}'"
-                    .format(purl.url))
+            log.error("Could not get mime type for the given url: '%s'",
+                    purl.url)
             error_opening_url = True
             continue
         purl.desktop_file = desktop_file
-        log.info("Found desktop file '{}'".format(desktop_file.file_name))
+        if log_urls:
+            log.info("Found desktop file '%s'", desktop_file.file_name)
         #log.debug(str(desktop_file))
         purls.append(purl)
 
     # Group URLs with same desktop_file
-    grouped_purls = group_purls(purls)
-    log.debug("Grouped purls: {}".format(str(grouped_purls)))
-
     # TODO: Are there any other possible actions, beside running exec?
     # Run exec should have all URLs with same desktop_file
-    for purls in grouped_purls: # for every group / list of purls
-        run_exec(purls, dryrun=dryrun)
+    for group in group_purls(purls): # for every group / list of purls
+        run_exec(group, dryrun=dryrun)
+
+    # Programs are launched, now there's time to build the index for the next
+    # time if latency budget prevented it
+    if LATENCY_DEADLINE is not None:
+        get_desktop_file_index()
 
     return 0 if not error_opening_url else 1
 
 
+def scandir_files(top):
+    """Generates paths of regular files under the given directory tree.
+
+    Directories are read with os.scandir() one at a time, so only paths of
+    not yet visited directories are kept in memory. Hidden files and
+    directories are skipped.
+
+    Parameters:
+        top: str. Root directory of the tree.
+    """
+    log = logging.getLogger(__name__)
+    dir_stack = [top]
+    while dir_stack:
+        try:
+            entries = os.scandir(dir_stack.pop())
+        except OSError as e:
+            log.warn("Could not read directory: {}".format(e))
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dir_stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path
+                except OSError:
+                    continue
+
+
+def browse_dir(path=".", dryrun=False):
+    """Groups files in a directory tree by their desktop files.
+
+    Works as a streaming pipeline: files are found with scandir_files(), their
+    mime types are detected in parallel worker threads and each file is added
+    to the group of its resolved desktop file as soon as it's classified.
+    Groups are printed while they fill up. Grouped paths are spooled to
+    temporary files so memory use stays flat regardless of the tree size.
+
+    When classification is done and stdin is a terminal, user is prompted to
+    select a group which files are then opened.
+
+    Parameters:
+        path: str. Root directory of the tree to browse.
+        dryrun: bool. Don't actually evaluate exec value/command.
+
+    Returns:
+        int. 0 if everything ok nonzero value if not.
+    """
+    log = logging.getLogger(__name__)
+
+    class Group(object):
+        """Files sharing one desktop file."""
+        def __init__(self, number, desktop_file):
+            self.number = number
+            self.desktop_file = desktop_file
+            self.count = 0
+            self.spool = tempfile.TemporaryFile(mode="w+", encoding="utf-8",
+                    errors="surrogateescape")
+        def name(self):
+            return self.desktop_file.file_name if self.desktop_file else \
+                    "(no desktop file)"
+
+    def detect(file_path):
+        try:
+            return file_path, URL(file_path, protocol="file",
+                    target=file_path).get_mimetype()
+        except OSError as e:
+            log.warn("Could not detect mime type of '%s': %s", file_path, e)
+            return None
+
+    path = os.path.realpath(path)
+    if not os.path.isdir(path):
+        log.error("Not a directory: '{}'".format(path))
+        return 1
+
+    # (mime type, file extension) -> Group, file extension is in the key as
+    # custom searches can match by it.
+    mime_groups = {}
+    # desktop file name -> Group
+    groups = OrderedDict()
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) \
+            as executor:
+        # Bounded window of pending detections keeps the memory flat and the
+        # output in scandir order.
+        pending = deque()
+        files = scandir_files(path)
+        while True:
+            for file_path in files:
+                pending.append(executor.submit(detect, file_path))
+                if len(pending) >= workers * 4:
+                    break
+            if not pending:
+                break
+            detected = pending.popleft().result()
+            if not detected:
+                continue
+            file_path, mime_type = detected
+
+            key = (mime_type, os.path.splitext(file_path)[1])
+            group = mime_groups.get(key)
+            if not group:
+                desktop_file = get_desktop_file_for_mime(mime_type,
+                        file_name=file_path) if mime_type else None
+                group_name = desktop_file.file_name if desktop_file else None
+                group = groups.get(group_name)
+                if not group:
+                    group = Group(len(groups) + 1, desktop_file)
+                    groups[group_name] = group
+                    print("[{}] {}".format(group.number, group.name()))
+                mime_groups[key] = group
+            group.count += 1
+            group.spool.write("{}\0{}\0".format(mime_type or "", file_path))
+            log.debug("  [%s] %s", group.number, file_path)
+
+    if not groups:
+        print("No files found.")
+        return 0
+
+    print()
+    for group in groups.values():
+        print("[{}] {} ({} files)".format(group.number, group.name(),
+            group.count))
+
+    if not sys.stdin.isatty():
+        return 0
+
+    try:
+        choice = input("Open group [1-{}, empty to quit]: ".format(
+            len(groups)))
+    except EOFError:
+        return 0
+    if not choice.strip():
+        return 0
+    try:
+        number = int(choice)
+    except ValueError:
+        number = 0
+    if not 1 <= number <= len(groups):
+        log.error("Invalid group: '{}'".format(choice))
+        return 1
+    group = list(groups.values())[number - 1]
+    if not group.desktop_file:
+        log.error("Group has no desktop file to open files with.")
+        return 1
+
+    group.spool.seek(0)
+    fields = group.spool.read().split("\0")
+    purls = []
+    for i in range(0, len(fields) - 1, 2):
+        purl = URL(fields[i+1], protocol="file", target=fields[i+1],
+                mime_type=fields[i])
+        purl.desktop_file = group.desktop_file
+        purls.append(purl)
+    run_exec(purls, dryrun=dryrun)
+    return 0
+
+
 def nrwalk(top, mindepth=0, maxdepth=sys.maxsize,
          dirfilter=None, filefilter=None,
-         topdown=True, onerror=None, followlinks=False):
+         topdown=True, onerror=None, followlinks=False, listdir=None):
     """Non-recursive directory tree generator.
 
     This is from pyworlib python utility lib, Copyright (C) Esa Määttä 2011,
@@ -861,8 +4683,27 @@ def nrwalk(top, mindepth=0, maxdepth=sys.maxsize,
         topdown: bool. See os.walk().
         onerror: func. See os.walk().
         followlinks: bool. See os.walk().
+        listdir: ([str], [str]) func(str). If given, returns subdirectory and
+            file names of a directory instead of listing and classifying them
+            with os.listdir() and os.path.isdir(). Can be used to reuse
+            listings of unchanged directories.
     """
     def process_dir(root):
+        if listdir:
+            dirs, nondirs = listdir(root)
+        else:
+            dirs, nondirs = list_dir(root)
+
+        # Filter nondirs with filefilter and dirs with dirfilter, if filter
+        # returns True for a file # then the file is filtered away
+        if dirfilter:
+            dirs = [ x for x in dirs if not dirfilter(x, root) ]
+        if filefilter:
+            nondirs = [ x for x in nondirs if not filefilter(x, root) ]
+
+        return dirs, nondirs
+
+    def list_dir(root):
         try:
             names = os.listdir(root)
         except os.error as err:
@@ -876,17 +4717,9 @@ def nrwalk(top, mindepth=0, maxdepth=sys.maxsize,
                 dirs.append(name)
             else:
                 nondirs.append(name)
-
-        # Filter nondirs with filefilter and dirs with dirfilter, if filter
-        # returns True for a file # then the file is filtered away
-        if dirfilter:
-            dirs = [ x for x in dirs if not dirfilter(x, root) ]
-        if filefilter:
-            nondirs = [ x for x in nondirs if not filefilter(x, root) ]
-
         return dirs, nondirs
 
-    islink, join, isdir = os.path.islink, os.path.join, os.path.isdir
+    join, isdir = os.path.join, os.path.isdir
 
     Dir_node = namedtuple('Dir_node', [ 'root', 'dirs', 'nondirs' ])
     travelsal_stack = list()
@@ -922,6 +4755,42 @@ def parse_comma_sep_list(csl_str):
     return sl
 
 
+def parse_bool(bool_str):
+    """Parses boolean config value string to a bool.
+
+    Accepts same values as configparser, e.g. "yes", "true", "on" and "1".
+
+    Parameters:
+        bool_str: str. Boolean as a string.
+    """
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[bool_str.strip().lower()]
+    except KeyError:
+        raise ValueError("Not a boolean: '{}'".format(bool_str))
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats log records as JSON objects, one per line.
+
+    The message is formatted as usual and its arguments are also given as a
+    list, so that e.g. URLs can be picked from the log without parsing the
+    message.
+    """
+    def format(self, record):
+        fields = OrderedDict([
+            ("time", record.created),
+            ("level", record.levelname),
+            ("function", record.funcName),
+            ("line", record.lineno),
+            ("message", record.getMessage()),
+            ("args", list(record.args)
+                if isinstance(record.args, tuple) else [record.args]),
+            ])
+        if record.exc_info:
+            fields["exception"] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=str)
+
+
 def process_cmd_line(inputs=sys.argv[1:], parent_parsers=list(),
         namespace=None):
     """Processes command line arguments.
@@ -1020,6 +4889,14 @@ def process_cmd_line(inputs=sys.argv[1:], parent_parsers=list(),
         dest='verbose',
         help="Be more quiet, negatively affects verbosity level.")
 
+    parser.add_argument(
+        '--log-format',
+        choices=["text", "json"],
+        default="text",
+        help="Format of log messages. With json, each message is a JSON "
+             "object on its own line with the message arguments as a "
+             "separate list.")
+
     parser.add_argument(
         '-c', '--config-file',
         type=str,
@@ -1045,13 +4922,86 @@ def process_cmd_line(inputs=sys.argv[1:], parent_parsers=list(),
         action=Print_default_config_action,
         help="Print default config used and exit.")
 
+    parser.add_argument(
+        '--max-latency',
+        type=int,
+        default=None,
+        metavar='MS',
+        help="Latency budget in milliseconds. Once spent, expensive desktop "
+             "file searches and mime type probes are skipped and the best "
+             "desktop file found so far is used. Overrides config option "
+             "max_latency.")
+
+    parser.add_argument(
+        '--coalesce',
+        type=int,
+        default=None,
+        metavar='MS',
+        help="Coalescing window in milliseconds. URLs of invocations "
+             "started within the window are opened together by the first "
+             "one. Overrides config option coalesce_window.")
+
+    parser.add_argument(
+        '--dir',
+        nargs='?',
+        const='.',
+        default=None,
+        metavar='PATH',
+        help="Group files under PATH (default: current directory) by their "
+             "desktop files and prompt which group to open.")
+
+    parser.add_argument(
+        '--resolve',
+        default=False,
+        action='store_true',
+        help="Don't open anything, write how each URL would be opened as "
+             "JSON Lines instead. URLs are read from stdin, one per line, "
+             "if none are given.")
+
+    parser.add_argument(
+        '--forkserver',
+        default=False,
+        action='store_true',
+        help="Run a resident launcher which starts programs for other "
+             "invocations, so they start in a new session without "
+             "forking pyxdg-open. Invocations start programs themselves "
+             "if it's not running.")
+
+    parser.add_argument(
+        '--stats',
+        default=False,
+        action='store_true',
+        help="Write resolver metrics (cache hits, full scans, parsed desktop "
+             "files, spawns and stage latencies) to stderr in Prometheus "
+             "text format when done.")
+
+    parser.add_argument(
+        '--build-cache',
+        default=False,
+        action='store_true',
+        help="Build all caches ahead of time and exit. Meant to be run "
+             "from package manager hooks, as root caches are built to {} "
+             "for all users.".format(SYSTEM_CACHE_DIR))
+
+    parser.add_argument(
+        '--verify-cache',
+        default=False,
+        action='store_true',
+        help="Check that all caches are built and up to date and exit. "
+             "Exit status is nonzero if not.")
+
     parser.add_argument(
         'urls',
-        nargs='+',
+        nargs='*',
         metavar='URL',
         help='Positional argument.')
 
-    return parser.parse_args(inputs)
+    args = parser.parse_args(inputs)
+    if not args.urls and args.dir is None and not args.build_cache and \
+            not args.verify_cache and not args.resolve and \
+            not args.forkserver:
+        parser.error("the following arguments are required: URL")
+    return args
 
 
 def read_config_options(config_file_path):
@@ -1087,7 +5037,8 @@ def read_config_options(config_file_path):
         opts[opt_name] = opt if not proc_func else proc_func(opt)
     base_config_name = "BASE43rfdf03jjdf"
 
-    config = configparser.ConfigParser()
+    # No interpolation, custom search exec strings have '%' field codes
+    config = configparser.ConfigParser(interpolation=None)
 
     config_file_path = os.path.expanduser(config_file_path)
 
@@ -1103,6 +5054,15 @@ def read_config_options(config_file_path):
     store_opt(options_dict, "desktop_file_paths", parse_comma_sep_list)
     store_opt(options_dict, "default_terminal_emulator")
     store_opt(options_dict, "search_order", parse_comma_sep_list)
+    store_opt(options_dict, "http_probe", parse_bool)
+    store_opt(options_dict, "http_probe_timeout", float)
+    store_opt(options_dict, "http_probe_cache_ttl", float)
+    store_opt(options_dict, "max_latency", int)
+    store_opt(options_dict, "scan_workers", int)
+    store_opt(options_dict, "check_try_exec", parse_bool)
+    store_opt(options_dict, "coalesce_window", int)
+    store_opt(options_dict, "fs_deadline", int)
+    store_opt(options_dict, "stats_file")
 
     # Read custom searchs from config file
     options_dict["custom_searchs"] = {}
@@ -1114,12 +5074,141 @@ def read_config_options(config_file_path):
     return options_dict
 
 
+def get_config_stamp(config_file_path):
+    """Returns a stamp which changes when the config file or defaults change.
+    """
+    config_file_path = os.path.expanduser(config_file_path)
+    try:
+        st = os.stat(config_file_path)
+        file_stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        file_stamp = None
+    return (config_file_path, file_stamp, list(DEFAULT_CONFIG.items()))
+
+
+def load_config_options(config_file_path):
+    """Returns config options, compiled options are cached.
+
+    Options are read with read_config_options() only if the config file has
+    changed since they were cached.
+
+    Parameters:
+        config_file_path: str. Path of a config file.
+
+    Returns:
+        dict. See read_config_options().
+    """
+    stamp = get_config_stamp(config_file_path)
+    return load_or_build_cache("config.pickle",
+            lambda cached: cached["stamp"] == stamp,
+            lambda: {"stamp": stamp,
+                "options": read_config_options(config_file_path)})["options"]
+
+
+def build_cache():
+    """Builds all cached data structures ahead of time.
+
+    Builds the desktop file index, with desktop files missing from the
+    desktop file cache parsed in a process pool, the scheme handler table, the
+    mime type hierarchy and the file extension table.
+    Config is compiled already when it's loaded. Meant for package manager
+    hooks, so that the first open after an upgrade doesn't pay for these.
+    Hooks run as root, so then caches are built to SYSTEM_CACHE_DIR, from
+    which users take what's fresh for them, see load_system_cache() and
+    load_path_keyed_cache().
+
+    Returns:
+        int. 0 if everything ok nonzero value if not.
+    """
+    global CACHE_DIR
+    if os.geteuid() == 0:
+        CACHE_DIR = SYSTEM_CACHE_DIR
+    start = time.monotonic()
+    aliases, ancestors = get_mime_hierarchy()
+    case_sensitive, folded = get_mime_extensions()
+    with cache_lock("index.bin"):
+        index = build_mapped_index()
+        ok = store_mapped_index("index.bin", index)
+    for path in get_path_dirs():
+        get_path_dir_executables(path)
+    store_path_index()
+    handlers = get_scheme_handlers(rebuild=True)
+    store_desktop_file_cache()
+    print("Built cache in {:.0f} ms: {} desktop files, {} mime types, "
+            "{} list file mime types, {} scheme handlers, "
+            "{} mime types with parents, {} file extensions".format(
+                (time.monotonic() - start) * 1000, index.counts["I"],
+                index.counts["M"], index.counts["L"], len(handlers),
+                len(ancestors), len(case_sensitive) + len(folded)))
+    return 0 if ok else 1
+
+
+def verify_cache(config_file_path):
+    """Checks that all cached data structures exist and are up to date.
+
+    Prints status of each cache.
+
+    Parameters:
+        config_file_path: str. Path of the config file in use.
+
+    Returns:
+        int. 0 if all caches are up to date, 1 if not.
+    """
+    def report(name, ok, detail):
+        print("{:<16} {:<6} {}".format(name, "ok" if ok else "STALE", detail))
+        return ok
+
+    results = []
+    cached = load_cache("config.pickle")
+    results.append(report("config", cached and
+        cached["stamp"] == get_config_stamp(config_file_path),
+        "compiled config"))
+
+    cached = load_cache("mime_hierarchy.pickle")
+    results.append(report("mime_hierarchy", cached and
+        cached["sources"] == get_mime_hierarchy_sources(),
+        "shared-mime-info aliases and subclasses"))
+
+    cached = load_cache("mime_extensions.pickle")
+    results.append(report("mime_extensions", cached and
+        cached["sources"] == get_mime_extension_sources(),
+        "mime.types and shared-mime-info globs"))
+
+    index = load_mapped_index("index.bin")
+    results.append(report("index", index and
+        index.generation == get_index_generation(),
+        "{} desktop files".format(index.counts["I"] if index else 0)))
+
+    cached = load_cache("schemes.pickle")
+    results.append(report("schemes", cached and
+        cached["stamp"] == get_scheme_handlers_stamp(),
+        "{} scheme handlers".format(len(cached["handlers"]) if cached
+            else 0)))
+
+    desktop_fns = set(index.values("ids")) if index else set()
+    cache = load_cache("desktop_files.pickle", {})
+    stale = 0
+    for desktop_fn in desktop_fns:
+        cached = cache.get(desktop_fn)
+        try:
+            st = os.stat(desktop_fn)
+        except OSError:
+            stale += 1
+            continue
+        if not is_desktop_file_cached(cached, st):
+            stale += 1
+    results.append(report("desktop_files", index and not stale,
+        "{} of {} indexed desktop files stale".format(stale,
+            len(desktop_fns))))
+
+    return 0 if all(results) else 1
+
+
 def main():
     """
     Main entry to the program when used from command line. Registers default
     signals and processes command line arguments from sys.argv.
     """
-    import signal
     import wor.utils
 
     def term_sig_handler(signum, frame):
@@ -1140,24 +5229,73 @@ def main():
         else:
             args.verbose = 0
 
-    # Init module level logger with given verbosity level
-    lformat = '%(levelname)s:%(funcName)s:%(lineno)s: %(message)s'
+    # Init module level logger with given verbosity level. Messages are
+    # formatted lazily, so disabled levels cost only the level check.
+    handler = logging.StreamHandler()
+    if args.log_format == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        lformat = '%(levelname)s:%(funcName)s:%(lineno)s: %(message)s'
+        handler.setFormatter(logging.Formatter(lformat))
     logging.basicConfig(
             level=wor.utils.convert_int_to_logging_level(args.verbose),
-            format=lformat)
+            handlers=[handler])
 
     global CONFIG
-    CONFIG = read_config_options(args.config_file)
+    # Verifying must not compile config before checking it
+    if args.verify_cache:
+        CONFIG = read_config_options(args.config_file)
+    else:
+        CONFIG = load_config_options(args.config_file)
 
+    if args.max_latency is not None:
+        CONFIG["max_latency"] = args.max_latency
+    if args.coalesce is not None:
+        CONFIG["coalesce_window"] = args.coalesce
+    count_stat("invocations")
+
+    config_file = args.config_file
+    show_stats = args.stats
     del args.config_file
     del args.verbose
+    del args.log_format
+    del args.max_latency
+    del args.coalesce
+    del args.stats
 
-    # Init mimetypes
+    # Init magic, file extensions are read from get_mime_extensions() and
+    # mimetypes is initialized on first use for other URLs
     global MM
-    global MT
     if HAS_MAGIC:
         MM = magic.open(magic.MIME_TYPE)
         MM.load()
-    MT.init()
 
-    return xdg_open(**args.__dict__)
+    if args.verify_cache:
+        return verify_cache(config_file)
+    elif args.forkserver:
+        return forkserver()
+    elif args.build_cache:
+        status = build_cache()
+    elif args.resolve:
+        status = resolve(args.urls)
+    elif args.dir is not None:
+        status = browse_dir(args.dir, dryrun=args.dryrun)
+    else:
+        del args.dir
+        del args.forkserver
+        del args.build_cache
+        del args.verify_cache
+        del args.resolve
+        if CONFIG.get("coalesce_window", 0) > 0 and not args.print_found:
+            args.urls = coalesce_urls(args.urls,
+                    CONFIG["coalesce_window"] / 1000, dryrun=args.dryrun)
+        # URLs were handed over to another invocation if None
+        status = xdg_open(**args.__dict__) if args.urls is not None else 0
+    store_desktop_file_cache()
+    store_path_index()
+    store_http_probe_cache()
+    if show_stats:
+        sys.stderr.write(format_stats(get_stats_samples()))
+    if CONFIG["stats_file"]:
+        write_stats_file(CONFIG["stats_file"])
+    return status
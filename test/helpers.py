@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Helpers for tests running pyxdg-open in a new process."""
+
+import subprocess
+import sys
+
+
+# Python code running pyxdg-open with the arguments after it
+RUN_MAIN = "import sys, wor.xdg_open as xo; sys.exit(xo.main())"
+
+
+def main_argv(*args):
+    """Returns argv which runs pyxdg-open with the given arguments."""
+    return [sys.executable, "-c", RUN_MAIN] + list(args)
+
+
+def run_main(*args, **kwargs):
+    """Runs pyxdg-open with the given arguments and waits for it to exit.
+
+    Parameters:
+        args: str. Command line arguments.
+        kwargs: Keyword arguments of subprocess.run(). By default stdout and
+            stderr are captured as text.
+
+    Returns:
+        subprocess.CompletedProcess.
+    """
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    kwargs.setdefault("stderr", subprocess.PIPE)
+    kwargs.setdefault("universal_newlines", True)
+    return subprocess.run(main_argv(*args), **kwargs)
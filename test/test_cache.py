@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests cache files against corruption and concurrent processes."""
+
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+import wor.xdg_open as xo
+
+from helpers import run_main
+
+
+def build_slowly(builds_fn):
+    """Cache build which takes a while and records each call."""
+    with open(builds_fn, "a") as f:
+        f.write("build\n")
+    time.sleep(0.2)
+    return {"value": 42}
+
+
+def load_or_build(builds_fn, results):
+    data = xo.load_or_build_cache("slow.pickle", lambda data: True,
+            lambda: build_slowly(builds_fn))
+    results.put(data)
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old_env = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = self.tmp.name
+        self.old_timeout = xo.CACHE_LOCK_TIMEOUT
+        self.cache_dir = xo.get_cache_dir()
+
+    def tearDown(self):
+        xo.CACHE_LOCK_TIMEOUT = self.old_timeout
+        if self.old_env is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.old_env
+        self.tmp.cleanup()
+
+    def corrupt(self, cache_name, func):
+        cache_fn = os.path.join(self.cache_dir, cache_name)
+        with open(cache_fn, "rb") as f:
+            data = f.read()
+        with open(cache_fn, "wb") as f:
+            f.write(func(data))
+
+    def test_store_and_load(self):
+        self.assertTrue(xo.store_cache("test.pickle", {"a": [1, 2]}))
+        self.assertEqual(xo.load_cache("test.pickle"), {"a": [1, 2]})
+        self.assertEqual(xo.load_cache("missing.pickle", {}), {})
+
+    def test_corrupted_cache_is_ignored(self):
+        header_size = xo.CACHE_HEADER.size
+        corruptions = [
+            lambda data: b"",
+            lambda data: data[:header_size // 2],
+            lambda data: data[:-3],
+            lambda data: data[:-1] + bytes([data[-1] ^ 0xff]),
+            lambda data: b"garbage" * 20,
+            lambda data: xo.CACHE_HEADER.pack(xo.CACHE_MAGIC,
+                xo.CACHE_VERSION + 1, b"\0" * 32) + data[header_size:],
+            ]
+        for corruption in corruptions:
+            xo.store_cache("test.pickle", {"a": 1})
+            self.corrupt("test.pickle", corruption)
+            self.assertEqual(xo.load_cache("test.pickle", "default"),
+                    "default")
+
+    def test_corrupted_index_is_ignored(self):
+        index = {"generation": "0" * 40, "ids": {"a.desktop": "/a.desktop"},
+                "MimeType": {"text/plain": ["/a.desktop"]},
+                "Categories": {}, "lists": {}}
+        xo.store_mapped_index("index.bin", xo.MappedIndex.from_index(index))
+        self.assertEqual(xo.load_mapped_index("index.bin").lookup(
+            "MimeType", "text/plain"), ["/a.desktop"])
+        self.corrupt("index.bin", lambda data: data[:-5])
+        self.assertIsNone(xo.load_mapped_index("index.bin"))
+        self.corrupt("index.bin", lambda data: b"\0" * 100)
+        self.assertIsNone(xo.load_mapped_index("index.bin"))
+
+    def test_run_with_corrupted_caches(self):
+        root = self.tmp.name
+        apps = os.path.join(root, "applications")
+        os.mkdir(apps)
+        with open(os.path.join(apps, "editor.desktop"), "w") as f:
+            f.write("[Desktop Entry]\nType=Application\nName=Editor\n"
+                    "Exec=editor %f\nMimeType=text/plain;\n")
+        config_fn = os.path.join(root, "pyxdg-open.conf")
+        with open(config_fn, "w") as f:
+            f.write("desktop_file_paths = {}\n"
+                    "check_try_exec = false\n".format(apps))
+        text_fn = os.path.join(root, "notes.txt")
+        with open(text_fn, "w") as f:
+            f.write("notes\n")
+        def run():
+            p = run_main("-c", config_fn, "-v", "1", "--dryrun", text_fn)
+            self.assertEqual(p.returncode, 0, p.stderr)
+            self.assertIn("Calling exec string: editor ", p.stderr)
+
+        run()
+        cache_names = [ name for name in os.listdir(self.cache_dir)
+                if not name.endswith(".lock") ]
+        self.assertIn("index.bin", cache_names)
+        for name in cache_names:
+            self.corrupt(name, lambda data: data[:len(data) // 2])
+        run()
+        for name in cache_names:
+            self.corrupt(name, lambda data: b"\xff" * 64)
+        run()
+
+    def test_locked_cache_falls_back(self):
+        xo.CACHE_LOCK_TIMEOUT = 0.1
+        with xo.cache_lock("test.pickle") as locked:
+            self.assertTrue(locked)
+            self.assertEqual(xo.load_or_build_cache("test.pickle",
+                lambda data: True, lambda: "built", lambda: "fallback"),
+                "fallback")
+            self.assertIsNone(xo.update_cache("test.pickle",
+                lambda data: "updated"))
+        self.assertIsNone(xo.load_cache("test.pickle"))
+        self.assertEqual(xo.load_or_build_cache("test.pickle",
+            lambda data: True, lambda: "built", lambda: "fallback"),
+            "built")
+        self.assertEqual(xo.load_cache("test.pickle"), "built")
+
+    def test_concurrent_build_runs_once(self):
+        builds_fn = os.path.join(self.tmp.name, "builds")
+        results = multiprocessing.Queue()
+        procs = [ multiprocessing.Process(target=load_or_build,
+            args=(builds_fn, results)) for _ in range(8) ]
+        for p in procs:
+            p.start()
+        values = [ results.get(timeout=10) for _ in procs ]
+        for p in procs:
+            p.join()
+        self.assertEqual(values, [{"value": 42}] * len(procs))
+        with open(builds_fn) as f:
+            self.assertEqual(f.read(), "build\n")
+
+    def test_concurrent_updates_are_merged(self):
+        procs = [ multiprocessing.Process(target=xo.update_cache,
+            args=("merged.pickle", lambda data, i=i: data | {i}, set()))
+            for i in range(8) ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        self.assertEqual(xo.load_cache("merged.pickle"), set(range(8)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests that only invocations with the same settings are coalesced."""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import wor.xdg_open as xo
+
+
+WINDOW = 0.5
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old_state = (os.environ.get("XDG_RUNTIME_DIR"), xo.CONFIG)
+        os.environ["XDG_RUNTIME_DIR"] = self.tmp.name
+        xo.CONFIG = xo.read_config_options(os.path.join(self.tmp.name,
+            "none.conf"))
+
+    def tearDown(self):
+        runtime_dir, xo.CONFIG = self.old_state
+        if runtime_dir is None:
+            os.environ.pop("XDG_RUNTIME_DIR", None)
+        else:
+            os.environ["XDG_RUNTIME_DIR"] = runtime_dir
+        self.tmp.cleanup()
+
+    def start_leader(self, urls):
+        """Runs coalesce_urls() on a thread, waits until it listens."""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            xo.coalesce_urls(urls, WINDOW)))
+        thread.start()
+        sock_fn = os.path.join(xo.get_runtime_dir(), "coalesce-{}.sock"
+                .format(xo.get_coalesce_key()))
+        for _ in range(100):
+            if os.path.exists(sock_fn):
+                break
+            time.sleep(0.005)
+        return thread, result
+
+    def test_key_follows_settings(self):
+        key = xo.get_coalesce_key()
+        self.assertEqual(xo.get_coalesce_key(), key)
+        self.assertNotEqual(xo.get_coalesce_key(dryrun=True), key)
+        old_display = os.environ.get("DISPLAY")
+        os.environ["DISPLAY"] = ":4095"
+        try:
+            self.assertNotEqual(xo.get_coalesce_key(), key)
+        finally:
+            if old_display is None:
+                del os.environ["DISPLAY"]
+            else:
+                os.environ["DISPLAY"] = old_display
+        xo.CONFIG["check_try_exec"] = not xo.CONFIG["check_try_exec"]
+        self.assertNotEqual(xo.get_coalesce_key(), key)
+
+    def test_same_settings_are_coalesced(self):
+        thread, result = self.start_leader(["/a"])
+        self.assertIsNone(xo.coalesce_urls(["/b"], WINDOW))
+        thread.join()
+        self.assertEqual(result, [["/a", "/b"]])
+
+    def test_different_settings_are_not_coalesced(self):
+        thread, result = self.start_leader(["/a"])
+        self.assertEqual(xo.coalesce_urls(["/b"], WINDOW, dryrun=True),
+                ["/b"])
+        thread.join()
+        self.assertEqual(result, [["/a"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests the environment of programs started by forkserver."""
+
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+
+from helpers import main_argv, run_main
+
+
+class ForkserverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        apps = os.path.join(root, "applications")
+        os.mkdir(apps)
+        self.env_fn = os.path.join(root, "env.out")
+        dump_env = os.path.join(root, "dump_env")
+        with open(dump_env, "w") as f:
+            f.write("#!/bin/sh\nenv > {}.tmp && mv {}.tmp {}\n".format(
+                self.env_fn, self.env_fn, self.env_fn))
+        os.chmod(dump_env, 0o755)
+        with open(os.path.join(apps, "dump.desktop"), "w") as f:
+            f.write("[Desktop Entry]\nType=Application\nName=Dump\n"
+                    "Exec={} %f\nMimeType=text/plain;\n".format(dump_env))
+        self.config_fn = os.path.join(root, "pyxdg-open.conf")
+        with open(self.config_fn, "w") as f:
+            f.write("desktop_file_paths = {}\n"
+                    "check_try_exec = false\n".format(apps))
+        self.text_fn = os.path.join(root, "notes.txt")
+        with open(self.text_fn, "w") as f:
+            f.write("notes\n")
+        self.env = dict(os.environ,
+                XDG_CACHE_HOME=os.path.join(root, "cache"),
+                XDG_RUNTIME_DIR=os.path.join(root, "run"))
+        self.server = subprocess.Popen(main_argv("-c", self.config_fn,
+            "--forkserver"),
+            env=dict(self.env, PYXDG_TEST_SERVER="server",
+                LC_PYXDG_TEST="server"))
+        sock_fn = os.path.join(root, "run", "pyxdg-open", "forkserver.sock")
+        for _ in range(100):
+            if os.path.exists(sock_fn):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.server.kill()
+        self.server.wait()
+        self.tmp.cleanup()
+
+    def test_only_allowed_variables_are_passed(self):
+        p = run_main("-c", self.config_fn, "-v", "1", self.text_fn,
+            env=dict(self.env, PYXDG_TEST_CLIENT="client",
+                LC_PYXDG_TEST="client", LD_PRELOAD=""))
+        self.assertEqual(p.returncode, 0, p.stderr)
+        self.assertIn("Forkserver started", p.stderr)
+        for _ in range(100):
+            if os.path.exists(self.env_fn):
+                break
+            time.sleep(0.05)
+        with open(self.env_fn) as f:
+            env = dict(line.rstrip("\n").split("=", 1) for line in f
+                    if "=" in line)
+        self.assertEqual(env.get("LC_PYXDG_TEST"), "client")
+        self.assertEqual(env.get("PYXDG_TEST_SERVER"), "server")
+        self.assertNotIn("PYXDG_TEST_CLIENT", env)
+        self.assertNotIn("LD_PRELOAD", env)
+        self.assertEqual(env.get("XDG_CACHE_HOME"),
+                self.env["XDG_CACHE_HOME"])
+
+
+if __name__ == '__main__':
+    unittest.main()
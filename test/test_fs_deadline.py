@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests fs_deadline fallback to file extensions for hung mounts."""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import wor.xdg_open as xo
+
+
+FS_DEADLINE = 100
+
+
+class HungFileSystem(xo.FileSystem):
+    """FileSystem of which paths under a hung mount never return."""
+    def __init__(self, mount_points, hung_mount):
+        self.simulated_mount_points = mount_points
+        self.hung_mount = hung_mount
+        self.hung = threading.Event()
+    def simulate(self, path):
+        if path.startswith(self.hung_mount + "/"):
+            self.hung.wait()
+    def realpath(self, path):
+        self.simulate(path)
+        return super().realpath(path)
+    def exists(self, path):
+        self.simulate(path)
+        return super().exists(path)
+    def magic_file(self, path):
+        self.simulate(path)
+        return super().magic_file(path)
+    def mount_points(self):
+        return self.simulated_mount_points
+
+
+class FSDeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        self.old_env = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        self.old_state = (xo.CONFIG, xo.FS, xo.MOUNT_POINTS, xo.SLOW_MOUNTS,
+                dict(xo.STATS_COUNTERS))
+        xo.CONFIG = xo.read_config_options(os.path.join(root, "none.conf"))
+        xo.CONFIG["fs_deadline"] = FS_DEADLINE
+        xo.MOUNT_POINTS = None
+        xo.SLOW_MOUNTS = None
+        xo.STATS_COUNTERS.clear()
+        self.local = os.path.join(root, "local")
+        self.hung = os.path.join(root, "hung")
+        for mount in (self.local, self.hung):
+            os.mkdir(mount)
+            for name in ("a.txt", "b.pdf"):
+                with open(os.path.join(mount, name), "w") as f:
+                    f.write("test\n")
+
+    def tearDown(self):
+        xo.FS.hung.set()
+        (xo.CONFIG, xo.FS, xo.MOUNT_POINTS, xo.SLOW_MOUNTS,
+                stats) = self.old_state
+        xo.STATS_COUNTERS.clear()
+        xo.STATS_COUNTERS.update(stats)
+        if self.old_env is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.old_env
+        self.tmp.cleanup()
+
+    def use_mounts(self, *mount_points):
+        """Uses HungFileSystem with (mount point, device) pairs."""
+        xo.FS = HungFileSystem(list(mount_points), self.hung)
+        xo.MOUNT_POINTS = None
+
+    def timed_url(self, path):
+        start = time.monotonic()
+        purl = xo.URL(path)
+        return purl, (time.monotonic() - start) * 1000
+
+    def timeouts(self):
+        return xo.STATS_COUNTERS.get("fs_timeouts", 0)
+
+    def test_hung_mount_falls_back_to_extension(self):
+        self.use_mounts(("/", os.makedev(4095, 0)),
+                (self.local, os.makedev(4095, 1)),
+                (self.hung, os.makedev(4095, 2)))
+        purl, elapsed = self.timed_url(os.path.join(self.hung, "a.txt"))
+        self.assertEqual(purl.mime_type, "text/plain")
+        self.assertGreaterEqual(elapsed, FS_DEADLINE * 0.9)
+        self.assertLess(elapsed, FS_DEADLINE * 5)
+        self.assertEqual(self.timeouts(), 1)
+
+        # Mount is remembered to be slow, so files on it don't wait
+        purl, elapsed = self.timed_url(os.path.join(self.hung, "b.pdf"))
+        self.assertEqual(purl.mime_type, "application/pdf")
+        self.assertLess(elapsed, FS_DEADLINE / 2)
+        self.assertEqual(self.timeouts(), 1)
+
+        # Also in later runs through the cache directory
+        xo.SLOW_MOUNTS = None
+        self.assertTrue(xo.is_slow_mount(os.path.join(self.hung, "a.txt")))
+
+        # Other mounts are not affected
+        purl = xo.URL(os.path.join(self.local, "a.txt"))
+        self.assertEqual(purl.mime_type, "text/plain")
+        self.assertFalse(xo.is_slow_mount(purl.url))
+        self.assertTrue(xo.run_fs_op(xo.get_fs_deadline(), xo.FS.exists,
+            purl.url))
+        self.assertEqual(self.timeouts(), 1)
+
+    def test_root_is_slow_only_after_repeated_timeouts(self):
+        # Hung directory is not a mount point of its own, as an automount
+        # which is not mounted yet
+        self.use_mounts(("/", os.makedev(4095, 0)))
+        hung_fn = os.path.join(self.hung, "a.txt")
+        local_fn = os.path.join(self.local, "a.txt")
+        with self.assertRaises(TimeoutError):
+            xo.run_fs_op(xo.get_fs_deadline(), xo.FS.exists, hung_fn)
+        self.assertFalse(xo.is_slow_mount(local_fn))
+        self.assertTrue(xo.run_fs_op(xo.get_fs_deadline(), xo.FS.exists,
+            local_fn))
+
+        for _ in range(xo.SLOW_ROOT_TIMEOUTS - 1):
+            with self.assertRaises(TimeoutError):
+                xo.run_fs_op(xo.get_fs_deadline(), xo.FS.exists, hung_fn)
+        self.assertEqual(self.timeouts(), xo.SLOW_ROOT_TIMEOUTS)
+        self.assertTrue(xo.is_slow_mount(local_fn))
+
+
+if __name__ == '__main__':
+    unittest.main()
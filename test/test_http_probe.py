@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests HTTP mime type probes against a local http.server stand-in."""
+
+import http.client
+import http.server
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import wor.xdg_open as xo
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Answers HEAD with Content-Type by path extension, keeping connections
+    alive unless the server is told to drop them silently."""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        self.connection_number = self.server.connections
+
+    def do_HEAD(self):
+        drop = self.server.drop_connections
+        self.server.requests.append((self.command, self.path,
+            self.connection_number))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf; charset=binary"
+                if self.path.endswith(".pdf") else "text/html")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        # Closed without "Connection: close", as idle timeouts do
+        if drop:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def trickle_response(listener, stop):
+    """Answers the first connection one byte of headers at a time."""
+    conn, _ = listener.accept()
+    with conn:
+        conn.recv(4096)
+        for byte in b"HTTP/1.1 200 OK\r\nX-Padding: " + b"x" * 1000:
+            if stop.wait(0.02):
+                break
+            conn.sendall(bytes((byte,)))
+
+
+class HTTPProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                Handler)
+        self.server.requests = []
+        self.server.connections = 0
+        self.server.drop_connections = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.netloc = "127.0.0.1:{}".format(self.server.server_address[1])
+        xo.HTTP_POOL = xo.HTTPConnectionPool()
+
+    def tearDown(self):
+        xo.HTTP_POOL.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def url(self, path):
+        return "http://{}{}".format(self.netloc, path)
+
+    def test_keep_alive_connection_is_reused(self):
+        self.assertEqual(xo.probe_http_mimetype(self.url("/a.pdf"), 5),
+                "application/pdf")
+        self.assertEqual(xo.probe_http_mimetype(self.url("/b.html"), 5),
+                "text/html")
+        self.assertEqual([ r[:2] for r in self.server.requests ],
+                [("HEAD", "/a.pdf"), ("HEAD", "/b.html")])
+        self.assertEqual(self.server.requests[0][2],
+                self.server.requests[1][2])
+
+    def test_retry_after_server_closed_connection(self):
+        self.server.drop_connections = True
+        self.assertEqual(xo.probe_http_mimetype(self.url("/a.pdf"), 5),
+                "application/pdf")
+        self.server.drop_connections = False
+        self.assertEqual(xo.probe_http_mimetype(self.url("/b.pdf"), 5),
+                "application/pdf")
+        self.assertEqual(self.server.requests[-1][1], "/b.pdf")
+        self.assertNotEqual(self.server.requests[0][2],
+                self.server.requests[-1][2])
+
+    def test_retry_uses_new_connection(self):
+        # All pooled connections have been closed by the server
+        self.server.drop_connections = True
+        for path in ("/a", "/b"):
+            conn = http.client.HTTPConnection(self.netloc, timeout=5)
+            conn.request("HEAD", path)
+            conn.getresponse().read()
+            xo.HTTP_POOL.put("http", self.netloc, conn)
+        self.server.drop_connections = False
+        self.assertEqual(xo.probe_http_mimetype(self.url("/c.pdf"), 5),
+                "application/pdf")
+
+    def test_trickling_server_gets_total_timeout(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        stop = threading.Event()
+        thread = threading.Thread(target=trickle_response,
+                args=(listener, stop))
+        thread.start()
+        try:
+            start = time.monotonic()
+            self.assertIsNone(xo.probe_http_mimetype("http://127.0.0.1:{}/"
+                .format(listener.getsockname()[1]), 0.2))
+            self.assertLess(time.monotonic() - start, 0.4)
+        finally:
+            stop.set()
+            thread.join()
+            listener.close()
+
+    def test_results_are_stored_once_at_exit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            old_state = (os.environ.get("XDG_CACHE_HOME"), xo.CONFIG,
+                    xo.HTTP_PROBE_CACHE)
+            os.environ["XDG_CACHE_HOME"] = tmp
+            xo.CONFIG = xo.read_config_options(os.path.join(tmp, "none.conf"))
+            xo.HTTP_PROBE_CACHE = None
+            try:
+                self.assertEqual(xo.get_http_mimetype(self.url("/a.pdf")),
+                        "application/pdf")
+                self.assertEqual(xo.get_http_mimetype(self.url("/b.html")),
+                        "text/html")
+                self.assertEqual(xo.load_cache("http_probe.pickle", {}), {})
+                xo.store_http_probe_cache()
+                stored = xo.load_cache("http_probe.pickle", {})
+                self.assertEqual(sorted(c[1] for c in stored.values()),
+                        ["application/pdf", "text/html"])
+            finally:
+                cache_home, xo.CONFIG, xo.HTTP_PROBE_CACHE = old_state
+                if cache_home is None:
+                    os.environ.pop("XDG_CACHE_HOME", None)
+                else:
+                    os.environ["XDG_CACHE_HOME"] = cache_home
+
+
+if __name__ == '__main__':
+    unittest.main()
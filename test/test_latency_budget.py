@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests opening files with a latency budget and a cold cache."""
+
+import os
+import tempfile
+import unittest
+
+from helpers import run_main
+
+
+class LatencyBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        apps = os.path.join(root, "applications")
+        os.mkdir(apps)
+        for i in range(200):
+            mime_type = "text/plain" if i == 150 \
+                    else "application/x-app{}".format(i)
+            with open(os.path.join(apps, "app{}.desktop".format(i)),
+                    "w") as f:
+                f.write("[Desktop Entry]\nType=Application\nName=App\n"
+                        "Exec=app{} %f\nMimeType={};\n".format(i, mime_type))
+        self.config_fn = os.path.join(root, "pyxdg-open.conf")
+        with open(self.config_fn, "w") as f:
+            f.write("desktop_file_paths = {}\n"
+                    "search_order = list_files, desktop_file_paths\n"
+                    "check_try_exec = false\n".format(apps))
+        self.text_fn = os.path.join(root, "notes.txt")
+        with open(self.text_fn, "w") as f:
+            f.write("notes\n")
+        self.env = dict(os.environ,
+                XDG_CACHE_HOME=os.path.join(root, "cache"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_tiny_budget_with_cold_cache_opens(self):
+        p = run_main("-c", self.config_fn, "-v", "1", "--dryrun",
+                "--max-latency", "1", self.text_fn, env=self.env)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        self.assertIn("Calling exec string: app150 ", p.stderr)
+        # The index is built only after the program is launched
+        self.assertLess(p.stderr.index("Calling exec string"),
+                p.stderr.index("Building desktop file index."))
+
+
+if __name__ == '__main__':
+    unittest.main()
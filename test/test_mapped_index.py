@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests MappedIndex lookups against the dict index it's built from."""
+
+import unittest
+
+import wor.xdg_open as xo
+
+
+INDEX = {
+        "generation": "1" * 40,
+        "ids": {"editor.desktop": "/apps/editor.desktop",
+            "kde-viewer.desktop": "/apps/kde/viewer.desktop"},
+        "MimeType": {"text/plain": ["/apps/editor.desktop",
+            "/apps/kde/viewer.desktop"],
+            "image/png": ["/apps/kde/viewer.desktop"],
+            "text/x-äö": ["/apps/editor.desktop"]},
+        "Categories": {"Utility": ["/apps/editor.desktop"]},
+        "lists": {"text/plain": [("editor.desktop", "/apps/mimeapps.list"),
+            ("kde-viewer.desktop", "/apps/defaults.list")]},
+        }
+
+
+class MappedIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = xo.MappedIndex.from_index(INDEX)
+
+    def test_lookups_match_dict_index(self):
+        for mapping in ("MimeType", "Categories"):
+            for key, values in INDEX[mapping].items():
+                self.assertEqual(self.index.lookup(mapping, key), values)
+        for df_id, path in INDEX["ids"].items():
+            self.assertEqual(self.index.get("ids", df_id), path)
+        self.assertEqual(self.index.get_pairs("lists", "text/plain"),
+                INDEX["lists"]["text/plain"])
+
+    def test_missing_keys(self):
+        self.assertEqual(self.index.lookup("MimeType", "text/html"), [])
+        self.assertIsNone(self.index.get("ids", "missing.desktop"))
+        # Same key in another mapping
+        self.assertEqual(self.index.lookup("Categories", "text/plain"), [])
+        self.assertEqual(self.index.get_pairs("lists", "image/png"), [])
+
+    def test_keys_values_and_counts(self):
+        self.assertEqual(sorted(self.index.keys("MimeType")),
+                sorted(INDEX["MimeType"]))
+        self.assertEqual(sorted(self.index.values("ids")),
+                sorted(INDEX["ids"].values()))
+        self.assertEqual(self.index.counts, {"I": 2, "M": 3, "C": 1, "L": 1})
+        self.assertEqual(self.index.generation, INDEX["generation"])
+
+    def test_hash_cache(self):
+        hashes = {}
+        xo.MappedIndex.from_index(INDEX, hashes)
+        self.assertEqual(hashes["M:text/plain"],
+                xo.MappedIndex.hash(b"M:text/plain"))
+        # Index built with cached hashes is the same
+        self.assertEqual(xo.MappedIndex.from_index(INDEX, hashes).buf,
+                self.index.buf)
+
+    def test_invalid_buffer(self):
+        buf = self.index.buf
+        for invalid in (buf[:10], buf[:-1], b"X" + buf[1:]):
+            with self.assertRaises(ValueError):
+                xo.MappedIndex(invalid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests telling URL schemes from relative file names like "notes:draft.txt".
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+import wor.xdg_open as xo
+
+from helpers import run_main
+
+
+DESKTOP_FILE = """[Desktop Entry]
+Type=Application
+Name={0}
+Exec={0} %u
+MimeType={1};
+"""
+
+
+class SchemeURLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        apps = os.path.join(self.root, "applications")
+        os.mkdir(apps)
+        for name, mime_type in (("editor", "text/plain"),
+                ("mailer", "x-scheme-handler/mailto")):
+            with open(os.path.join(apps, name + ".desktop"), "w") as f:
+                f.write(DESKTOP_FILE.format(name, mime_type))
+        self.config_fn = os.path.join(self.root, "pyxdg-open.conf")
+        with open(self.config_fn, "w") as f:
+            f.write("desktop_file_paths = {}\n"
+                    "search_order = desktop_file_paths\n"
+                    "check_try_exec = false\n".format(apps))
+        for name in ("notes:draft.txt", "mailto:draft.txt"):
+            with open(os.path.join(self.root, name), "w") as f:
+                f.write("draft\n")
+        # pyxdg-open runs in the temporary directory
+        python_path = [ os.path.abspath(path) for path in
+                os.environ.get("PYTHONPATH", "").split(os.pathsep) if path ]
+        self.env = dict(os.environ, PYTHONPATH=os.pathsep.join(python_path),
+                XDG_CACHE_HOME=os.path.join(self.root, "cache"))
+
+        self.old_state = (xo.CONFIG, xo.SCHEME_HANDLERS, xo.DESKTOP_FILE_INDEX,
+                xo.INDEX_GENERATION, xo.get_desktop_file_index,
+                os.environ.get("XDG_CACHE_HOME"), os.getcwd())
+
+    def tearDown(self):
+        (xo.CONFIG, xo.SCHEME_HANDLERS, xo.DESKTOP_FILE_INDEX,
+                xo.INDEX_GENERATION, xo.get_desktop_file_index, cache_home,
+                cwd) = self.old_state
+        os.chdir(cwd)
+        if cache_home is None:
+            os.environ.pop("XDG_CACHE_HOME", None)
+        else:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+        self.tmp.cleanup()
+
+    def new_run(self):
+        """Resets what's kept in memory for a run, in this process."""
+        os.environ["XDG_CACHE_HOME"] = self.env["XDG_CACHE_HOME"]
+        xo.CONFIG = xo.read_config_options(self.config_fn)
+        xo.SCHEME_HANDLERS = None
+        xo.DESKTOP_FILE_INDEX = None
+        xo.INDEX_GENERATION = None
+
+    def resolve(self, url):
+        out = run_main("-c", self.config_fn, "--resolve", url, cwd=self.root,
+                env=self.env)
+        return json.loads(out.stdout)
+
+    def test_resolve(self):
+        record = self.resolve("notes:draft.txt")
+        self.assertEqual(record["protocol"], "file")
+        self.assertEqual(record["url"],
+                os.path.join(os.path.realpath(self.root), "notes:draft.txt"))
+        self.assertEqual(record["argv"][0], "editor")
+
+        record = self.resolve("mailto:someone@example.com")
+        self.assertEqual(record["protocol"], "mailto")
+        self.assertEqual(record["argv"],
+                ["mailer", "mailto:someone@example.com"])
+
+    def test_absolute_url(self):
+        self.new_run()
+        os.chdir(self.root)
+        self.assertEqual(xo.get_absolute_url("notes:draft.txt"),
+                os.path.join(self.root, "notes:draft.txt"))
+        self.assertEqual(xo.get_absolute_url("notes:missing.txt"),
+                "notes:missing.txt")
+        # Scheme has a handler
+        self.assertEqual(xo.get_absolute_url("mailto:draft.txt"),
+                "mailto:draft.txt")
+        self.assertEqual(xo.get_absolute_url("https://example.com/"),
+                "https://example.com/")
+
+    def test_cached_table_needs_no_index(self):
+        url = "mailto:someone@example.com"
+        self.new_run()
+        purl, stage = xo.get_scheme_handler_url(url)
+        self.assertEqual(purl.mime_type, "x-scheme-handler/mailto")
+        self.assertEqual(os.path.basename(purl.desktop_file.file_name),
+                "mailer.desktop")
+        self.assertEqual(stage, "desktop_file_paths")
+
+        get_desktop_file_index = xo.get_desktop_file_index
+        def no_index(*args, **kwargs):
+            self.fail("Desktop file index opened")
+        self.new_run()
+        xo.get_desktop_file_index = no_index
+        purl, _ = xo.get_scheme_handler_url(url)
+        self.assertEqual(purl.desktop_file.get_entry_value_from_group("Exec"),
+                "mailer %u")
+
+        # Changed handler is noticed and the table rebuilt
+        mailer_fn = purl.desktop_file.file_name
+        with open(mailer_fn, "w") as f:
+            f.write(DESKTOP_FILE.format("mailer2",
+                "x-scheme-handler/mailto"))
+        self.new_run()
+        xo.get_desktop_file_index = get_desktop_file_index
+        purl, _ = xo.get_scheme_handler_url(url)
+        self.assertEqual(purl.desktop_file.get_entry_value_from_group("Exec"),
+                "mailer2 %u")
+
+
+if __name__ == '__main__':
+    unittest.main()
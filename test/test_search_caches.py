@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests that cached search results follow changed desktop files.
+
+Every resolution runs pyxdg-open --resolve in a new process, as runs share
+only the cache directory.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from helpers import run_main
+
+
+DESKTOP_FILE = """[Desktop Entry]
+Type=Application
+Name={0}
+Exec={0} %f
+MimeType={1};
+"""
+
+
+class SearchCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        self.apps = os.path.join(root, "applications")
+        os.mkdir(self.apps)
+        self.config_fn = os.path.join(root, "pyxdg-open.conf")
+        with open(self.config_fn, "w") as f:
+            f.write("desktop_file_paths = {}\n"
+                    "search_order = desktop_file_paths\n"
+                    "check_try_exec = false\n".format(self.apps))
+        self.text_fn = os.path.join(root, "notes.txt")
+        with open(self.text_fn, "w") as f:
+            f.write("notes\n")
+        self.env = dict(os.environ,
+                XDG_CACHE_HOME=os.path.join(root, "cache"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_desktop_file(self, name, mime_types, mtime=None,
+            replace=False):
+        """Writes a desktop file in place, keeping its directory unchanged,
+        or replaces it by renaming a new file over it as package managers do.
+        """
+        df_fn = os.path.join(self.apps, name + ".desktop")
+        tmp_fn = df_fn + ".tmp" if replace else df_fn
+        with open(tmp_fn, "a") as f:
+            f.truncate(0)
+            f.write(DESKTOP_FILE.format(name, ";".join(mime_types)))
+        if mtime is not None:
+            os.utime(tmp_fn, (mtime, mtime))
+        if replace:
+            os.replace(tmp_fn, df_fn)
+
+    def resolve(self, url):
+        """Returns --resolve record of a URL, exit status is 1 if not found."""
+        out = run_main("-c", self.config_fn, "--resolve", url, env=self.env)
+        return json.loads(out.stdout)
+
+    def resolved_name(self, url):
+        df_fn = self.resolve(url)["desktop_file"]
+        return os.path.basename(df_fn) if df_fn else None
+
+    def test_negative_result_follows_replaced_desktop_file(self):
+        self.write_desktop_file("viewer", ["image/png"], mtime=1000000000)
+        self.assertIsNone(self.resolved_name(self.text_fn))
+        # Negative cache hit
+        self.assertIsNone(self.resolved_name(self.text_fn))
+
+        self.write_desktop_file("viewer", ["image/png", "text/plain"],
+                mtime=1000000100, replace=True)
+        self.assertEqual(self.resolved_name(self.text_fn), "viewer.desktop")
+
+    def test_index_lookup_follows_edit_in_place(self):
+        self.write_desktop_file("editor", ["text/plain"], mtime=1000000000)
+        self.write_desktop_file("viewer", ["image/png"], mtime=1000000000)
+        self.assertEqual(self.resolved_name(self.text_fn), "editor.desktop")
+
+        # Directory is unchanged, so the index is refreshed only because
+        # the indexed desktop file no longer has the mime type
+        apps_mtime = os.stat(self.apps).st_mtime_ns
+        self.write_desktop_file("editor", ["text/x-c"], mtime=1000000100)
+        self.write_desktop_file("viewer", ["image/png", "text/plain"],
+                mtime=1000000100)
+        self.assertEqual(os.stat(self.apps).st_mtime_ns, apps_mtime)
+        self.assertEqual(self.resolved_name(self.text_fn), "viewer.desktop")
+
+    def test_mru_result_follows_changes(self):
+        self.write_desktop_file("editor", ["text/plain"], mtime=1000000000)
+        self.write_desktop_file("aviewer", ["image/png"], mtime=1000000000)
+        self.assertEqual(self.resolved_name(self.text_fn), "editor.desktop")
+        # MRU hit
+        self.assertEqual(self.resolved_name(self.text_fn), "editor.desktop")
+
+        # A desktop file earlier in the search order gains the mime type
+        self.write_desktop_file("aviewer", ["image/png", "text/plain"],
+                mtime=1000000100, replace=True)
+        self.assertEqual(self.resolved_name(self.text_fn), "aviewer.desktop")
+
+        # The MRU result itself is edited in place
+        self.write_desktop_file("aviewer", ["image/png"], mtime=1000000200)
+        self.assertEqual(self.resolved_name(self.text_fn), "editor.desktop")
+
+    def test_mru_result_checks_program(self):
+        bin_dir = os.path.join(self.tmp.name, "bin")
+        os.mkdir(bin_dir)
+        for name in ("editor", "aviewer"):
+            program = os.path.join(bin_dir, name)
+            with open(program, "w") as f:
+                f.write("#!/bin/sh\n")
+            os.chmod(program, 0o755)
+        with open(self.config_fn) as f:
+            config = f.read()
+        with open(self.config_fn, "w") as f:
+            f.write(config.replace("check_try_exec = false",
+                "check_try_exec = true"))
+        self.env["PATH"] = bin_dir + os.pathsep + self.env.get("PATH", "")
+        self.write_desktop_file("aviewer", ["text/plain"], mtime=1000000000)
+        self.write_desktop_file("editor", ["text/plain"], mtime=1000000000)
+        self.assertEqual(self.resolved_name(self.text_fn), "aviewer.desktop")
+        # MRU hit
+        self.assertEqual(self.resolved_name(self.text_fn), "aviewer.desktop")
+
+        os.remove(os.path.join(bin_dir, "aviewer"))
+        self.assertEqual(self.resolved_name(self.text_fn), "editor.desktop")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*- vim:fenc=utf-8:ft=python:et:sw=4:ts=4:sts=4
+"""Tests using caches built by root to the system cache directory."""
+
+import os
+import stat
+import tempfile
+import unittest
+
+import wor.xdg_open as xo
+
+
+class SystemCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old_state = (os.environ.get("XDG_CACHE_HOME"),
+                xo.SYSTEM_CACHE_DIR, xo.CACHE_DIR)
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self.tmp.name, "user")
+        xo.SYSTEM_CACHE_DIR = os.path.join(self.tmp.name, "system")
+        self.user_dir = xo.get_cache_dir()
+
+    def tearDown(self):
+        cache_home, xo.SYSTEM_CACHE_DIR, xo.CACHE_DIR = self.old_state
+        if cache_home is None:
+            os.environ.pop("XDG_CACHE_HOME", None)
+        else:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+        self.tmp.cleanup()
+
+    def store_system_cache(self, cache_name, data):
+        xo.CACHE_DIR = xo.SYSTEM_CACHE_DIR
+        try:
+            self.assertTrue(xo.store_cache(cache_name, data))
+        finally:
+            xo.CACHE_DIR = None
+
+    def test_system_cache_is_readable_by_all(self):
+        self.store_system_cache("test.pickle", {"stamp": 1})
+        mode = os.stat(os.path.join(xo.SYSTEM_CACHE_DIR,
+            "test.pickle")).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0o644)
+
+    def test_fresh_system_cache_is_used(self):
+        self.store_system_cache("test.pickle", {"stamp": 1})
+        def build():
+            return {"stamp": 2}
+        is_fresh = lambda data: data["stamp"] == 1
+        self.assertEqual(xo.load_or_build_cache("test.pickle", is_fresh,
+            self.fail), {"stamp": 1})
+        # Copied to the user's cache
+        self.assertEqual(xo.load_cache("test.pickle"), {"stamp": 1})
+
+        # Stale system cache is not used
+        is_fresh = lambda data: data["stamp"] == 2
+        self.assertEqual(xo.load_or_build_cache("test.pickle", is_fresh,
+            build), {"stamp": 2})
+        self.assertEqual(xo.load_cache("test.pickle"), {"stamp": 2})
+
+    def test_newer_system_entries_are_merged(self):
+        self.assertEqual(xo.load_path_keyed_cache("paths.pickle"),
+                ({}, False))
+        xo.store_cache("paths.pickle", {"/a": (2, "user a"),
+            "/b": (1, "user b")})
+        self.store_system_cache("paths.pickle", {"/a": (1, "system a"),
+            "/b": (2, "system b"), "/c": (1, "system c")})
+        self.assertEqual(xo.load_path_keyed_cache("paths.pickle"),
+                ({"/a": (2, "user a"), "/b": (2, "system b"),
+                    "/c": (1, "system c")}, True))
+
+        # Once the user's cache is stored again, the system cache is not read
+        data, _ = xo.load_path_keyed_cache("paths.pickle")
+        xo.store_cache("paths.pickle", data)
+        os.utime(os.path.join(xo.SYSTEM_CACHE_DIR, "paths.pickle"),
+                ns=(1, 1))
+        self.assertEqual(xo.load_path_keyed_cache("paths.pickle"),
+                (data, False))
+
+    def test_system_cache_in_use_is_not_merged(self):
+        self.store_system_cache("paths.pickle", {"/a": (1, "system a")})
+        xo.CACHE_DIR = xo.SYSTEM_CACHE_DIR
+        self.assertIsNone(xo.load_system_cache("paths.pickle"))
+        self.assertEqual(xo.load_path_keyed_cache("paths.pickle"),
+                ({"/a": (1, "system a")}, False))
+
+
+if __name__ == '__main__':
+    unittest.main()